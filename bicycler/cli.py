@@ -1,16 +1,28 @@
 import argparse
 import math
+import time
 import warnings
 from argparse import ArgumentTypeError
 from pathlib import Path
 
-from model.bicycle_controller import RollPIDController, RollPDController
-from model.bicycle_controller import NoControlController, RollRateFeedbackController, RollFeedbackController
+import numpy as np
+
+from model.bicycle_controller import create_controller, controller_types
 from model.bicycle_model import BicycleModel
 from model.bicycle_state import BicycleState
+from model.disturbances import Disturbance, parse_disturbance
+from model.lazy_simulation_result import LazySimulationResult
+from model.monte_carlo import MonteCarloStatistics, MonteCarloStudy, parse_distribution, variable_names
+from model.parameter_fit import fit_parameters, TrajectoryFit
+from model.result_archive import ResultArchive
+from model.result_cache import ResultCache, run_cached
 from model.simulation import Simulation
 from model.simulation_parameters import SimulationParameters
+from model.sensitivity import critical_speed_sensitivities, parameter_names
 from model.simulation_result import SimulationResult
+from model.stability import analyze_stability, StabilityAnalysis
+from model.sweep import expand_grid, Sweep
+from visualization.streaming_animation import StreamingAnimation
 from visualization.visualize import visualize_animation
 
 
@@ -26,20 +38,53 @@ def setup_parser() -> argparse.ArgumentParser:
                                   type=Path,
                                   help='Input file with bicycle parameters',
                                   required=True)
+    visualize_parser.add_argument('--run', type=int,
+                                  help='Index of the run to play, if the input file is an archive of a sweep')
 
     # add a subparser for the simulate command
     simulate_parser = subparsers.add_parser('simulate', help='Simulate the bicycle model')
     simulate_parser.add_argument('--show',
                                  action='store_true',
                                  help='Show the visualization instead of writing to a file')
+    simulate_parser.add_argument('--checkpoint-interval', type=int,
+                                 help='With --show, simulate the whole run first, but only keep a checkpoint every '
+                                      'N states and recompute the shown states from them. Allows to jump to any '
+                                      'state of very long runs, which are played while simulating by default')
     simulate_parser.add_argument('--output', '-o',
                                  type=Path,
                                  help='Output file for simulation results',
                                  required=True)
+    simulate_parser.add_argument('--format', '-f', type=str,
+                                 help='Format of the output file. npz holds the result in memory and writes it at '
+                                      'the end, npy writes it to a memory-mapped file while simulating, '
+                                      'compact writes a compressed npz file with float32 or quantized values',
+                                 choices=['npz', 'npy', 'compact'], default='npz')
+    simulate_parser.add_argument('--no-cache', action='store_true',
+                                 help='Always simulate instead of reusing a cached result of equal parameters')
+    simulate_parser.add_argument('--cache-dir', type=Path,
+                                 help='Directory of cached results, defaults to $BICYCLER_CACHE_DIR '
+                                      'or ~/.cache/bicycler')
+    simulate_parser.add_argument('--error-bound', type=float,
+                                 help='Maximum absolute error of the values in the compact format. '
+                                      'Values are stored as float32, if not given')
     simulate_parser.add_argument('--timestep', '-t', type=float,
                                  help='Timestep for the simulation in s', default=0.01)
     simulate_parser.add_argument('--stepcount', '-s', type=int,
                                     help='Number of steps for the simulation', default=500)
+    simulate_parser.add_argument('--output-every', type=float,
+                                 help='Time between two stored states in s. The simulation still integrates with '
+                                      'the timestep, but only stores every k-th state. Defaults to the timestep')
+    simulate_parser.add_argument('--control-period', type=float,
+                                 help='Time between two evaluations of the controller in s. The steer torque is held '
+                                      'in between. Defaults to the timestep')
+    simulate_parser.add_argument('--measurement-delay', type=float, default=0.0,
+                                 help='Age of the state in s, which the controller receives, e.g. the reaction time '
+                                      'of a rider')
+    simulate_parser.add_argument('--disturbance', action='append',
+                                 help='External torque, may be given several times: impulse:roll|steer:TIME:NMS, '
+                                      'step:roll|steer:START:NM[:DURATION] or noise:roll|steer:STD:BANDWIDTH_HZ')
+    simulate_parser.add_argument('--seed', type=int, default=0,
+                                 help='Seed of the random disturbances')
     simulate_parser.add_argument('--velocity', '-v', type=float,
                                     help='Velocity of the bicycle in m/s', default=5)
     simulate_parser.add_argument('--roll', '-r', type=float,
@@ -48,14 +93,207 @@ def setup_parser() -> argparse.ArgumentParser:
                                     help='Initial steering angle in degree', default=-2)
     simulate_parser.add_argument('--controller', '-c', type=str,
                                     help='Controller to use for the simulation',
-                                 choices=['none', 'roll', 'rollrate', 'pid', 'pd'], default='none')
+                                 choices=list(controller_types), default='none')
+    simulate_parser.add_argument('--engine', '-e', type=str,
+                                 help='Engine to advance the simulation. The exact engine steps with the transition '
+                                      'matrix of the linear closed-loop system and falls back to numeric integration '
+                                      'for nonlinear controllers',
+                                 choices=SimulationParameters.engines, default='numeric')
+    simulate_parser.add_argument('--integrator', type=str,
+                                 help='Integration method of the numeric engine. rk45 adapts its internal step size '
+                                      'and writes the output on the grid of the timestep. The higher order methods '
+                                      'only gain accuracy for linear controllers',
+                                 choices=SimulationParameters.integrators, default='euler')
     simulate_parser.add_argument('--model-parameters', metavar='PARAMETER=VALUE', type=str, nargs='+',
                                     help='Vary parameter values of the bicycle model. '
                                          'Give name and value pairs as NAME=VALE separated by spaces.'
                                          'Do not put spaces around the = sign.')
 
+    # add a subparser for the stability command
+    stability_parser = subparsers.add_parser('stability',
+                                             help='Compute the eigenvalues of the linearized bicycle model '
+                                                  'and its critical speeds')
+    stability_parser.add_argument('--min-velocity', type=float,
+                                  help='Lowest velocity of the grid in m/s', default=0.0)
+    stability_parser.add_argument('--max-velocity', type=float,
+                                  help='Highest velocity of the grid in m/s', default=10.0)
+    stability_parser.add_argument('--points', '-n', type=parse_positive_int,
+                                  help='Number of velocities in the grid', default=10000)
+    stability_parser.add_argument('--table-rows', type=int,
+                                  help='Number of velocities to print in the eigenvalue table', default=21)
+    stability_parser.add_argument('--controller', '-c', type=str,
+                                  help='Analyze the closed-loop system with a linear controller',
+                                  choices=['none', 'roll', 'rollrate', 'pd'], default='none')
+    stability_parser.add_argument('--output', '-o', type=Path,
+                                  help='Optional output file for the velocities and eigenvalues of the whole grid')
+    stability_parser.add_argument('--sensitivities', type=int, metavar='N',
+                                  help='Print the N model parameters with the largest influence on each critical '
+                                       'speed, from the analytic derivatives of the critical speeds')
+    stability_parser.add_argument('--model-parameters', metavar='PARAMETER=VALUE', type=str, nargs='+',
+                                  help='Vary parameter values of the bicycle model. '
+                                       'Give name and value pairs as NAME=VALE separated by spaces.'
+                                       'Do not put spaces around the = sign.')
+
+    # add a subparser for the fit command
+    fit_parser = subparsers.add_parser('fit',
+                                       help='Fit parameters of the bicycle model to a recorded trajectory, '
+                                            'which is driven by its recorded steer torque')
+    fit_parser.add_argument('--input', '-i', type=Path,
+                            help='Recorded trajectory in the layout of a simulation result', required=True)
+    fit_parser.add_argument('--parameters', '-p', metavar='PARAMETER', type=str, nargs='+',
+                            help='Names of the fitted model parameters', required=True,
+                            choices=list(BicycleModel.default_parameters))
+    fit_parser.add_argument('--velocity', type=float,
+                            help='Velocity of the bicycle in m/s, defaults to the velocity in the metadata '
+                                 'of the recording')
+    fit_parser.add_argument('--segment-duration', type=float,
+                            help='Length of the segments in s, which are simulated from the recorded states',
+                            default=1.0)
+    fit_parser.add_argument('--starts', type=parse_positive_int,
+                            help='Number of starts. The first start is the initial guess, the others are drawn '
+                                 'around it', default=8)
+    fit_parser.add_argument('--spread', type=float,
+                            help='Relative distance of the random starts from the initial guess', default=0.2)
+    fit_parser.add_argument('--seed', type=int, default=0,
+                            help='Seed of the random starts')
+    fit_parser.add_argument('--workers', '-w', type=int,
+                            help='Number of worker processes, defaults to the number of cores')
+    fit_parser.add_argument('--max-iterations', type=int, default=100,
+                            help='Maximum number of Levenberg-Marquardt iterations per start')
+    fit_parser.add_argument('--model-parameters', metavar='PARAMETER=VALUE', type=str, nargs='+',
+                            help='Values of the other parameters and the initial guess of the fitted parameters. '
+                                 'Give name and value pairs as NAME=VALE separated by spaces.'
+                                 'Do not put spaces around the = sign.')
+
+    # add a subparser for the montecarlo command
+    montecarlo_parser = subparsers.add_parser('montecarlo',
+                                              help='Estimate the probability of a fall, when the initial state, '
+                                                   'velocity and model parameters are drawn from distributions')
+    montecarlo_parser.add_argument('--sample', metavar='VARIABLE=DISTRIBUTION', type=str, nargs='+',
+                                   help='Distributions of the velocity in m/s, the initial roll, steer, roll_rate '
+                                        'and steer_rate in degree (per second) or of model parameters as VALUE, '
+                                        'normal:MEAN:STD or uniform:LOW:HIGH, e.g. velocity=uniform:3:6 '
+                                        'c=normal:0.08:0.005')
+    montecarlo_parser.add_argument('--controller', '-c', type=str,
+                                   help='Controller to use for the simulations. It is designed for the base model',
+                                   choices=list(controller_types), default='none')
+    montecarlo_parser.add_argument('--gains', metavar='GAIN=VALUE', type=str, nargs='+',
+                                   help='Gains of the controller')
+    montecarlo_parser.add_argument('--model-parameters', metavar='PARAMETER=VALUE', type=str, nargs='+',
+                                   help='Values of the model parameters without a distribution. '
+                                        'Give name and value pairs as NAME=VALE separated by spaces.'
+                                        'Do not put spaces around the = sign.')
+    montecarlo_parser.add_argument('--timestep', '-t', type=float,
+                                   help='Timestep for the simulation in s', default=0.01)
+    montecarlo_parser.add_argument('--stepcount', '-s', type=int,
+                                   help='Number of steps for the simulation', default=500)
+    montecarlo_parser.add_argument('--seed', type=int, default=0,
+                                   help='Seed of the samples')
+    montecarlo_parser.add_argument('--batch-size', type=int, default=256,
+                                   help='Number of samples which are simulated together')
+    montecarlo_parser.add_argument('--workers', '-w', type=int,
+                                   help='Number of worker processes, defaults to the number of cores')
+    montecarlo_parser.add_argument('--ci-width', type=float, default=0.01,
+                                   help='Stop, when the half width of the confidence interval of the fall '
+                                        'probability is at most this value')
+    montecarlo_parser.add_argument('--confidence', type=float, default=0.95,
+                                   help='Confidence level of the interval')
+    montecarlo_parser.add_argument('--min-samples', type=int, default=1000,
+                                   help='Minimum number of samples before stopping')
+    montecarlo_parser.add_argument('--max-samples', type=int, default=1000000,
+                                   help='Maximum number of samples')
+    montecarlo_parser.add_argument('--checkpoint', type=Path,
+                                   help='File which holds the statistics while running. If it exists, the study '
+                                        'is resumed from it')
+    montecarlo_parser.add_argument('--histograms', action='store_true',
+                                   help='Print a histogram of every metric')
+
+    # add a subparser for the sweep command
+    sweep_parser = subparsers.add_parser('sweep',
+                                         help='Simulate a grid of parameters in parallel. Values are given as a list '
+                                              'of numbers or as ranges START:STOP:COUNT')
+    sweep_parser.add_argument('--output', '-o', type=Path,
+                              help='Output .npy file for the parameters and metrics of all runs, which is written as '
+                                   'the runs complete', required=True)
+    sweep_parser.add_argument('--timestep', '-t', type=float,
+                              help='Timestep for the simulation in s', default=0.01)
+    sweep_parser.add_argument('--stepcount', '-s', type=int,
+                              help='Number of steps for the simulation', default=500)
+    sweep_parser.add_argument('--velocity', '-v', type=str, nargs='+',
+                              help='Velocities of the bicycle in m/s', default=['5'])
+    sweep_parser.add_argument('--roll', '-r', type=str, nargs='+',
+                              help='Initial roll angles in degree', default=['5'])
+    sweep_parser.add_argument('--steer', '-d', type=str, nargs='+',
+                              help='Initial steering angles in degree', default=['-2'])
+    sweep_parser.add_argument('--controller', '-c', type=str, nargs='+',
+                              help='Controllers to use for the simulation',
+                              choices=list(controller_types), default=['none'])
+    sweep_parser.add_argument('--gains', metavar='GAIN=VALUES', type=str, nargs='+',
+                              help='Vary controller gains, e.g. kp=5,10,20 or kp=0:20:5. '
+                                   'Gains are only applied to the controllers which use them.')
+    sweep_parser.add_argument('--model-parameters', metavar='PARAMETER=VALUES', type=str, nargs='+',
+                              help='Vary parameter values of the bicycle model, e.g. c=0.06,0.08 or c=0:0.1:11')
+    sweep_parser.add_argument('--engine', '-e', type=str, help='Engine to advance the simulations',
+                              choices=SimulationParameters.engines, default='numeric')
+    sweep_parser.add_argument('--integrator', type=str, help='Integration method of the numeric engine',
+                              choices=SimulationParameters.integrators, default='euler')
+    sweep_parser.add_argument('--workers', '-w', type=int,
+                              help='Number of worker processes, defaults to the number of cores')
+    sweep_parser.add_argument('--chunk-size', type=int,
+                              help='Number of runs sent to a worker at once', default=64)
+    sweep_parser.add_argument('--trajectories', action='store_true',
+                              help='Also store the trajectory of every run in its record of the output file')
+    sweep_parser.add_argument('--archive', type=Path,
+                              help='Store the trajectories of all runs together with an index of their parameters '
+                                   'and metrics in a single archive file. Play a run with visualize --run')
+    sweep_parser.add_argument('--no-superposition', action='store_true',
+                              help='Simulate every run, instead of computing the runs with a linear controller, '
+                                   'which only differ in their initial angles, by superposition')
+
     return parser
 
+def parse_positive_int(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        raise ArgumentTypeError(f'Invalid integer "{value}"') from None
+    if number < 1:
+        raise ArgumentTypeError(f'{number} is not positive')
+    return number
+
+def parse_values(specified_items: list[str]) -> list[float]:
+    values = []
+    for item in specified_items:
+        for value in item.split(','):
+            if value.count(':') == 2:
+                start, stop, count = value.split(':')
+                values.extend(np.linspace(float(start), float(stop), int(count)).tolist())
+            elif value:
+                values.append(float(value))
+    return values
+
+def parse_named_values(specified_items: list[str] | None, valid_names, kind: str) -> dict[str, list[float]]:
+    named_values = {}
+    for kv_pair in specified_items or []:
+        if kv_pair.count('=') != 1:
+            raise ArgumentTypeError(f'Invalid {kind} specification: "{kv_pair}"". Use NAME=VALUES!')
+        key, values = kv_pair.split('=')
+        key = key.strip()
+        if key in valid_names:
+            named_values[key] = parse_values([values])
+        else:
+            warnings.warn(f'Unknown {kind} "{key}" with values {values} specified. Ignoring it.')
+    return named_values
+
+def parse_disturbances(specified_items: list[str] | None) -> list[Disturbance]:
+    disturbances = []
+    for spec in specified_items or []:
+        try:
+            disturbances.append(parse_disturbance(spec))
+        except ValueError as e:
+            raise ArgumentTypeError(str(e)) from None
+    return disturbances
+
 def parse_model_parameters(specified_items: list[str]) -> BicycleModel:
     specified_parameters = {}
     if specified_items:
@@ -70,18 +308,28 @@ def parse_model_parameters(specified_items: list[str]) -> BicycleModel:
                 warnings.warn(f'Unknown parameter "{key}" with value {value} specified. Ignoring it.')
 
     # create the model with the default parameters
-    return BicycleModel(**specified_parameters)
+    return BicycleModel.create(**specified_parameters)
 
 
-def visualize_from_file(input_file: Path, verbose = False):
+def visualize_from_file(input_file: Path, verbose = False, run: int | None = None):
     if verbose:
         print(f'Loading {input_file} for visualization')
     # load the input file
-    animation = SimulationResult.load_from(input_file)
+    if run is not None:
+        with ResultArchive(input_file) as archive:
+            animation = archive.load(run)
+    else:
+        animation = SimulationResult.load_from(input_file)
     visualize_animation(animation)
 
 
-def simulate(simulation_parameters: SimulationParameters,verbose = False) -> SimulationResult:
+def simulate(simulation_parameters: SimulationParameters,verbose = False,
+             cache: ResultCache | None = None) -> SimulationResult:
+    if cache is not None:
+        # reuse the result of an earlier simulation with equal parameters
+        if verbose:
+            print(f'Simulating bicycle model or loading the result from {cache.directory}')
+        return run_cached(simulation_parameters, cache)
     if verbose:
         print('Simulating bicycle model')
     # create a simulation
@@ -92,7 +340,8 @@ def simulate(simulation_parameters: SimulationParameters,verbose = False) -> Sim
     return simulation.get_result()
 
 def simulate_to_file(simulation_parameters: SimulationParameters,
-                     output_file: Path, verbose = False):
+                     output_file: Path, output_format: str = 'npz', verbose = False,
+                     error_bound: float | None = None, cache: ResultCache | None = None):
     if verbose:
         print(f'Simulating bicycle model and saving results to {output_file}')
     # check, that the output directory exists
@@ -101,7 +350,193 @@ def simulate_to_file(simulation_parameters: SimulationParameters,
             print(f"Creating directory {output_file.parent.absolute()}")
         output_file.parent.mkdir(parents=True, exist_ok=True)
 
-    simulate(simulation_parameters, verbose).save_to(output_file)
+    if output_format == 'npy':
+        # write the states to disk while simulating
+        simulation = Simulation(simulation_parameters)
+        simulation.run(output_file.with_suffix('.npy'))
+    elif output_format == 'compact':
+        error = simulate(simulation_parameters, verbose, cache).save_compact(output_file, error_bound)
+        print('Maximum round-trip error per column: ' +
+              ', '.join(f'{name} {value:.3g}' for name, value in
+                        zip(('roll', 'steer', 'roll_rate', 'steer_rate', 'steer_torque', 'heading'), error)))
+    else:
+        simulate(simulation_parameters, verbose, cache).save_to(output_file)
+
+def print_stability_analysis(analysis: StabilityAnalysis, table_rows: int):
+    # eigenvalue table over the velocity, like figure 3 of the paper
+    header = f"{'v [m/s]':>8} | " + " | ".join(f"{'eigenvalue ' + str(i + 1):>22}" for i in range(4))
+    print(header)
+    print('-' * len(header))
+    rows = np.unique(np.linspace(0, len(analysis.velocities) - 1, max(table_rows, 2)).round().astype(int))
+    for i in rows:
+        values = " | ".join(f"{value.real:10.4f} {value.imag:+10.4f}j" for value in analysis.eigenvalues[i])
+        print(f"{analysis.velocities[i]:8.3f} | {values}")
+    print()
+
+    for speed in analysis.critical_speeds:
+        direction = 'stabilizes' if speed.stabilizing else 'destabilizes'
+        print(f"{speed.mode} speed: {speed.velocity:.6f} m/s ({direction} for higher velocities)")
+    if analysis.stable_intervals:
+        for lower, upper in analysis.stable_intervals:
+            print(f"stable for {lower:.6f} m/s < v < {upper:.6f} m/s")
+    else:
+        print("not stable for any velocity of the grid")
+
+
+def print_critical_speed_sensitivities(model: BicycleModel, analysis: StabilityAnalysis, derivatives: np.ndarray,
+                                       count: int):
+    values = np.array([model.get_parameter(name) for name in parameter_names])
+    for speed, speed_derivatives in zip(analysis.critical_speeds, derivatives):
+        # relative change of the speed per relative change of the parameter, to compare parameters of any unit
+        elasticities = speed_derivatives * values / speed.velocity
+        print()
+        print(f"sensitivity of the {speed.mode} speed {speed.velocity:.6f} m/s")
+        print(f"{'parameter':>10} | {'value':>10} | {'dv/dp':>12} | {'elasticity':>10}")
+        for i in np.argsort(-np.abs(elasticities), kind='stable')[:count]:
+            print(f"{parameter_names[i]:>10} | {values[i]:10.4g} | {speed_derivatives[i]:12.5g} | "
+                  f"{elasticities[i]:10.4f}")
+
+
+def stability(args: argparse.Namespace):
+    model = parse_model_parameters(args.model_parameters)
+    gains = create_controller(args.controller).get_linear_gains()
+    velocities = np.linspace(args.min_velocity, args.max_velocity, args.points)
+
+    start = time.perf_counter()
+    analysis = analyze_stability(model, velocities, gains)
+    duration = time.perf_counter() - start
+
+    print_stability_analysis(analysis, args.table_rows)
+    if args.sensitivities:
+        start = time.perf_counter()
+        derivatives = critical_speed_sensitivities(model, analysis, gains)
+        if args.verbose:
+            print(f"Computed the derivatives of {len(analysis.critical_speeds)} critical speeds with respect to "
+                  f"{len(parameter_names)} parameters in {(time.perf_counter() - start) * 1000:.1f}ms")
+        print_critical_speed_sensitivities(model, analysis, derivatives, args.sensitivities)
+    if args.verbose:
+        print(f"Analyzed {args.points} velocities in {duration * 1000:.1f}ms")
+    if args.output is not None:
+        np.savez(args.output, velocities=analysis.velocities, eigenvalues=analysis.eigenvalues,
+                 critical_speeds=np.array([speed.velocity for speed in analysis.critical_speeds]))
+
+
+def fit(args: argparse.Namespace):
+    recording = SimulationResult.load_from(args.input)
+    velocity = args.velocity
+    if velocity is None:
+        # the metadata of a simulation result holds the velocity as "5.0 m/s"
+        description = recording.get_metadata().get('bicycle_velocity')
+        if description is None:
+            raise ArgumentTypeError(f'{args.input} does not contain the velocity, give it with --velocity')
+        velocity = float(description.split()[0])
+    problem = TrajectoryFit(recording.get_data_array(), float(recording.get_timestep()), velocity, args.parameters,
+                            parse_model_parameters(args.model_parameters), args.segment_duration)
+    if args.verbose:
+        print(f'Fitting {len(args.parameters)} parameters to {len(recording.get_data_array())} states '
+              f'from {args.starts} starts')
+
+    start = time.perf_counter()
+    results = fit_parameters(problem, args.starts, args.spread, args.seed, args.workers, args.max_iterations)
+    duration = time.perf_counter() - start
+
+    best = results[0]
+    print(f"{'parameter':>10} | {'initial':>12} | {'fitted':>12} | {'std. error':>10}")
+    for name, initial, value, uncertainty in zip(best.parameter_names, problem.get_initial_values(), best.values,
+                                                 best.uncertainties):
+        print(f"{name:>10} | {initial:12.6g} | {value:12.6g} | {uncertainty:10.3g}")
+    print(f"rms residual of roll and steer: {best.rms:.4g} rad after {best.iterations} iterations"
+          f"{'' if best.converged else ' (stalled)' if best.stalled else ' (not converged)'}")
+    if args.verbose:
+        print('rms residual of all starts: ' + ', '.join(f'{result.rms:.4g}' for result in results))
+    print(f'Fitted in {duration:.2f}s')
+
+
+def parse_distributions(specified_items: list[str] | None) -> dict:
+    distributions = {}
+    for kv_pair in specified_items or []:
+        if kv_pair.count('=') != 1:
+            raise ArgumentTypeError(f'Invalid distribution specification: "{kv_pair}"". Use NAME=DISTRIBUTION!')
+        key, spec = kv_pair.split('=')
+        if key.strip() not in variable_names:
+            raise ArgumentTypeError(f'Unknown variable "{key}". Use one of {", ".join(variable_names)}')
+        try:
+            distributions[key.strip()] = parse_distribution(spec)
+        except ValueError as e:
+            raise ArgumentTypeError(str(e)) from None
+    return distributions
+
+
+def print_monte_carlo_statistics(statistics: MonteCarloStatistics, confidence: float, histograms: bool):
+    lower, upper = statistics.get_confidence_interval(confidence)
+    print(f"fall probability: {statistics.get_fall_probability():.4f} "
+          f"({confidence:.0%} confidence interval {lower:.4f} to {upper:.4f}) "
+          f"from {statistics.sample_count} samples")
+    if statistics.error_count:
+        print(f"{statistics.error_count} samples without a valid bicycle model were skipped")
+    print()
+    quantiles = (0.05, 0.5, 0.95)
+    header = (f"{'metric':>17} | {'count':>8} | {'mean':>10} | {'std':>10} | {'min':>10} | "
+              + " | ".join(f"{f'{q:.0%}':>10}" for q in quantiles) + f" | {'max':>10}")
+    print(header)
+    print('-' * len(header))
+    for name, sketch in statistics.metrics.items():
+        values = [sketch.mean if sketch.count else math.nan, sketch.get_std(),
+                  sketch.minimum if sketch.count else math.nan] + [sketch.quantile(q) for q in quantiles] + \
+                 [sketch.maximum if sketch.count else math.nan]
+        print(f"{name:>17} | {sketch.count:8d} | " + " | ".join(f"{value:10.4g}" for value in values))
+    if histograms:
+        for name, sketch in statistics.metrics.items():
+            if not sketch.count:
+                continue
+            counts, edges = sketch.histogram()
+            print()
+            print(f"histogram of {name}")
+            for count, lower_edge, upper_edge in zip(counts, edges[:-1], edges[1:]):
+                bar = '#' * round(40 * count / max(counts.max(), 1))
+                print(f"{lower_edge:10.4g} to {upper_edge:10.4g} | {count:8d} {bar}")
+
+
+def montecarlo(args: argparse.Namespace):
+    gain_names = {name for _, gains in controller_types.values() for name in gains}
+    gains = {name: values[0] for name, values in parse_named_values(args.gains, gain_names, 'gain').items()}
+    study = MonteCarloStudy(parse_distributions(args.sample), args.controller, gains,
+                            parse_model_parameters(args.model_parameters), args.timestep, args.stepcount,
+                            args.batch_size, args.seed)
+    if args.checkpoint is not None and not args.checkpoint.parent.exists():
+        args.checkpoint.parent.mkdir(parents=True, exist_ok=True)
+
+    start = time.perf_counter()
+    statistics = study.run(args.workers, args.checkpoint, args.ci_width, args.confidence, args.min_samples,
+                           args.max_samples, args.verbose)
+    duration = time.perf_counter() - start
+
+    print_monte_carlo_statistics(statistics, args.confidence, args.histograms)
+    print(f'Finished in {duration:.1f}s')
+
+
+def sweep(args: argparse.Namespace):
+    gain_names = {name for _, gains in controller_types.values() for name in gains}
+    runs = expand_grid(parse_values(args.velocity),
+                       parse_values(args.roll),
+                       parse_values(args.steer),
+                       args.controller,
+                       parse_named_values(args.gains, gain_names, 'gain'),
+                       parse_named_values(args.model_parameters, BicycleModel.default_parameters, 'parameter'))
+    if args.verbose:
+        print(f'Sweeping {len(runs)} runs and saving results to {args.output}')
+    if not args.output.parent.exists():
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+
+    start = time.perf_counter()
+    columns = Sweep(runs, args.timestep, args.stepcount, args.engine, args.integrator).run(
+        args.output, args.workers, args.chunk_size, args.trajectories, args.verbose, args.archive,
+        not args.no_superposition)
+    duration = time.perf_counter() - start
+
+    failed = np.count_nonzero(columns['error'] != '')
+    print(f'Simulated {len(runs)} runs in {duration:.1f}s, {failed} failed')
+
 
 def cli_main():
     parser = setup_parser()
@@ -110,7 +545,19 @@ def cli_main():
     args = parser.parse_args()
 
     if args.command == 'visualize':
-        visualize_from_file(args.input, args.verbose)
+        visualize_from_file(args.input, args.verbose, args.run)
+
+    if args.command == 'stability':
+        stability(args)
+
+    if args.command == 'sweep':
+        sweep(args)
+
+    if args.command == 'fit':
+        fit(args)
+
+    if args.command == 'montecarlo':
+        montecarlo(args)
 
     if args.command == 'simulate':
         # first, parse the model parameters
@@ -118,25 +565,27 @@ def cli_main():
         # parse the initial state
         init_state = BicycleState(math.radians(args.roll), math.radians(args.steer), 0, 0, 0, 0)
         # instantiate the controller
-        if args.controller == 'none':
-            controller = NoControlController()
-        elif args.controller == 'rollrate':
-            controller = RollRateFeedbackController(15.0)
-        elif args.controller == "roll":
-            controller = RollFeedbackController(10.0)
-        elif args.controller == "pid":
-            controller = RollPIDController(10, 10, 10)
-        elif args.controller == "pd":
-            controller = RollPDController(10, 10)
-        else:
-            raise ValueError(f'Unknown controller {args.controller} specified')
+        controller = create_controller(args.controller, model)
         # create the simulation parameters
-        simulation_parameters = SimulationParameters(init_state, model, args.velocity, controller, args.timestep, args.stepcount)
+        simulation_parameters = SimulationParameters(init_state, model, args.velocity, controller, args.timestep, args.stepcount,
+                                                     args.engine, args.integrator, args.output_every,
+                                                     args.control_period, args.measurement_delay,
+                                                     parse_disturbances(args.disturbance), args.seed)
 
-        if args.show:
-            visualize_animation(simulate(simulation_parameters, args.verbose))
+        if args.show and args.checkpoint_interval:
+            # play any state of the simulation in constant memory
+            if args.verbose:
+                print('Simulating bicycle model')
+            visualize_animation(LazySimulationResult(Simulation(simulation_parameters), args.checkpoint_interval),
+                                autoplay=True)
+        elif args.show:
+            # play the simulation while it is running
+            if args.verbose:
+                print('Simulating bicycle model')
+            visualize_animation(StreamingAnimation(Simulation(simulation_parameters)).start(), autoplay=True)
         else:
-            simulate_to_file(simulation_parameters, args.output, args.verbose)
+            cache = None if args.no_cache else ResultCache(args.cache_dir)
+            simulate_to_file(simulation_parameters, args.output, args.format, args.verbose, args.error_bound, cache)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,207 @@
+import numpy as np
+
+from model.bicycle_controller import BicycleController, ControllerState, NoControlController
+from model.bicycle_model import BicycleModel
+from model.bicycle_state import BicycleState
+from model.simulation_parameters import SimulationParameters
+from model.simulation_result import SimulationResult
+
+
+class BatchSimulation:
+    """
+    Simulates an ensemble of bicycles at once.
+    The state of all members is advanced together as (N, 4) arrays using stacked model matrices,
+    so the per-step Python overhead is shared by the whole ensemble.
+    Members which fall over are removed from the active set and their remaining rows are frozen,
+    just like in Simulation.run.
+    """
+
+    initial_states: np.ndarray
+    velocities: np.ndarray
+    bicycle_models: list[BicycleModel]
+    controllers: list[BicycleController]
+    timestep: float
+    stepcount: int
+    data: np.ndarray
+    result_populated: bool = False
+    # distinct controller instances, the group of every member and its row in the state of its controller
+    controller_groups: list[BicycleController]
+    member_groups: np.ndarray
+    member_rows: np.ndarray
+    controller_states: list[ControllerState]
+
+    def __init__(self,
+                 initial_states: np.ndarray,
+                 velocities: np.ndarray | float,
+                 bicycle_models: BicycleModel | list[BicycleModel] | None = None,
+                 controllers: BicycleController | list[BicycleController] | None = None,
+                 timestep: float = 0.01,
+                 stepcount: int = 500):
+        """
+        :param initial_states: Initial states of shape (N, 4) as roll, steer, roll_rate, steer_rate
+                               or of shape (N, 6) in the layout of SimulationResult
+        :param velocities: Velocity per member of shape (N,) or a single velocity for all members
+        :param bicycle_models: A single model for all members or one model per member
+        :param controllers: A single controller for all members or one controller per member.
+                            Every member has its own controller state, so members can share a controller.
+        :param timestep: Timestep of the simulation in s
+        :param stepcount: Number of steps to simulate
+        """
+        initial_states = np.atleast_2d(np.asarray(initial_states, dtype=float))
+        if initial_states.ndim != 2 or initial_states.shape[1] not in (4, 6):
+            raise ValueError(f"Initial states must be of shape (N, 4) or (N, 6), got {initial_states.shape}")
+        member_cnt = initial_states.shape[0]
+
+        self.initial_states = np.zeros((member_cnt, 6))
+        self.initial_states[:, :4] = initial_states[:, :4]
+        if initial_states.shape[1] == 6:
+            self.initial_states[:, 5] = initial_states[:, 5]
+
+        self.velocities = np.broadcast_to(np.asarray(velocities, dtype=float), (member_cnt,)).copy()
+
+        if bicycle_models is None:
+            bicycle_models = BicycleModel.create()
+        if isinstance(bicycle_models, BicycleModel):
+            bicycle_models = [bicycle_models] * member_cnt
+        if len(bicycle_models) != member_cnt:
+            raise ValueError(f"Expected {member_cnt} bicycle models, got {len(bicycle_models)}")
+        self.bicycle_models = list(bicycle_models)
+
+        if controllers is None:
+            controllers = NoControlController()
+        if isinstance(controllers, BicycleController):
+            controllers = [controllers] * member_cnt
+        if len(controllers) != member_cnt:
+            raise ValueError(f"Expected {member_cnt} controllers, got {len(controllers)}")
+        self.controllers = list(controllers)
+
+        self.timestep = timestep
+        self.stepcount = stepcount
+        self.data = np.zeros((member_cnt, stepcount, 6))
+
+    def get_member_count(self) -> int:
+        return self.initial_states.shape[0]
+
+    def _stack_model_matrices(self) -> tuple[np.ndarray, ...]:
+        M_inv = np.stack([model.M_inv for model in self.bicycle_models])
+        C1 = np.stack([model.C1 for model in self.bicycle_models])
+        K0 = np.stack([model.K0 for model in self.bicycle_models])
+        K2 = np.stack([model.K2 for model in self.bicycle_models])
+        g = np.array([model.get_parameter('g') for model in self.bicycle_models])
+        bike_lambda = np.array([model.get_parameter('lambda') for model in self.bicycle_models])
+        wheelbase = np.array([model.get_parameter('w') for model in self.bicycle_models])
+        trail = np.array([model.get_parameter('c') for model in self.bicycle_models])
+        return M_inv, C1, K0, K2, g, bike_lambda, wheelbase, trail
+
+    def _create_controller_states(self):
+        # members which share a controller instance are evaluated together,
+        # every member has its own row in the state of its controller
+        unique_controllers = {id(controller): controller for controller in self.controllers}
+        group_of = {key: group for group, key in enumerate(unique_controllers)}
+        self.controller_groups = list(unique_controllers.values())
+        self.member_groups = np.array([group_of[id(controller)] for controller in self.controllers], dtype=int)
+        self.member_rows = np.zeros(self.get_member_count(), dtype=int)
+        self.controller_states = []
+        for group, controller in enumerate(self.controller_groups):
+            members = np.flatnonzero(self.member_groups == group)
+            self.member_rows[members] = np.arange(len(members))
+            self.controller_states.append(
+                controller.create_state(len(members), self.velocities[members], period=self.timestep))
+
+    def _calculate_torques(self, members: np.ndarray, q: np.ndarray, q_dot: np.ndarray) -> np.ndarray:
+        """
+        Calculate the control inputs of the given members
+        :return: Torques of shape (N, 2) as roll_torque, steer_torque
+        """
+        torques = np.zeros((len(members), 2))
+        states = np.column_stack((q, q_dot))
+        groups = self.member_groups[members]
+        for group, controller in enumerate(self.controller_groups):
+            if isinstance(controller, NoControlController):
+                continue
+            selected = np.flatnonzero(groups == group)
+            if len(selected):
+                torques[selected] = controller.calculate_control_batch(
+                    states[selected], self.controller_states[group], self.member_rows[members[selected]])
+        return torques
+
+    def run(self):
+        dt = self.timestep
+        M_inv, C1, K0, K2, g, bike_lambda, wheelbase, trail = self._stack_model_matrices()
+        v = self.velocities
+
+        # fold the velocity dependent terms of equation 5.3 into one matrix per member
+        damping = v[:, None, None] * C1
+        stiffness = g[:, None, None] * K0 + (v ** 2)[:, None, None] * K2
+        # coefficients of the heading rate, based on equation (B6) from Appendix B
+        psi_steer_rate_coef = trail / wheelbase
+        psi_steer_coef = v * np.cos(bike_lambda) / wheelbase
+
+        # populate the first row with the initial states
+        self._create_controller_states()
+        active = np.arange(self.get_member_count())
+        q = self.initial_states[:, 0:2].copy()
+        q_dot = self.initial_states[:, 2:4].copy()
+        psi = self.initial_states[:, 5].copy()
+        torques = self._calculate_torques(active, q, q_dot)
+        self.data[:, 0, 0:2] = q
+        self.data[:, 0, 2:4] = q_dot
+        self.data[:, 0, 4] = torques[:, 1]
+        self.data[:, 0, 5] = psi
+
+        for step in range(1, self.stepcount):
+            if len(active) == 0:
+                break
+
+            # equation 5.3 rearranged for q_ddot, evaluated for all active members at once,
+            # the roll and steer torques are added to the accelerations like in Simulation
+            q_ddot = torques - (M_inv @ ((damping @ q_dot[:, :, None]) + (stiffness @ q[:, :, None])))[:, :, 0]
+
+            # first-order approximation of the integral, as in Simulation.run
+            q = q + dt * q_dot
+            q_dot = q_dot + dt * q_ddot
+            torques = self._calculate_torques(active, q, q_dot)
+            psi = psi + dt * (psi_steer_rate_coef * q_dot[:, 1] + psi_steer_coef * q[:, 1])
+
+            self.data[active, step] = np.column_stack((q, q_dot, torques[:, 1], psi))
+
+            # compact members which have fallen over out of the active set
+            fallen = (np.abs(q[:, 0]) > np.pi / 2) | (np.abs(q[:, 1]) > np.pi / 2)
+            if np.any(fallen):
+                fallen_members = active[fallen]
+                self.data[fallen_members, step + 1:] = self.data[fallen_members, step][:, None, :]
+                keep = ~fallen
+                active = active[keep]
+                q, q_dot, psi, torques = q[keep], q_dot[keep], psi[keep], torques[keep]
+                M_inv, damping, stiffness = M_inv[keep], damping[keep], stiffness[keep]
+                psi_steer_rate_coef, psi_steer_coef = psi_steer_rate_coef[keep], psi_steer_coef[keep]
+
+        self.result_populated = True
+
+    def get_data_array(self) -> np.ndarray:
+        """
+        Get the results of all members
+        :return: Array of shape (N, stepcount, 6) in the layout of SimulationResult
+        """
+        if not self.result_populated:
+            raise ValueError("Simulation has not been run yet")
+        return self.data
+
+    def get_member_parameters(self, member: int) -> SimulationParameters:
+        initial_state = BicycleState(*self.initial_states[member])
+        return SimulationParameters(initial_state, self.bicycle_models[member], float(self.velocities[member]),
+                                    self.controllers[member], self.timestep, self.stepcount)
+
+    def get_results(self) -> list[SimulationResult]:
+        """
+        Get the results of all members as separate SimulationResults.
+        The results share their data with the array returned by get_data_array.
+        """
+        data = self.get_data_array()
+        results = []
+        for member in range(self.get_member_count()):
+            result = SimulationResult(self.timestep, 0)
+            result.data = data[member]
+            result.metadata = self.get_member_parameters(member).get_description()
+            results.append(result)
+        return results
@@ -1,9 +1,18 @@
+import bisect
+import hashlib
+import json
 import math
+import os
+import time
 from abc import abstractmethod, ABC
 from dataclasses import dataclass
 
 import numpy as np
 
+from model import linear_system
+from model.bicycle_model import BicycleModel
+from model.cache_directory import get_cache_directory
+
 
 @dataclass
 class BicycleControl:
@@ -18,11 +27,54 @@ class BicycleControl:
 
 
 
+# internal state of a controller for a number of independent simulations, see BicycleController.create_state
+ControllerState = dict[str, np.ndarray]
+
+
 class BicycleController(ABC):
+    # controllers which are designed for a bicycle model receive the simulated model from create_controller
+    requires_model: bool = False
+    # statistics, which are measured times, so they only describe the run which measured them
+    timing_statistics: tuple[str, ...] = ()
+
     @abstractmethod
-    def calculate_control(self, roll: float, steer: float, roll_rate: float, steer_rate: float) -> BicycleControl:
+    def calculate_control(self, roll: float, steer: float, roll_rate: float, steer_rate: float,
+                          controller_state: ControllerState | None = None) -> BicycleControl:
+        """
+        Calculate the control input for a single state
+        :param controller_state: State from create_state with a single member. Stateful controllers use
+                                 a state of their own instance, if it is not given.
+        """
         pass
 
+    def create_state(self, member_cnt: int = 1, velocities: np.ndarray | float | None = None,
+                     period: float | None = None) -> ControllerState:
+        """
+        Create the internal state of the controller for a number of independent simulations.
+        The state is passed to the calculate methods instead of being stored on the instance,
+        so a single instance can drive many simulations at once.
+        :param member_cnt: Number of simulations
+        :param velocities: Velocity of every simulation in m/s, for controllers which depend on the velocity
+        :param period: Time between two calls of the calculate methods in s, if it is known
+        :return: Arrays with one row per simulation, empty for controllers without an internal state
+        """
+        return {}
+
+    def calculate_control_batch(self, states: np.ndarray,
+                                controller_state: ControllerState | None = None,
+                                members: np.ndarray | None = None) -> np.ndarray:
+        """
+        Calculate the control inputs for many states at once
+        :param states: States of shape (N, 4) as roll, steer, roll_rate, steer_rate
+        :param controller_state: State from create_state, required by stateful controllers
+        :param members: Rows of the controller state which belong to the states, defaults to all rows
+        :return: Control inputs of shape (N, 2) as roll_torque, steer_torque
+        """
+        gains = self.get_linear_gains()
+        if gains is None:
+            raise NotImplementedError(f'{self.get_name()} does not support batched control')
+        return states[:, 0:4] @ gains.T
+
     @abstractmethod
     def get_parameters(self) -> dict[str, str]:
         pass
@@ -30,16 +82,35 @@ class BicycleController(ABC):
     def get_name(self) -> str:
         return self.__class__.__name__
 
+    def get_statistics(self, controller_state: ControllerState) -> dict[str, str]:
+        """
+        Get statistics of the controller, e.g. of its computation time, which are added to the metadata
+        :param controller_state: The state of the controller after a simulation
+        """
+        return {}
+
+    def get_linear_gains(self) -> np.ndarray | None:
+        """
+        Get the gains of the controller if it is a linear state feedback
+        :return: Gain matrix K of shape (2, 4) with [roll_torque, steer_torque] = K @ [roll, steer, roll_rate, steer_rate]
+                 or None, if the controller is nonlinear or has an internal state
+        """
+        return None
+
 class NoControlController(BicycleController):
     """
     Controller which applies no control input.
     """
-    def calculate_control(self, roll: float, steer: float, roll_rate: float, steer_rate: float) -> BicycleControl:
+    def calculate_control(self, roll: float, steer: float, roll_rate: float, steer_rate: float,
+                          controller_state: ControllerState | None = None) -> BicycleControl:
         return BicycleControl(0.0, 0.0)
 
     def get_parameters(self) -> dict[str, str]:
         return {}
 
+    def get_linear_gains(self) -> np.ndarray | None:
+        return np.zeros((2, 4))
+
 
 class RollRateFeedbackController(BicycleController):
     """
@@ -48,12 +119,17 @@ class RollRateFeedbackController(BicycleController):
     def __init__(self, gain: float):
         self.gain = gain
 
-    def calculate_control(self, roll: float, steer: float, roll_rate: float, steer_rate: float) -> BicycleControl:
+    def calculate_control(self, roll: float, steer: float, roll_rate: float, steer_rate: float,
+                          controller_state: ControllerState | None = None) -> BicycleControl:
         return BicycleControl(0.0, self.gain * roll_rate)
 
     def get_parameters(self) -> dict[str, str]:
         return {'gain': str(self.gain)}
 
+    def get_linear_gains(self) -> np.ndarray | None:
+        return np.array([[0.0, 0.0, 0.0, 0.0],
+                         [0.0, 0.0, self.gain, 0.0]])
+
 
 class RollFeedbackController(BicycleController):
     """
@@ -62,12 +138,17 @@ class RollFeedbackController(BicycleController):
     def __init__(self, gain: float):
         self.gain = gain
 
-    def calculate_control(self, roll: float, steer: float, roll_rate: float, steer_rate: float) -> BicycleControl:
+    def calculate_control(self, roll: float, steer: float, roll_rate: float, steer_rate: float,
+                          controller_state: ControllerState | None = None) -> BicycleControl:
         return BicycleControl(0.0, self.gain * roll)
 
     def get_parameters(self) -> dict[str, str]:
         return {'gain': str(self.gain)}
 
+    def get_linear_gains(self) -> np.ndarray | None:
+        return np.array([[0.0, 0.0, 0.0, 0.0],
+                         [self.gain, 0.0, 0.0, 0.0]])
+
 
 class RollPIDController(BicycleController):
     """
@@ -75,26 +156,69 @@ class RollPIDController(BicycleController):
     """
     target_roll = 0.0
     integral_window_size: int
-    integral_window: np.ndarray
-    integral_window_idx = 0
+    # state which is used, if calculate_control is called without a state
+    default_state: ControllerState
 
     def __init__(self, kp: float, ki: float, kd: float, window_size = 10):
         self.kp = kp
         self.ki = ki
         self.kd = kd
         self.integral_window_size = window_size
-        self.integral_window = np.zeros(window_size)
+        self.default_state = self.create_state()
+
+    def create_state(self, member_cnt: int = 1, velocities: np.ndarray | float | None = None,
+                     period: float | None = None) -> ControllerState:
+        # ring buffer of the last errors together with their running sum
+        return {'window': np.zeros((member_cnt, self.integral_window_size)),
+                'index': np.zeros(member_cnt, dtype=int),
+                'sum': np.zeros(member_cnt)}
+
+    def calculate_control(self, roll: float, steer: float, roll_rate: float, steer_rate: float,
+                          controller_state: ControllerState | None = None) -> BicycleControl:
+        if controller_state is None:
+            controller_state = self.default_state
+        window = controller_state['window'][0]
+        index = int(controller_state['index'][0])
 
-    def calculate_control(self, roll: float, steer: float, roll_rate: float, steer_rate: float) -> BicycleControl:
         error = self.target_roll - roll
         derivative = roll_rate
-        self.integral_window[self.integral_window_idx] = error
-        self.integral_window_idx = (self.integral_window_idx + 1) % self.integral_window_size
-        integral = np.sum(self.integral_window)
+        # replace the oldest error in the window and update the sum, instead of summing the whole window
+        integral = float(controller_state['sum'][0]) + error - float(window[index])
+        window[index] = error
+        index = (index + 1) % self.integral_window_size
+        # sum the whole window once per cycle, so the rounding errors of the running sum do not accumulate
+        if index == 0:
+            integral = float(np.sum(window))
+        controller_state['sum'][0] = integral
+        controller_state['index'][0] = index
         return BicycleControl(0.0, -self.kp * error - self.ki * integral + self.kd * derivative)
 
+    def calculate_control_batch(self, states: np.ndarray,
+                                controller_state: ControllerState | None = None,
+                                members: np.ndarray | None = None) -> np.ndarray:
+        if controller_state is None:
+            raise ValueError(f'{self.get_name()} requires a controller state for batched control')
+        window = controller_state['window']
+        rows = np.arange(window.shape[0]) if members is None else np.asarray(members)
+        index = controller_state['index'][rows]
+
+        error = self.target_roll - states[:, 0]
+        integral = controller_state['sum'][rows] + error - window[rows, index]
+        window[rows, index] = error
+        index = (index + 1) % self.integral_window_size
+        wrapped = index == 0
+        if np.any(wrapped):
+            integral[wrapped] = np.sum(window[rows[wrapped]], axis=1)
+        controller_state['sum'][rows] = integral
+        controller_state['index'][rows] = index
+
+        control = np.zeros((len(states), 2))
+        control[:, 1] = -self.kp * error - self.ki * integral + self.kd * states[:, 2]
+        return control
+
     def get_parameters(self) -> dict[str, str]:
-        return {'kp': str(self.kp), 'ki': str(self.ki), 'kd': str(self.kd)}
+        return {'kp': str(self.kp), 'ki': str(self.ki), 'kd': str(self.kd),
+                'window_size': str(self.integral_window_size)}
 
 class RollPDController(BicycleController):
     """
@@ -107,10 +231,413 @@ class RollPDController(BicycleController):
         self.kd = kd
         self.integral = 0.0
 
-    def calculate_control(self, roll: float, steer: float, roll_rate: float, steer_rate: float) -> BicycleControl:
+    def calculate_control(self, roll: float, steer: float, roll_rate: float, steer_rate: float,
+                          controller_state: ControllerState | None = None) -> BicycleControl:
         error = self.target_roll - roll
         derivative = roll_rate
         return BicycleControl(0.0,  -self.kp * error + self.kd * derivative)
 
+    def calculate_control_batch(self, states: np.ndarray,
+                                controller_state: ControllerState | None = None,
+                                members: np.ndarray | None = None) -> np.ndarray:
+        # evaluated directly, because a non-zero target roll has no linear gains
+        control = np.zeros((len(states), 2))
+        control[:, 1] = -self.kp * (self.target_roll - states[:, 0]) + self.kd * states[:, 2]
+        return control
+
     def get_parameters(self) -> dict[str, str]:
-        return {'kp': str(self.kp), 'kd': str(self.kd)}
\ No newline at end of file
+        return {'kp': str(self.kp), 'kd': str(self.kd)}
+
+    def get_linear_gains(self) -> np.ndarray | None:
+        # a non-zero target roll makes the control law affine instead of linear
+        if self.target_roll != 0.0:
+            return None
+        return np.array([[0.0, 0.0, 0.0, 0.0],
+                         [self.kp, 0.0, self.kd, 0.0]])
+
+
+def get_model_key(bicycle_model: BicycleModel) -> str:
+    """
+    Hash all parameters of a bicycle model, to identify the model which a model-based controller is designed for
+    :return: Hex digest which is equal for equal models
+    """
+    description = {name: float(bicycle_model.get_parameter(name)) for name in sorted(BicycleModel.default_parameters)}
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class LQRController(BicycleController):
+    """
+    Linear-quadratic regulator of the steer torque, designed for the linearized bicycle at a single velocity.
+    The gains minimize the integral of xᵀQx + u·r·u for the state x = [roll, steer, roll_rate, steer_rate]
+    and are computed from the solution of the continuous algebraic Riccati equation.
+    """
+    requires_model = True
+    gains: np.ndarray
+
+    def __init__(self, velocity: float, bicycle_model: BicycleModel | None = None,
+                 q_roll: float = 1.0, q_steer: float = 1.0, q_roll_rate: float = 1.0, q_steer_rate: float = 1.0,
+                 r: float = 1.0):
+        """
+        :param velocity: Velocity in m/s for which the controller is designed
+        :param bicycle_model: The bicycle model, defaults to the default model
+        :param q_roll, q_steer, q_roll_rate, q_steer_rate: Weights of the state in the cost function
+        :param r: Weight of the steer torque in the cost function
+        """
+        self.velocity = velocity
+        self.bicycle_model = bicycle_model if bicycle_model is not None else BicycleModel.create()
+        self.weights = (q_roll, q_steer, q_roll_rate, q_steer_rate)
+        self.r = r
+        self.gains = linear_system.lqr_gains(self.bicycle_model, np.array([velocity]), self.weights, r)[0]
+        self.gains.flags.writeable = False
+
+    def calculate_control(self, roll: float, steer: float, roll_rate: float, steer_rate: float,
+                          controller_state: ControllerState | None = None) -> BicycleControl:
+        g0, g1, g2, g3 = self.gains.tolist()
+        return BicycleControl(0.0, g0 * roll + g1 * steer + g2 * roll_rate + g3 * steer_rate)
+
+    def get_parameters(self) -> dict[str, str]:
+        return {'velocity': str(self.velocity),
+                **{name: str(value) for name, value in zip(('q_roll', 'q_steer', 'q_roll_rate', 'q_steer_rate'),
+                                                           self.weights)},
+                'r': str(self.r),
+                'design_model': get_model_key(self.bicycle_model)}
+
+    def get_linear_gains(self) -> np.ndarray | None:
+        return np.array([[0.0, 0.0, 0.0, 0.0], self.gains])
+
+
+# gain tables of the gain-scheduled regulators computed in this process, by the key of their cache file
+_gain_tables: dict[str, np.ndarray] = {}
+
+
+class GainScheduledLQRController(BicycleController):
+    """
+    Linear-quadratic regulator, whose gains are scheduled over the velocity.
+    The gains are computed once for a grid of velocities and linearly interpolated for the velocity
+    of every simulation, so the controller works for any velocity without solving a Riccati equation.
+    The gain table is cached in the cache directory by the model parameters, weights and velocity grid.
+    Velocities outside of the grid use the gains of the closest grid velocity.
+    """
+    requires_model = True
+    velocities: np.ndarray
+    gain_table: np.ndarray
+
+    def __init__(self, bicycle_model: BicycleModel | None = None,
+                 q_roll: float = 1.0, q_steer: float = 1.0, q_roll_rate: float = 1.0, q_steer_rate: float = 1.0,
+                 r: float = 1.0, min_velocity: float = 0.5, max_velocity: float = 10.0, velocity_cnt: int = 96):
+        """
+        :param bicycle_model: The bicycle model, defaults to the default model
+        :param q_roll, q_steer, q_roll_rate, q_steer_rate: Weights of the state in the cost function
+        :param r: Weight of the steer torque in the cost function
+        :param min_velocity, max_velocity, velocity_cnt: Grid of velocities in m/s of the gain table
+        """
+        self.bicycle_model = bicycle_model if bicycle_model is not None else BicycleModel.create()
+        self.weights = (q_roll, q_steer, q_roll_rate, q_steer_rate)
+        self.r = r
+        self.velocities = np.linspace(min_velocity, max_velocity, int(velocity_cnt))
+        self.gain_table = self._load_gain_table()
+        # plain lists for the interpolation of single states
+        self._velocity_list = self.velocities.tolist()
+        self._gain_list = self.gain_table.tolist()
+
+    def _get_table_key(self) -> str:
+        description = {'model': get_model_key(self.bicycle_model),
+                       'weights': [float(weight) for weight in self.weights],
+                       'r': float(self.r),
+                       'velocities': self.velocities.tolist()}
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def _load_gain_table(self) -> np.ndarray:
+        key = self._get_table_key()
+        if key in _gain_tables:
+            return _gain_tables[key]
+        path = get_cache_directory() / 'lqr' / f'{key}.npy'
+        try:
+            gain_table = np.load(path)
+        except (OSError, ValueError):
+            gain_table = linear_system.lqr_gains(self.bicycle_model, self.velocities, self.weights, self.r)
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                # write to a temporary file first, so concurrent readers never see a partial table
+                temporary_path = path.with_name(f'{key}.{os.getpid()}.tmp.npy')
+                np.save(temporary_path, gain_table)
+                os.replace(temporary_path, path)
+            except OSError:
+                # the table is only cached for later runs
+                pass
+        gain_table.flags.writeable = False
+        _gain_tables[key] = gain_table
+        return gain_table
+
+    def get_gains(self, velocity: float) -> list[float]:
+        """
+        Interpolate the gains of the steer torque for a velocity
+        :return: The gains of roll, steer, roll_rate and steer_rate
+        """
+        velocities = self._velocity_list
+        upper = bisect.bisect_right(velocities, velocity)
+        if upper == 0:
+            return self._gain_list[0]
+        if upper == len(velocities):
+            return self._gain_list[-1]
+        lower = upper - 1
+        fraction = (velocity - velocities[lower]) / (velocities[upper] - velocities[lower])
+        return [a + fraction * (b - a) for a, b in zip(self._gain_list[lower], self._gain_list[upper])]
+
+    def create_state(self, member_cnt: int = 1, velocities: np.ndarray | float | None = None,
+                     period: float | None = None) -> ControllerState:
+        if velocities is None:
+            raise ValueError(f'{self.get_name()} requires the velocities of the simulations')
+        return {'velocity': np.broadcast_to(np.asarray(velocities, dtype=float), (member_cnt,)).copy()}
+
+    def calculate_control(self, roll: float, steer: float, roll_rate: float, steer_rate: float,
+                          controller_state: ControllerState | None = None) -> BicycleControl:
+        if controller_state is None:
+            raise ValueError(f'{self.get_name()} requires a controller state with the velocity')
+        g0, g1, g2, g3 = self.get_gains(float(controller_state['velocity'][0]))
+        return BicycleControl(0.0, g0 * roll + g1 * steer + g2 * roll_rate + g3 * steer_rate)
+
+    def calculate_control_batch(self, states: np.ndarray,
+                                controller_state: ControllerState | None = None,
+                                members: np.ndarray | None = None) -> np.ndarray:
+        if controller_state is None:
+            raise ValueError(f'{self.get_name()} requires a controller state with the velocity')
+        velocities = controller_state['velocity'] if members is None else controller_state['velocity'][members]
+        gains = np.column_stack([np.interp(velocities, self.velocities, self.gain_table[:, i]) for i in range(4)])
+        control = np.zeros((len(states), 2))
+        control[:, 1] = np.sum(gains * states[:, 0:4], axis=1)
+        return control
+
+    def get_parameters(self) -> dict[str, str]:
+        return {**{name: str(value) for name, value in zip(('q_roll', 'q_steer', 'q_roll_rate', 'q_steer_rate'),
+                                                           self.weights)},
+                'r': str(self.r),
+                'min_velocity': str(self.velocities[0]),
+                'max_velocity': str(self.velocities[-1]),
+                'velocity_cnt': str(len(self.velocities)),
+                'design_model': get_model_key(self.bicycle_model)}
+
+
+def solve_box_qp(H: np.ndarray, f: np.ndarray, bound: float, x: np.ndarray, lipschitz: np.ndarray,
+                 tolerance: float = 1e-6, max_iterations: int = 200) -> tuple[np.ndarray, int]:
+    """
+    Minimize ½xᵀHx + fᵀx subject to |x| <= bound for a stack of problems
+    with the accelerated projected gradient method (FISTA).
+    :param H: Positive definite matrices of shape (m, n, n)
+    :param f: Linear terms of shape (m, n)
+    :param bound: Bound of every variable
+    :param x: Initial guesses of shape (m, n), e.g. the shifted solutions of the previous problems
+    :param lipschitz: Largest eigenvalue of every H of shape (m,), the inverse is the step size
+    :param tolerance: The iteration stops, when the norm of the change of the variables is below this
+    :param max_iterations: Maximum number of iterations
+    :return: The solutions of shape (m, n) and the number of iterations
+    """
+    # a gradient step is y - (H/L)y - f/L, so scale H and f once instead of in every iteration
+    step = (1.0 / lipschitz)[:, None]
+    G = np.eye(H.shape[-1]) - H * step[:, :, None]
+    g = f * step
+    if len(H) == 1:
+        # a single problem avoids the overhead of the stacked products
+        G, g = G[0], g[0]
+        x = x[0]
+    x = np.minimum(np.maximum(x, -bound), bound)
+    y = x
+    t = 1.0
+    for iteration in range(1, max_iterations + 1):
+        if G.ndim == 2:
+            x_next = G @ y - g
+        else:
+            x_next = (G @ y[:, :, None])[:, :, 0] - g
+        np.maximum(x_next, -bound, out=x_next)
+        np.minimum(x_next, bound, out=x_next)
+        difference = x_next - x
+        t_next = (1 + math.sqrt(1 + 4 * t * t)) / 2
+        y = x_next + ((t - 1) / t_next) * difference
+        x, t = x_next, t_next
+        # the euclidean norm bounds the largest change of a single torque
+        if np.vdot(difference, difference) <= tolerance * tolerance:
+            break
+    return x.reshape(len(H), -1), iteration
+
+
+class MPCController(BicycleController):
+    """
+    Model predictive control of the steer torque with a torque limit, e.g. of a rider.
+    In every step the torques of the next horizon prediction steps are optimized for the discretized linear model
+    and the first one is applied. The cost is the sum of xᵀQx + u·r·u over the horizon and the terminal cost
+    x_NᵀPx_N with the solution P of the discrete Riccati equation, which is the cost of the LQR after the horizon.
+    So the unconstrained solution is the discrete LQR, which stabilizes the bicycle at any velocity, and the torques
+    are bounded by max_torque. The prediction is condensed into a QP in the torques only, whose matrices are computed once
+    per velocity. The QP is solved with a projected gradient method, starting from the solution of the previous
+    call shifted by the number of prediction steps, which have passed since then.
+    """
+    requires_model = True
+    timing_statistics = ('mpc_mean_solve_time', 'mpc_max_solve_time')
+
+    def __init__(self, bicycle_model: BicycleModel | None = None, max_torque: float = 5.0, horizon: int = 50,
+                 prediction_timestep: float = 0.01,
+                 q_roll: float = 1.0, q_steer: float = 1.0, q_roll_rate: float = 1.0, q_steer_rate: float = 1.0,
+                 r: float = 0.01, tolerance: float = 1e-6, max_iterations: int = 200):
+        """
+        :param bicycle_model: The bicycle model, defaults to the default model
+        :param max_torque: Maximum absolute steer torque in Nm
+        :param horizon: Number of prediction steps
+        :param prediction_timestep: Time between two prediction steps in s, during which the torque is constant
+        :param q_roll, q_steer, q_roll_rate, q_steer_rate: Weights of the state in the cost function
+        :param r: Weight of the steer torque in the cost function
+        :param tolerance: Accuracy of the torques in Nm, at which the QP solver stops
+        :param max_iterations: Maximum number of iterations of the QP solver per step
+        """
+        self.bicycle_model = bicycle_model if bicycle_model is not None else BicycleModel.create()
+        self.max_torque = max_torque
+        self.horizon = int(horizon)
+        self.prediction_timestep = prediction_timestep
+        self.weights = (q_roll, q_steer, q_roll_rate, q_steer_rate)
+        self.r = r
+        self.tolerance = tolerance
+        self.max_iterations = int(max_iterations)
+        # condensed QP matrices by velocity
+        self._qp_matrices: dict[float, tuple[np.ndarray, np.ndarray, float]] = {}
+
+    def get_qp_matrices(self, velocity: float) -> tuple[np.ndarray, np.ndarray, float]:
+        """
+        Get the condensed QP ½UᵀHU + (Fx₀)ᵀU of the torques U over the horizon for the initial state x₀
+        :return: H of shape (horizon, horizon), F of shape (horizon, 4) and the largest eigenvalue of H
+        """
+        velocity = float(velocity)
+        if velocity not in self._qp_matrices:
+            n, N = 4, self.horizon
+            # exact discretization with a constant torque during every prediction step
+            augmented = np.zeros((n + 1, n + 1))
+            augmented[:n, :n] = linear_system.system_matrix(self.bicycle_model, velocity)
+            augmented[:n, n] = linear_system.input_matrix()[:, 1]
+            discrete = linear_system.expm(augmented * self.prediction_timestep)
+            Ad, Bd = discrete[:n, :n], discrete[:n, n]
+
+            # predicted states X = Φx₀ + ΓU of the steps 1 to N
+            Phi = np.empty((N, n, n))
+            Phi[0] = Ad
+            for k in range(1, N):
+                Phi[k] = Ad @ Phi[k - 1]
+            Gamma = np.zeros((N, n, N))
+            for k in range(N):
+                Gamma[k, :, k] = Bd
+                if k > 0:
+                    Gamma[k, :, :k] = Ad @ Gamma[k - 1, :, :k]
+
+            Q = np.diag(np.asarray(self.weights, dtype=float))
+            # the terminal weight replaces the weight of the last state, the sum of the stage costs of the states
+            # 0 to N - 1 and x_NᵀPx_N is the infinite-horizon cost (the constant x₀ᵀQx₀ does not change the QP)
+            weights = np.repeat(Q[None], N, axis=0)
+            weights[-1] = linear_system.solve_discrete_riccati(Ad, Bd[:, None], Q, np.array([[self.r]]))
+            H = 2 * (np.einsum('kin,kij,kjm->nm', Gamma, weights, Gamma) + self.r * np.eye(N))
+            F = 2 * np.einsum('kin,kij,kjl->nl', Gamma, weights, Phi)
+            H = (H + H.T) / 2
+            self._qp_matrices[velocity] = (H, F, float(np.linalg.eigvalsh(H)[-1]))
+        return self._qp_matrices[velocity]
+
+    def create_state(self, member_cnt: int = 1, velocities: np.ndarray | float | None = None,
+                     period: float | None = None) -> ControllerState:
+        if velocities is None:
+            raise ValueError(f'{self.get_name()} requires the velocities of the simulations')
+        # the previous solution is shifted by the prediction steps between two calls, one step if they are unknown
+        shift = 1 if period is None else round(period / self.prediction_timestep)
+        return {'velocity': np.broadcast_to(np.asarray(velocities, dtype=float), (member_cnt,)).copy(),
+                # previous solution of every simulation for the warm start
+                'solution': np.zeros((member_cnt, self.horizon)),
+                'shift': np.full(member_cnt, shift, dtype=int),
+                # latency of the solver in s and its number of iterations
+                'solve_count': np.zeros(member_cnt, dtype=int),
+                'solve_time': np.zeros(member_cnt),
+                'max_solve_time': np.zeros(member_cnt),
+                'iterations': np.zeros(member_cnt, dtype=int)}
+
+    def calculate_control(self, roll: float, steer: float, roll_rate: float, steer_rate: float,
+                          controller_state: ControllerState | None = None) -> BicycleControl:
+        control = self.calculate_control_batch(np.array([[roll, steer, roll_rate, steer_rate]]), controller_state)
+        return BicycleControl(0.0, float(control[0, 1]))
+
+    def calculate_control_batch(self, states: np.ndarray,
+                                controller_state: ControllerState | None = None,
+                                members: np.ndarray | None = None) -> np.ndarray:
+        if controller_state is None:
+            raise ValueError(f'{self.get_name()} requires a controller state with the velocity')
+        rows = np.arange(len(controller_state['velocity'])) if members is None else np.asarray(members)
+        matrices = [self.get_qp_matrices(velocity) for velocity in controller_state['velocity'][rows]]
+        # the latency excludes the one-time computation of the QP matrices
+        start = time.perf_counter()
+        H = np.stack([matrix[0] for matrix in matrices])
+        f = np.einsum('mnl,ml->mn', np.stack([matrix[1] for matrix in matrices]), states[:, 0:4])
+        lipschitz = np.array([matrix[2] for matrix in matrices])
+
+        # warm start with the previous solution shifted by the elapsed prediction steps, the last torque is repeated
+        steps = np.minimum(np.arange(self.horizon) + controller_state['shift'][rows, None], self.horizon - 1)
+        initial = np.take_along_axis(controller_state['solution'][rows], steps, axis=1)
+        # without a previous solution start with the unconstrained solution
+        cold = controller_state['solve_count'][rows] == 0
+        if np.any(cold):
+            initial[cold] = -np.linalg.solve(H[cold], f[cold][:, :, None])[:, :, 0]
+        solution, iterations = solve_box_qp(H, f, self.max_torque, initial, lipschitz,
+                                            self.tolerance, self.max_iterations)
+        controller_state['solution'][rows] = solution
+
+        elapsed = time.perf_counter() - start
+        controller_state['solve_count'][rows] += 1
+        controller_state['solve_time'][rows] += elapsed
+        controller_state['max_solve_time'][rows] = np.maximum(controller_state['max_solve_time'][rows], elapsed)
+        controller_state['iterations'][rows] += iterations
+
+        control = np.zeros((len(states), 2))
+        control[:, 1] = solution[:, 0]
+        return control
+
+    def get_statistics(self, controller_state: ControllerState) -> dict[str, str]:
+        count = max(1, int(np.sum(controller_state['solve_count'])))
+        return {'mpc_solves': str(int(np.sum(controller_state['solve_count']))),
+                'mpc_mean_solve_time': f"{np.sum(controller_state['solve_time']) / count * 1e6:.1f}us",
+                'mpc_max_solve_time': f"{np.max(controller_state['max_solve_time'], initial=0.0) * 1e6:.1f}us",
+                'mpc_mean_iterations': f"{np.sum(controller_state['iterations']) / count:.1f}"}
+
+    def get_parameters(self) -> dict[str, str]:
+        return {'max_torque': str(self.max_torque),
+                'horizon': str(self.horizon),
+                'prediction_timestep': str(self.prediction_timestep),
+                **{name: str(value) for name, value in zip(('q_roll', 'q_steer', 'q_roll_rate', 'q_steer_rate'),
+                                                           self.weights)},
+                'r': str(self.r),
+                'tolerance': str(self.tolerance),
+                'max_iterations': str(self.max_iterations),
+                'design_model': get_model_key(self.bicycle_model)}
+
+
+# controllers selectable by name, together with their default gains
+controller_types: dict[str, tuple[type[BicycleController], dict[str, float]]] = {
+    'none': (NoControlController, {}),
+    'roll': (RollFeedbackController, {'gain': 10.0}),
+    'rollrate': (RollRateFeedbackController, {'gain': 15.0}),
+    'pid': (RollPIDController, {'kp': 10, 'ki': 10, 'kd': 10}),
+    'pd': (RollPDController, {'kp': 10, 'kd': 10}),
+    'lqr': (GainScheduledLQRController, {'q_roll': 1.0, 'q_steer': 1.0, 'q_roll_rate': 1.0, 'q_steer_rate': 1.0,
+                                         'r': 1.0}),
+    'mpc': (MPCController, {'max_torque': 5.0, 'horizon': 50, 'q_roll': 1.0, 'q_steer': 1.0, 'q_roll_rate': 1.0,
+                            'q_steer_rate': 1.0, 'r': 0.01}),
+}
+
+
+def create_controller(name: str, bicycle_model: BicycleModel | None = None, **gains: float) -> BicycleController:
+    """
+    Create a controller by name
+    :param name: Name of the controller, see controller_types
+    :param bicycle_model: The simulated bicycle model, which model-based controllers like LQR are designed for
+    :param gains: Gains which replace the default gains of the controller
+    :return: The controller
+    """
+    if name not in controller_types:
+        raise ValueError(f'Unknown controller {name} specified')
+    controller_type, default_gains = controller_types[name]
+    unknown_gains = set(gains) - set(default_gains)
+    if unknown_gains:
+        raise ValueError(f'Controller {name} has no gains {", ".join(sorted(unknown_gains))}')
+    if controller_type.requires_model and bicycle_model is not None:
+        return controller_type(bicycle_model=bicycle_model, **{**default_gains, **gains})
+    return controller_type(**{**default_gains, **gains})
@@ -1,5 +1,29 @@
+from dataclasses import dataclass
+from functools import lru_cache
+
 import numpy as np
 
+
+def _stack_2x2(a, b, c, d) -> np.ndarray:
+    # works for floats as well as for arrays of equal shape, the matrix dimensions are the last ones
+    if np.ndim(a) == np.ndim(b) == np.ndim(c) == np.ndim(d) == 0:
+        return np.array([[a, b], [c, d]])
+    a, b, c, d = np.broadcast_arrays(a, b, c, d)
+    return np.stack([np.stack([a, b], axis=-1), np.stack([c, d], axis=-1)], axis=-2)
+
+
+@dataclass
+class StackedModelMatrices:
+    # parameters of all models as arrays of shape (N,)
+    parameters: dict[str, np.ndarray]
+    # matrices of all models of shape (N, 2, 2)
+    M: np.ndarray
+    C1: np.ndarray
+    K0: np.ndarray
+    K2: np.ndarray
+    M_inv: np.ndarray
+
+
 class BicycleModel:
     """
     Physical constants and matrices of the bicycle model.
@@ -10,6 +34,7 @@ class BicycleModel:
     C1: np.ndarray
     K0: np.ndarray
     K2: np.ndarray
+    M_inv: np.ndarray
     non_default_values: dict[str, float]
 
     default_parameters = {
@@ -42,12 +67,59 @@ class BicycleModel:
     }
 
     def __init__(self, **parameters):
+        """
+        Create a bicycle model. Use BicycleModel.create to reuse the model of an earlier equal configuration.
+        :param parameters: Parameters which replace the default parameters, see default_parameters
+        """
         # Update default values with provided parameters
         params = {**self.default_parameters, **parameters}
 
         # Compute non-default values
         self.non_default_values = {k: v for k, v in params.items() if v != self.default_parameters[k]}
 
+        self.M, self.C1, self.K0, self.K2 = self.compute_matrices(params)
+        # the inverse of the mass matrix is needed by every simulation, so compute it once per model
+        self.M_inv = np.linalg.inv(self.M)
+        # models are shared by the cache of create, so they must not be modified
+        for matrix in (self.M, self.C1, self.K0, self.K2, self.M_inv):
+            matrix.flags.writeable = False
+
+    @staticmethod
+    def create(**parameters) -> "BicycleModel":
+        """
+        Get the model for the given parameters. Models of equal parameters are computed only once and shared.
+        :param parameters: Parameters which replace the default parameters, see default_parameters
+        :return: The bicycle model
+        """
+        return _create_cached(tuple(sorted(parameters.items())))
+
+    @classmethod
+    def stacked_matrices(cls, **parameters) -> "StackedModelMatrices":
+        """
+        Compute the matrices of many models at once.
+        Any subset of the parameters can be given as arrays, which are broadcast against each other.
+        :param parameters: Parameters which replace the default parameters, as floats or arrays of shape (N,)
+        :return: The matrices of the N models, each of shape (N, 2, 2)
+        """
+        unknown_parameters = set(parameters) - set(cls.default_parameters)
+        if unknown_parameters:
+            raise ValueError(f'Unknown bicycle model parameters {", ".join(sorted(unknown_parameters))}')
+        params = {**cls.default_parameters,
+                  **{name: np.asarray(value, dtype=float) for name, value in parameters.items()}}
+        shape = np.broadcast_shapes((1,), *[np.shape(value) for value in params.values()])
+        params = {name: np.broadcast_to(value, shape) for name, value in params.items()}
+        M, C1, K0, K2 = cls.compute_matrices(params)
+        return StackedModelMatrices(params, M, C1, K0, K2, np.linalg.inv(M))
+
+    @staticmethod
+    def compute_matrices(params: dict) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Compute the matrices M, C1, K0 and K2 from a complete set of parameters
+        :param params: All parameters of default_parameters, either as floats or as arrays of equal shape
+        :return: M, C1, K0 and K2 of shape (2, 2) for floats or (..., 2, 2) for arrays
+        """
+        params = dict(params)
+
         # Compute total mass and center of mass coordinates
         mT = params['mR'] + params['mB'] + params['mH'] + params['mF']
         xT = (params['xB'] * params['mB'] + params['xH'] * params['mH'] + params['w'] * params['mF']) / mT
@@ -89,25 +161,26 @@ class BicycleModel:
         Mpd = IAlx + mu * ITxz
         Mdp = Mpd
         Mdd = IAll + 2 * mu * IAlz + mu**2 * ITzz
-        self.M = np.array([[Mpp, Mpd], [Mdp, Mdd]])
+        M = _stack_2x2(Mpp, Mpd, Mdp, Mdd)
 
         K0pp = mT * zT
         K0pd = -SA
         K0dp = K0pd
         K0dd = -SA * np.sin(params['lambda'])
-        self.K0 = np.array([[K0pp, K0pd], [K0dp, K0dd]])
+        K0 = _stack_2x2(K0pp, K0pd, K0dp, K0dd)
 
         K2pp = 0.0
         K2pd = (ST - mT * zT) / params['w'] * np.cos(params['lambda'])
         K2dp = 0.0
         K2dd = (SA + SF * np.sin(params['lambda'])) / params['w'] * np.cos(params['lambda'])
-        self.K2 = np.array([[K2pp, K2pd], [K2dp, K2dd]])
+        K2 = _stack_2x2(K2pp, K2pd, K2dp, K2dd)
 
         C1pp = 0.0
         C1pd = (mu * ST + SF * np.cos(params['lambda']) + ITxz / params['w'] * np.cos(params['lambda']) - mu * mT * zT)
         C1dp = -(mu * ST + SF * np.cos(params['lambda']))
         C1dd = (IAlz / params['w'] * np.cos(params['lambda']) + mu * (SA + ITzz / params['w'] * np.cos(params['lambda'])))
-        self.C1 = np.array([[C1pp, C1pd], [C1dp, C1dd]])
+        C1 = _stack_2x2(C1pp, C1pd, C1dp, C1dd)
+        return M, C1, K0, K2
 
     def is_default(self) -> bool:
         return len(self.non_default_values) == 0
@@ -116,4 +189,9 @@ class BicycleModel:
         return self.non_default_values
 
     def get_parameter(self, name: str) -> float:
-        return self.non_default_values[name] if name in self.non_default_values else self.default_parameters[name]
\ No newline at end of file
+        return self.non_default_values[name] if name in self.non_default_values else self.default_parameters[name]
+
+
+@lru_cache(maxsize=1024)
+def _create_cached(parameters: tuple[tuple[str, float], ...]) -> BicycleModel:
+    return BicycleModel(**dict(parameters))
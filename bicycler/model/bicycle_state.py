@@ -11,6 +11,7 @@ class BicycleState:
     steering_rate: float = 0.0
     steer_torque: float = 0.0
     heading: float = 0.0
+    roll_torque: float = 0.0
 
     def __init__(self,
                  lean_angle: float,
@@ -18,13 +19,15 @@ class BicycleState:
                  lean_rate: float,
                  steering_rate: float,
                  steer_torque: float,
-                 heading: float):
+                 heading: float,
+                 roll_torque: float = 0.0):
         self.lean_angle = lean_angle
         self.steering_angle = steering_angle
         self.lean_rate = lean_rate
         self.steering_rate = steering_rate
         self.steer_torque = steer_torque
         self.heading = heading
+        self.roll_torque = roll_torque
 
     def get_q(self) -> np.array:
         return np.array([self.lean_angle, self.steering_angle])
@@ -33,7 +36,7 @@ class BicycleState:
         return np.array([self.lean_rate, self.steering_rate])
 
     def get_f(self) -> np.array:
-        return np.array([0.0, self.steer_torque])
+        return np.array([self.roll_torque, self.steer_torque])
 
     def get_roll(self) -> float:
         return self.lean_angle
@@ -50,5 +53,8 @@ class BicycleState:
     def get_steer_torque(self) -> float:
         return self.steer_torque
 
+    def get_roll_torque(self) -> float:
+        return self.roll_torque
+
     def get_heading(self) -> float:
         return self.heading
@@ -0,0 +1,9 @@
+import os
+from pathlib import Path
+
+
+def get_cache_directory() -> Path:
+    """
+    Get the directory for cached data, which is $BICYCLER_CACHE_DIR or ~/.cache/bicycler
+    """
+    return Path(os.environ.get('BICYCLER_CACHE_DIR', Path.home() / '.cache' / 'bicycler'))
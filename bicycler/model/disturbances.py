@@ -0,0 +1,194 @@
+import math
+from abc import ABC, abstractmethod
+from collections.abc import Sequence
+
+import numpy as np
+
+# inputs which can be disturbed, in the order of the columns of generate_disturbances
+targets = ('roll', 'steer')
+
+
+def _format(value: float) -> str:
+    # shortest text which is parsed back to the same value
+    return repr(float(value))
+
+
+class Disturbance(ABC):
+    """
+    External torque on the roll or the steer axis, e.g. a lateral push, a gust or an uneven road.
+    Like the control input, the torque is added to the acceleration and held constant during every timestep.
+    """
+    target: str
+
+    def __init__(self, target: str):
+        if target not in targets:
+            raise ValueError(f'Unknown disturbance target "{target}". Use one of {", ".join(targets)}')
+        self.target = target
+
+    @abstractmethod
+    def generate(self, first_step: int, step_cnt: int, timestep: float, key: tuple[int, ...]) -> np.ndarray:
+        """
+        Generate the torques of a block of integration steps
+        :param first_step: Index of the first step, step i starts at the time i * timestep
+        :param step_cnt: Number of steps
+        :param timestep: Timestep of the simulation in s
+        :param key: Seed of the random values of this disturbance. Equal keys produce equal torques,
+                    no matter how the steps are split into blocks.
+        :return: Torques of shape (step_cnt,)
+        """
+        pass
+
+    @abstractmethod
+    def get_spec(self) -> str:
+        """
+        Get the description of the disturbance in the format of parse_disturbance
+        """
+        pass
+
+
+class Impulse(Disturbance):
+    """
+    Short push, which is applied as a constant torque during a single timestep
+    """
+    time: float
+    magnitude: float
+
+    def __init__(self, target: str, time: float, magnitude: float):
+        """
+        :param time: Time of the push in s
+        :param magnitude: Integral of the torque over time in Nms
+        """
+        super().__init__(target)
+        self.time = time
+        self.magnitude = magnitude
+
+    def generate(self, first_step: int, step_cnt: int, timestep: float, key: tuple[int, ...]) -> np.ndarray:
+        torques = np.zeros(step_cnt)
+        step = round(self.time / timestep) - first_step
+        if 0 <= step < step_cnt:
+            torques[step] = self.magnitude / timestep
+        return torques
+
+    def get_spec(self) -> str:
+        return f'impulse:{self.target}:{_format(self.time)}:{_format(self.magnitude)}'
+
+
+class Push(Disturbance):
+    """
+    Constant torque, which starts at a given time and lasts for a given duration or until the end
+    """
+    start: float
+    magnitude: float
+    duration: float
+
+    def __init__(self, target: str, start: float, magnitude: float, duration: float = math.inf):
+        """
+        :param start: Begin of the push in s
+        :param magnitude: Torque in Nm
+        :param duration: Length of the push in s
+        """
+        super().__init__(target)
+        self.start = start
+        self.magnitude = magnitude
+        self.duration = duration
+
+    def generate(self, first_step: int, step_cnt: int, timestep: float, key: tuple[int, ...]) -> np.ndarray:
+        times = (first_step + np.arange(step_cnt)) * timestep
+        return np.where((times >= self.start) & (times < self.start + self.duration), self.magnitude, 0.0)
+
+    def get_spec(self) -> str:
+        spec = f'step:{self.target}:{_format(self.start)}:{_format(self.magnitude)}'
+        if math.isfinite(self.duration):
+            spec += f':{_format(self.duration)}'
+        return spec
+
+
+class BandLimitedNoise(Disturbance):
+    """
+    Approximately band-limited random torque, e.g. a gusty side wind. Normally distributed values are drawn at
+    twice the bandwidth and linearly interpolated in between, which attenuates but does not remove the content
+    above the bandwidth.
+    The values are drawn in blocks, block i from a generator seeded with the key and i, so the noise
+    is reproducible and any range of steps is generated without drawing the values before it.
+    """
+    # number of random values which are drawn at once
+    block_size = 4096
+
+    std: float
+    bandwidth: float
+
+    def __init__(self, target: str, std: float, bandwidth: float):
+        """
+        :param std: Standard deviation of the drawn torques in Nm
+        :param bandwidth: Approximate highest frequency of the noise in Hz
+        """
+        super().__init__(target)
+        if bandwidth <= 0:
+            raise ValueError('The bandwidth of the noise must be positive')
+        self.std = std
+        self.bandwidth = bandwidth
+
+    def _draw(self, begin: int, end: int, key: tuple[int, ...]) -> np.ndarray:
+        # the random values with the indices begin to end (exclusive)
+        first_block = begin // self.block_size
+        blocks = [np.random.default_rng(key + (block,)).normal(0.0, self.std, self.block_size)
+                  for block in range(first_block, (end - 1) // self.block_size + 1)]
+        offset = begin - first_block * self.block_size
+        return np.concatenate(blocks)[offset:offset + end - begin]
+
+    def generate(self, first_step: int, step_cnt: int, timestep: float, key: tuple[int, ...]) -> np.ndarray:
+        if step_cnt == 0:
+            return np.zeros(0)
+        # time of the steps in units of the interval between two random values
+        positions = (first_step + np.arange(step_cnt)) * (timestep * 2 * self.bandwidth)
+        begin = int(positions[0])
+        values = self._draw(begin, int(positions[-1]) + 2, key)
+        return np.interp(positions - begin, np.arange(len(values)), values)
+
+    def get_spec(self) -> str:
+        return f'noise:{self.target}:{_format(self.std)}:{_format(self.bandwidth)}'
+
+
+# disturbance type of every spec prefix
+disturbance_types = {
+    'impulse': Impulse,
+    'step': Push,
+    'noise': BandLimitedNoise,
+}
+
+
+def parse_disturbance(spec: str) -> Disturbance:
+    """
+    Create a disturbance from a description like impulse:roll:1.5:20 (time in s and Nms),
+    step:steer:2:0.5[:1] (start in s, torque in Nm, optional duration in s) or noise:roll:5:2 (std in Nm,
+    bandwidth in Hz)
+    :param spec: The description, see Disturbance.get_spec
+    :return: The disturbance
+    """
+    kind, *fields = spec.split(':')
+    if kind not in disturbance_types or len(fields) < 3:
+        raise ValueError(f'Invalid disturbance "{spec}". Use impulse:TARGET:TIME:MAGNITUDE, '
+                         f'step:TARGET:START:MAGNITUDE[:DURATION] or noise:TARGET:STD:BANDWIDTH')
+    target, *values = fields
+    try:
+        return disturbance_types[kind](target, *map(float, values))
+    except TypeError:
+        raise ValueError(f'Invalid number of values in disturbance "{spec}"') from None
+
+
+def generate_disturbances(disturbances: Sequence[Disturbance], seed: int, first_step: int, step_cnt: int,
+                          timestep: float) -> np.ndarray:
+    """
+    Generate the total disturbance torques of a block of integration steps
+    :param disturbances: The disturbances of the simulation
+    :param seed: Seed of the random disturbances
+    :param first_step: Index of the first step
+    :param step_cnt: Number of steps
+    :param timestep: Timestep of the simulation in s
+    :return: Torques of shape (step_cnt, 2) as roll_torque, steer_torque
+    """
+    torques = np.zeros((step_cnt, len(targets)))
+    for index, disturbance in enumerate(disturbances):
+        column = targets.index(disturbance.target)
+        torques[:, column] += disturbance.generate(first_step, step_cnt, timestep, (seed, index))
+    return torques
@@ -0,0 +1,140 @@
+from abc import ABC, abstractmethod
+from typing import Callable
+
+import numpy as np
+
+# the derivative of the state vector [roll, steer, roll_rate, steer_rate, heading]
+Derivative = Callable[[np.ndarray], np.ndarray]
+
+
+class Integrator(ABC):
+    """
+    Advances the state vector [roll, steer, roll_rate, steer_rate, heading] by one timestep.
+    The control input is held constant during the step, so the derivative only depends on the state.
+    """
+    evaluations: int
+
+    def __init__(self):
+        # number of derivative evaluations, to compare the cost of the integrators
+        self.evaluations = 0
+
+    def _evaluate(self, derivative: Derivative, y: np.ndarray) -> np.ndarray:
+        self.evaluations += 1
+        return derivative(y)
+
+    @abstractmethod
+    def step(self, derivative: Derivative, y: np.ndarray, timestep: float) -> np.ndarray:
+        """
+        Advance the state by one timestep
+        :param derivative: Function computing the derivative of the state
+        :param y: The current state
+        :param timestep: The timestep in s
+        :return: The state after the timestep
+        """
+        pass
+
+    def get_name(self) -> str:
+        return self.__class__.__name__
+
+
+class RK4Integrator(Integrator):
+    """
+    Classic fourth-order Runge-Kutta method
+    """
+    def step(self, derivative: Derivative, y: np.ndarray, timestep: float) -> np.ndarray:
+        k1 = self._evaluate(derivative, y)
+        k2 = self._evaluate(derivative, y + timestep / 2 * k1)
+        k3 = self._evaluate(derivative, y + timestep / 2 * k2)
+        k4 = self._evaluate(derivative, y + timestep * k3)
+        return y + timestep / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+
+
+class SymplecticEulerIntegrator(Integrator):
+    """
+    Semi-implicit Euler method. The rates are updated first and the angles are advanced with the new rates,
+    which avoids the energy drift of the explicit Euler method for oscillating modes.
+    """
+    def step(self, derivative: Derivative, y: np.ndarray, timestep: float) -> np.ndarray:
+        y_next = y.copy()
+        y_next[2:4] = y[2:4] + timestep * self._evaluate(derivative, y)[2:4]
+        # the angles and the heading only depend on the rates, so use the updated ones
+        rates = self._evaluate(derivative, np.concatenate((y[0:2], y_next[2:4], y[4:5])))
+        y_next[0:2] = y[0:2] + timestep * rates[0:2]
+        y_next[4] = y[4] + timestep * rates[4]
+        return y_next
+
+
+class DormandPrinceIntegrator(Integrator):
+    """
+    Adaptive Runge-Kutta method of order 5(4) by Dormand and Prince.
+    Every timestep is divided into as many internal steps as the error control requires,
+    so the output is still written on the grid of the requested timestep.
+    """
+    # Butcher tableau of the Dormand-Prince method
+    a = [np.array([]),
+         np.array([1 / 5]),
+         np.array([3 / 40, 9 / 40]),
+         np.array([44 / 45, -56 / 15, 32 / 9]),
+         np.array([19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729]),
+         np.array([9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656]),
+         np.array([35 / 384, 0.0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84])]
+    # weights of the fifth order solution and of the embedded fourth order error estimate
+    b = np.array([35 / 384, 0.0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84, 0.0])
+    b_error = b - np.array([5179 / 57600, 0.0, 7571 / 16695, 393 / 640, -92097 / 339200, 187 / 2100, 1 / 40])
+
+    # limits for changing the internal step size
+    safety = 0.9
+    min_factor = 0.2
+    max_factor = 10.0
+
+    def __init__(self, rtol: float = 1e-6, atol: float = 1e-9):
+        super().__init__()
+        self.rtol = rtol
+        self.atol = atol
+        # the internal step size is kept between timesteps
+        self.internal_step = None
+
+    def step(self, derivative: Derivative, y: np.ndarray, timestep: float) -> np.ndarray:
+        t = 0.0
+        h = timestep if self.internal_step is None else self.internal_step
+        k_first = self._evaluate(derivative, y)
+        while t < timestep:
+            # do not step over the end of the timestep
+            last_step = h >= timestep - t
+            h_step = timestep - t if last_step else h
+
+            k = np.empty((7, y.shape[0]))
+            k[0] = k_first
+            for stage in range(1, 7):
+                k[stage] = self._evaluate(derivative, y + h_step * (self.a[stage] @ k[:stage]))
+            y_new = y + h_step * (self.b @ k)
+
+            # estimate the local error with the embedded fourth order solution
+            scale = self.atol + self.rtol * np.maximum(np.abs(y), np.abs(y_new))
+            error = np.sqrt(np.mean((h_step * (self.b_error @ k) / scale) ** 2))
+            factor = self.max_factor if error == 0.0 else self.safety * error ** -0.2
+            factor = min(self.max_factor, max(self.min_factor, factor))
+            if error <= 1.0:
+                t = timestep if last_step else t + h_step
+                y = y_new
+                # the last stage is evaluated at the new state, so it is the first stage of the next step
+                k_first = k[6]
+                # a step shortened to end on the timestep does not limit the following steps
+                h = max(h, h_step * factor) if last_step else h_step * factor
+            else:
+                h = h_step * factor
+        self.internal_step = h
+        return y
+
+
+integrators = {
+    'rk4': RK4Integrator,
+    'symplectic': SymplecticEulerIntegrator,
+    'rk45': DormandPrinceIntegrator,
+}
+
+
+def create_integrator(name: str) -> Integrator:
+    if name not in integrators:
+        raise ValueError(f'Unknown integrator "{name}". Use one of {", ".join(integrators)}')
+    return integrators[name]()
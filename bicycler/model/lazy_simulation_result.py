@@ -0,0 +1,131 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from model.bicycle_state import BicycleState
+from model.simulation import Simulation, SimulationCheckpoint
+from visualization.animation import BikeAnimation
+
+
+class LazySimulationResult(BikeAnimation):
+    """
+    Simulation result with random access to its states, which only keeps a checkpoint of the complete simulation
+    state every checkpoint_interval states. When a state is requested, its block of states is recomputed from the
+    preceding checkpoint, so memory is O(steps / checkpoint_interval) instead of O(steps). The recently
+    requested blocks are kept in a small LRU cache, so playing, stepping and scrubbing back and forth only
+    recompute a block when it is entered.
+    The exact engine needs no checkpoints, because the transition matrix reaches any state with O(log n)
+    matrix products.
+    """
+    simulation: Simulation
+    checkpoint_interval: int
+    cache_size: int
+    # checkpoint i is at the last state of block i
+    checkpoints: list[SimulationCheckpoint]
+    blocks: OrderedDict[int, np.ndarray]
+    # index of the state in which the bicycle has fallen over and that state, None if it stays upright
+    fall_row: int | None = None
+    fallen_state: np.ndarray | None = None
+
+    def __init__(self, simulation: Simulation, checkpoint_interval: int = 1024, cache_size: int = 8):
+        """
+        Run the simulation once to record the checkpoints
+        :param simulation: The simulation, it must not have been run yet
+        :param checkpoint_interval: Number of states between two checkpoints, which is also the number of states
+                                    that are recomputed at once
+        :param cache_size: Number of recomputed blocks which are kept
+        """
+        if checkpoint_interval < 1:
+            raise ValueError('The checkpoint interval must be positive')
+        self.simulation = simulation
+        self.checkpoint_interval = checkpoint_interval
+        self.cache_size = cache_size
+        self.checkpoints = []
+        self.blocks = OrderedDict()
+
+        exact = simulation.get_engine() == 'exact'
+        simulation.record_checkpoints = not exact
+        row_cnt = 0
+        for chunk in simulation.iter_chunks(checkpoint_interval, stop_at_fall=True):
+            row_cnt += len(chunk)
+            # the engines do not record a checkpoint at a fall
+            if not exact and simulation.checkpoint is not None and simulation.checkpoint.row_index == row_cnt - 1:
+                self.checkpoints.append(simulation.checkpoint)
+        simulation.record_checkpoints = False
+        simulation.checkpoint = None
+        if row_cnt < self.get_duration():
+            # the states after a fall are all equal to the state in which the bicycle has fallen over
+            self.fall_row = row_cnt - 1
+            self.fallen_state = chunk[-1].copy()
+        self.metadata = simulation.get_metadata()
+
+    def _compute_block(self, block: int) -> np.ndarray:
+        start = block * self.checkpoint_interval
+        if block == 0:
+            checkpoint = None
+        elif self.simulation.get_engine() == 'exact':
+            checkpoint = self.simulation.get_exact_checkpoint(start - 1)
+        else:
+            checkpoint = self.checkpoints[block - 1]
+        # the block ends at the fall, all later states are equal
+        chunk = next(self.simulation.iter_chunks(self.checkpoint_interval, stop_at_fall=True, checkpoint=checkpoint))
+        if self.fall_row is not None and start <= self.fall_row < start + len(chunk):
+            chunk = chunk[:self.fall_row - start + 1]
+            chunk[-1] = self.fallen_state
+        return chunk
+
+    def _get_block(self, block: int) -> np.ndarray:
+        if block in self.blocks:
+            self.blocks.move_to_end(block)
+            return self.blocks[block]
+        data = self._compute_block(block)
+        self.blocks[block] = data
+        if len(self.blocks) > self.cache_size:
+            self.blocks.popitem(last=False)
+        return data
+
+    def get_row(self, frame: int) -> np.ndarray:
+        """
+        Get a single state in the layout of SimulationResult
+        :param frame: Index of the state
+        :return: The state of shape (6,)
+        """
+        if not 0 <= frame < self.get_duration():
+            raise IndexError(f'State {frame} is not in the result with {self.get_duration()} states')
+        if self.fall_row is not None and frame >= self.fall_row:
+            return self.fallen_state
+        block, offset = divmod(frame, self.checkpoint_interval)
+        return self._get_block(block)[offset]
+
+    def get_data_array(self) -> np.ndarray:
+        """
+        Compute all states at once, which needs as much memory as a SimulationResult
+        """
+        data = np.empty((self.get_duration(), 6))
+        row_cnt = self.get_duration() if self.fall_row is None else self.fall_row
+        for block in range(0, -(-row_cnt // self.checkpoint_interval)):
+            start = block * self.checkpoint_interval
+            chunk = self._compute_block(block)
+            data[start:start + len(chunk)] = chunk
+        if self.fall_row is not None:
+            data[self.fall_row:] = self.fallen_state
+        return data
+
+    def get_state_at_frame(self, frame) -> BicycleState:
+        dataframe = self.get_row(frame)
+        return BicycleState(dataframe[0], dataframe[1], dataframe[2], dataframe[3], dataframe[4], dataframe[5])
+
+    def get_timestep(self) -> float:
+        return self.simulation.parameters.get_output_timestep()
+
+    def get_frame_delay_ms(self) -> int:
+        return round(self.get_frame_time_ms())
+
+    def get_frame_time_ms(self) -> float:
+        return self.get_timestep() * 1000
+
+    def get_duration(self) -> int:
+        return self.simulation.parameters.get_output_count()
+
+    def get_metadata(self) -> dict[str, str]:
+        return self.metadata
@@ -0,0 +1,140 @@
+import copy
+
+import numpy as np
+
+from model.bicycle_state import BicycleState
+from model.result_cache import run_cached
+from model.simulation_parameters import SimulationParameters
+from model.simulation_summary import FALL_THRESHOLD, summarize_columns
+
+# the basis is simulated from initial states of this size, so it never reaches the fall threshold.
+# scaling by a power of two is exact, so the rescaled basis equals a simulation from a unit state.
+basis_scale = 2.0 ** -600
+# number of states, after which the ensemble is checked for bicycles which have fallen over
+fall_check_interval = 32
+
+
+class LinearEnsemble:
+    """
+    Trajectories of many initial states of the same linear closed-loop system by superposition.
+    With a linear controller the response is linear in the initial state, so the four responses to the unit
+    initial states of roll, steer, roll_rate and steer_rate are simulated once and the trajectory of any initial
+    state is their linear combination. The trajectories of a whole ensemble are a single matrix product
+    and the fall detection is applied afterwards.
+    Sampled control and measurement delay keep the system linear, disturbances do not.
+    """
+    parameters: SimulationParameters
+    # responses to the unit initial states of shape (4, T, 6) in the layout of SimulationResult
+    basis: np.ndarray
+    timestep: float
+
+    def __init__(self, parameters: SimulationParameters):
+        """
+        :param parameters: Parameters of the simulation, the initial state is ignored
+        """
+        if parameters.controller.get_linear_gains() is None:
+            raise ValueError(f'The superposition of trajectories requires a linear controller, '
+                             f'{parameters.controller.get_name()} is not linear')
+        if parameters.disturbances:
+            raise ValueError('The superposition of trajectories does not support disturbances')
+        self.parameters = parameters
+
+        responses = []
+        for axis in range(4):
+            initial_state = np.zeros(6)
+            initial_state[axis] = basis_scale
+            basis_parameters = copy.copy(parameters)
+            basis_parameters.initial_state = BicycleState(*initial_state)
+            # equal parameters share the simulated basis within the process
+            result = run_cached(basis_parameters)
+            responses.append(result.get_data_array() / basis_scale)
+        self.basis = np.stack(responses)
+        # the columns of the basis of shape (6, 4, T), to compute single columns of the trajectories
+        self.column_basis = np.ascontiguousarray(self.basis.transpose(2, 0, 1))
+        self.timestep = result.get_timestep()
+
+    def get_row_count(self) -> int:
+        return self.basis.shape[1]
+
+    def _combine(self, initial_states: np.ndarray) -> np.ndarray:
+        # trajectories without fall detection of shape (N, T, 6)
+        data = (initial_states[:, :4] @ self.basis.reshape(4, -1)).reshape(len(initial_states), -1, 6)
+        if initial_states.shape[1] == 6:
+            # the heading does not act on the other states, so the initial heading is a constant offset
+            data[:, :, 5] += initial_states[:, 5:6]
+        return data
+
+    def _find_ends(self, coefficients: np.ndarray) -> np.ndarray:
+        # number of states up to the end of the interval, in which each bicycle falls over.
+        # the bicycles are advanced interval by interval and the ones, which have fallen over, are dropped.
+        row_cnt = self.get_row_count()
+        ends = np.full(len(coefficients), row_cnt)
+        active = np.arange(len(coefficients))
+        for start in range(0, row_cnt, fall_check_interval):
+            stop = min(start + fall_check_interval, row_cnt)
+            roll, steer = (coefficients[active] @ self.column_basis[column, :, start:stop] for column in (0, 1))
+            fallen = np.any((np.abs(roll) > FALL_THRESHOLD) | (np.abs(steer) > FALL_THRESHOLD), axis=1)
+            ends[active[fallen]] = stop
+            active = active[~fallen]
+            if not len(active):
+                break
+        return ends
+
+    def _summarize_block(self, initial_states: np.ndarray) -> dict[str, np.ndarray]:
+        coefficients = initial_states[:, :4]
+        ends = self._find_ends(coefficients)
+        metrics = {}
+        last = np.empty(len(coefficients), dtype=int)
+        # bicycles, which fall over in the same interval, are summarized together up to the end of the interval.
+        # only the columns which enter the summary are computed, each one with a single matrix product.
+        for end in np.unique(ends):
+            members = np.flatnonzero(ends == end)
+            roll, steer, steer_torque = (coefficients[members] @ self.column_basis[column, :, :end]
+                                         for column in (0, 1, 4))
+            group_metrics, last[members] = summarize_columns(roll, steer, steer_torque, self.timestep)
+            for name, values in group_metrics.items():
+                metrics.setdefault(name, np.empty(len(coefficients)))[members] = values
+        # the heading is only needed at the last state
+        final_heading = np.einsum('ij,ji->i', coefficients, self.column_basis[5][:, last])
+        if initial_states.shape[1] == 6:
+            final_heading += initial_states[:, 5]
+        metrics['final_heading'] = final_heading
+        return metrics
+
+    @staticmethod
+    def _validate(initial_states: np.ndarray) -> np.ndarray:
+        initial_states = np.atleast_2d(np.asarray(initial_states, dtype=float))
+        if initial_states.ndim != 2 or initial_states.shape[1] not in (4, 6):
+            raise ValueError(f"Initial states must be of shape (N, 4) or (N, 6), got {initial_states.shape}")
+        return initial_states
+
+    def trajectories(self, initial_states: np.ndarray) -> np.ndarray:
+        """
+        Compute the trajectories of an ensemble of initial states
+        :param initial_states: Initial states of shape (N, 4) as roll, steer, roll_rate, steer_rate
+                               or of shape (N, 6) in the layout of SimulationResult
+        :return: Trajectories of shape (N, T, 6), which are frozen after a fall like in Simulation.run
+        """
+        initial_states = self._validate(initial_states)
+        data = self._combine(initial_states)
+        beyond = np.any(np.abs(data[:, :, 0:2]) > np.pi / 2, axis=2)
+        last = np.where(np.any(beyond, axis=1), np.argmax(beyond, axis=1), data.shape[1] - 1)
+        # repeat the state in which the bicycle has fallen over until the end
+        rows = np.minimum(np.arange(data.shape[1]), last[:, np.newaxis])
+        return np.take_along_axis(data, rows[:, :, np.newaxis], axis=1)
+
+    def summarize(self, initial_states: np.ndarray, block_size: int | None = None) -> dict[str, np.ndarray]:
+        """
+        Compute the summary metrics of an ensemble of initial states, e.g. for a map of the basin of stability.
+        The trajectories are computed in blocks, so memory does not depend on the size of the ensemble.
+        :param initial_states: Initial states of shape (N, 4) or (N, 6), see trajectories
+        :param block_size: Number of trajectories which are computed at once
+        :return: One array of shape (N,) for every field of SimulationSummary
+        """
+        initial_states = self._validate(initial_states)
+        if block_size is None:
+            # limit the columns of a block to about 8 MB
+            block_size = max(1, (1 << 20) // self.get_row_count())
+        blocks = [self._summarize_block(initial_states[start:start + block_size])
+                  for start in range(0, len(initial_states), block_size)]
+        return {name: np.concatenate([block[name] for block in blocks]) for name in blocks[0]}
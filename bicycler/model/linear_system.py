@@ -0,0 +1,221 @@
+from functools import lru_cache
+
+import numpy as np
+
+from model.bicycle_model import BicycleModel
+
+# coefficients of the [13/13] Padé approximant of the matrix exponential
+# see Higham, "The scaling and squaring method for the matrix exponential revisited" (2005)
+_PADE_13_COEFFICIENTS = (64764752532480000., 32382376266240000., 7771770303897600., 1187353796428800.,
+                         129060195264000., 10559470521600., 670442572800., 33522128640., 1323241920., 40840800.,
+                         960960., 16380., 182., 1.)
+_PADE_13_THETA = 5.371920351148152
+
+
+def expm(A: np.ndarray) -> np.ndarray:
+    """
+    Compute the matrix exponential using scaling and squaring with a [13/13] Padé approximant.
+    :param A: Square matrix or stack of square matrices of shape (..., n, n)
+    :return: The matrix exponential of every matrix in A
+    """
+    A = np.asarray(A, dtype=float)
+    b = _PADE_13_COEFFICIENTS
+    identity = np.broadcast_to(np.eye(A.shape[-1]), A.shape)
+
+    # scale the matrices, such that the approximant is accurate to double precision
+    norm = np.max(np.abs(A).sum(axis=-2), axis=-1)
+    max_norm = np.max(norm) if norm.size else 0.0
+    squarings = max(0, int(np.ceil(np.log2(max_norm / _PADE_13_THETA)))) if max_norm > 0 else 0
+    A = A / 2 ** squarings
+
+    A2 = A @ A
+    A4 = A2 @ A2
+    A6 = A4 @ A2
+    U = A @ (A6 @ (b[13] * A6 + b[11] * A4 + b[9] * A2) + b[7] * A6 + b[5] * A4 + b[3] * A2 + b[1] * identity)
+    V = A6 @ (b[12] * A6 + b[10] * A4 + b[8] * A2) + b[6] * A6 + b[4] * A4 + b[2] * A2 + b[0] * identity
+    result = np.linalg.solve(V - U, V + U)
+
+    # undo the scaling by repeated squaring
+    for _ in range(squarings):
+        result = result @ result
+    return result
+
+
+def system_matrix(bicycle_model: BicycleModel, velocity: float) -> np.ndarray:
+    """
+    First-order form of equation 5.3 for the state [roll, steer, roll_rate, steer_rate]
+    :return: The 4x4 matrix A = [[0, I], [-M⁻¹(gK0 + v²K2), -vM⁻¹C1]]
+    """
+    M_inv = bicycle_model.M_inv
+    g = bicycle_model.get_parameter('g')
+    A = np.zeros((4, 4))
+    A[0:2, 2:4] = np.eye(2)
+    A[2:4, 0:2] = -M_inv @ (g * bicycle_model.K0 + velocity ** 2 * bicycle_model.K2)
+    A[2:4, 2:4] = -M_inv @ (velocity * bicycle_model.C1)
+    return A
+
+
+def stacked_system_matrices(bicycle_model: BicycleModel,
+                            velocities: np.ndarray,
+                            gains: np.ndarray | None = None) -> np.ndarray:
+    """
+    Build the first-order system matrices for many velocities at once
+    :param bicycle_model: The bicycle model
+    :param velocities: Velocities of shape (N,)
+    :param gains: Optional linear state feedback of shape (2, 4), see BicycleController.get_linear_gains
+    :return: Stacked system matrices of shape (N, 4, 4)
+    """
+    velocities = np.asarray(velocities, dtype=float)
+    M_inv = bicycle_model.M_inv
+    g = bicycle_model.get_parameter('g')
+    v = velocities[:, None, None]
+
+    A = np.zeros((len(velocities), 4, 4))
+    A[:, 0:2, 2:4] = np.eye(2)
+    A[:, 2:4, 0:2] = -M_inv @ (g * bicycle_model.K0 + v ** 2 * bicycle_model.K2)
+    A[:, 2:4, 2:4] = -M_inv @ (v * bicycle_model.C1)
+    if gains is not None:
+        A += input_matrix() @ gains
+    return A
+
+
+def input_matrix() -> np.ndarray:
+    """
+    Maps the control torques [roll_torque, steer_torque] onto the derivative of the state.
+    Like in Simulation.run, the torques are added to the accelerations of roll and steer.
+    :return: The 4x2 input matrix B
+    """
+    B = np.zeros((4, 2))
+    B[2:4, :] = np.eye(2)
+    return B
+
+
+def heading_rate_coefficients(bicycle_model: BicycleModel, velocity: float) -> np.ndarray:
+    """
+    Coefficients of the heading rate with respect to the state [roll, steer, roll_rate, steer_rate]
+    based on equation (B6) from Appendix B
+    """
+    wheelbase = bicycle_model.get_parameter('w')
+    trail = bicycle_model.get_parameter('c')
+    bike_lambda = bicycle_model.get_parameter('lambda')
+    return np.array([0.0, velocity * np.cos(bike_lambda) / wheelbase, 0.0, trail / wheelbase])
+
+
+def closed_loop_matrix(bicycle_model: BicycleModel, velocity: float, gains: np.ndarray) -> np.ndarray:
+    """
+    System matrix of the bicycle under linear state feedback
+    :param gains: Gain matrix K of shape (2, 4) with [roll_torque, steer_torque] = K @ state
+    :return: The 4x4 matrix A + BK
+    """
+    return system_matrix(bicycle_model, velocity) + input_matrix() @ gains
+
+
+def augmented_closed_loop_matrix(bicycle_model: BicycleModel, velocity: float, gains: np.ndarray) -> np.ndarray:
+    """
+    Closed-loop system matrix for the state extended by the heading [roll, steer, roll_rate, steer_rate, heading]
+    :return: The 5x5 closed-loop system matrix
+    """
+    A = np.zeros((5, 5))
+    A[0:4, 0:4] = closed_loop_matrix(bicycle_model, velocity, gains)
+    A[4, 0:4] = heading_rate_coefficients(bicycle_model, velocity)
+    return A
+
+
+@lru_cache(maxsize=128)
+def _cached_expm(matrix_bytes: bytes, size: int, timestep: float) -> np.ndarray:
+    A = np.frombuffer(matrix_bytes).reshape(size, size)
+    transition = expm(A * timestep)
+    transition.flags.writeable = False
+    return transition
+
+
+def transition_matrix(A: np.ndarray, timestep: float) -> np.ndarray:
+    """
+    Get the state transition matrix expm(A·dt) of a linear system.
+    The result is cached, so repeated simulations of the same configuration do not recompute it.
+    :param A: Square system matrix
+    :param timestep: Timestep dt in s
+    :return: The read-only transition matrix
+    """
+    A = np.ascontiguousarray(A, dtype=float)
+    return _cached_expm(A.tobytes(), A.shape[0], float(timestep))
+
+
+def solve_continuous_riccati(A: np.ndarray, B: np.ndarray, Q: np.ndarray, R: np.ndarray) -> np.ndarray:
+    """
+    Solve the continuous algebraic Riccati equation AᵀP + PA - PBR⁻¹BᵀP + Q = 0 for the stabilizing solution.
+    The solution is computed from the stable invariant subspace of the Hamiltonian matrix
+    H = [[A, -BR⁻¹Bᵀ], [-Q, -Aᵀ]], which is spanned by the eigenvectors of its n eigenvalues
+    with a negative real part.
+    :param A: System matrix of shape (..., n, n)
+    :param B: Input matrix of shape (..., n, m)
+    :param Q: Positive semi-definite state weights of shape (n, n)
+    :param R: Positive definite input weights of shape (m, m)
+    :return: The symmetric solution P of shape (..., n, n)
+    """
+    A = np.asarray(A, dtype=float)
+    n = A.shape[-1]
+    B = np.broadcast_to(B, A.shape[:-2] + np.shape(B)[-2:])
+    S = B @ np.linalg.solve(R, np.swapaxes(B, -1, -2))
+    H = np.empty(A.shape[:-2] + (2 * n, 2 * n))
+    H[..., :n, :n] = A
+    H[..., :n, n:] = -S
+    H[..., n:, :n] = -np.asarray(Q, dtype=float)
+    H[..., n:, n:] = -np.swapaxes(A, -1, -2)
+
+    values, vectors = np.linalg.eig(H)
+    # the eigenvalues of H are symmetric to the imaginary axis, the stable half belongs to the solution
+    order = np.argsort(values.real, axis=-1)[..., :n]
+    stable = np.take_along_axis(vectors, order[..., None, :], axis=-1)
+    U1 = stable[..., :n, :]
+    U2 = stable[..., n:, :]
+    P = np.linalg.solve(np.swapaxes(U1, -1, -2), np.swapaxes(U2, -1, -2)).real
+    P = np.swapaxes(P, -1, -2)
+    return (P + np.swapaxes(P, -1, -2)) / 2
+
+
+def solve_discrete_riccati(A: np.ndarray, B: np.ndarray, Q: np.ndarray, R: np.ndarray) -> np.ndarray:
+    """
+    Solve the discrete algebraic Riccati equation P = AᵀPA - AᵀPB(R + BᵀPB)⁻¹BᵀPA + Q for the stabilizing
+    solution. Like solve_continuous_riccati, the solution is computed from the stable invariant subspace of the
+    symplectic matrix Z = [[A + SA⁻ᵀQ, -SA⁻ᵀ], [-A⁻ᵀQ, A⁻ᵀ]] with S = BR⁻¹Bᵀ, which is spanned by the eigenvectors
+    of its n eigenvalues inside the unit circle. A must be invertible, e.g. the transition matrix of a timestep.
+    :param A: System matrix of shape (n, n)
+    :param B: Input matrix of shape (n, m)
+    :param Q: Positive semi-definite state weights of shape (n, n)
+    :param R: Positive definite input weights of shape (m, m)
+    :return: The symmetric solution P of shape (n, n)
+    """
+    A = np.asarray(A, dtype=float)
+    Q = np.asarray(Q, dtype=float)
+    n = A.shape[0]
+    S = B @ np.linalg.solve(R, B.T)
+    A_inv_t = np.linalg.inv(A).T
+    Z = np.block([[A + S @ A_inv_t @ Q, -S @ A_inv_t],
+                  [-A_inv_t @ Q, A_inv_t]])
+
+    values, vectors = np.linalg.eig(Z)
+    # the eigenvalues of Z come in pairs λ, 1/λ, the ones inside the unit circle belong to the solution
+    stable = vectors[:, np.argsort(np.abs(values))[:n]]
+    P = np.linalg.solve(stable[:n].T, stable[n:].T).T.real
+    return (P + P.T) / 2
+
+
+def lqr_gains(bicycle_model: BicycleModel,
+              velocities: np.ndarray,
+              state_weights: np.ndarray,
+              input_weight: float) -> np.ndarray:
+    """
+    Compute the gains of the linear-quadratic regulator with the steer torque as input for many velocities
+    :param bicycle_model: The bicycle model
+    :param velocities: Velocities of shape (N,)
+    :param state_weights: Weights of roll, steer, roll_rate and steer_rate in the cost function
+    :param input_weight: Weight of the steer torque in the cost function
+    :return: Gains of shape (N, 4) with steer_torque = gains @ [roll, steer, roll_rate, steer_rate]
+    """
+    A = stacked_system_matrices(bicycle_model, np.atleast_1d(velocities))
+    B = input_matrix()[:, 1:2]
+    R = np.array([[float(input_weight)]])
+    P = solve_continuous_riccati(A, B, np.diag(np.asarray(state_weights, dtype=float)), R)
+    # u = -R⁻¹BᵀPx, in the sign convention of BicycleController.get_linear_gains
+    return -(np.linalg.solve(R, B.T) @ P)[:, 0, :]
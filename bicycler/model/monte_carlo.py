@@ -0,0 +1,495 @@
+import json
+import math
+import os
+from abc import ABC, abstractmethod
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from statistics import NormalDist
+
+import numpy as np
+
+from model.batch_simulation import BatchSimulation
+from model.bicycle_controller import create_controller
+from model.bicycle_model import BicycleModel
+from model.simulation_summary import summarize_trajectories
+from model.sweep import metric_names
+
+# variables which are drawn besides the model parameters, angles in degree and rates in degree per second
+state_variables = ('velocity', 'roll', 'steer', 'roll_rate', 'steer_rate')
+# every drawn variable has its own random stream, so adding a distribution does not change the others
+variable_names = state_variables + tuple(BicycleModel.default_parameters)
+
+
+def _format(value: float) -> str:
+    # shortest text which is parsed back to the same value
+    return repr(float(value))
+
+
+class Distribution(ABC):
+    """
+    Distribution of a variable of a Monte Carlo study
+    """
+
+    @abstractmethod
+    def sample(self, rng: np.random.Generator, count: int) -> np.ndarray:
+        pass
+
+    @abstractmethod
+    def get_spec(self) -> str:
+        """
+        Get the description of the distribution in the format of parse_distribution
+        """
+        pass
+
+
+class Constant(Distribution):
+    value: float
+
+    def __init__(self, value: float):
+        self.value = value
+
+    def sample(self, rng: np.random.Generator, count: int) -> np.ndarray:
+        return np.full(count, self.value)
+
+    def get_spec(self) -> str:
+        return _format(self.value)
+
+
+class Normal(Distribution):
+    mean: float
+    std: float
+
+    def __init__(self, mean: float, std: float):
+        if std < 0:
+            raise ValueError('The standard deviation must not be negative')
+        self.mean = mean
+        self.std = std
+
+    def sample(self, rng: np.random.Generator, count: int) -> np.ndarray:
+        return rng.normal(self.mean, self.std, count)
+
+    def get_spec(self) -> str:
+        return f'normal:{_format(self.mean)}:{_format(self.std)}'
+
+
+class Uniform(Distribution):
+    low: float
+    high: float
+
+    def __init__(self, low: float, high: float):
+        if high < low:
+            raise ValueError('The upper bound must not be below the lower bound')
+        self.low = low
+        self.high = high
+
+    def sample(self, rng: np.random.Generator, count: int) -> np.ndarray:
+        return rng.uniform(self.low, self.high, count)
+
+    def get_spec(self) -> str:
+        return f'uniform:{_format(self.low)}:{_format(self.high)}'
+
+
+# distribution type of every spec prefix
+distribution_types = {
+    'normal': Normal,
+    'uniform': Uniform,
+}
+
+
+def parse_distribution(spec: str) -> Distribution:
+    """
+    Create a distribution from a description like 5.0 (constant), normal:5:0.5 (mean and standard deviation)
+    or uniform:4:6 (lower and upper bound)
+    :param spec: The description, see Distribution.get_spec
+    :return: The distribution
+    """
+    kind, *fields = spec.split(':')
+    try:
+        if not fields:
+            return Constant(float(kind))
+        if kind in distribution_types and len(fields) == 2:
+            return distribution_types[kind](*map(float, fields))
+    except ValueError as e:
+        raise ValueError(f'Invalid distribution "{spec}": {e}') from None
+    raise ValueError(f'Invalid distribution "{spec}". Use VALUE, normal:MEAN:STD or uniform:LOW:HIGH')
+
+
+class MetricSketch:
+    """
+    Mergeable summary of the values of a metric in constant memory.
+    Mean and variance are updated with the parallel algorithm of Chan et al., the distribution is kept in
+    logarithmically spaced buckets, so every quantile is known within the relative accuracy (like DDSketch).
+    Sketches of separately computed parts are merged into the sketch of the whole, so they are computed in
+    parallel and can be stored and resumed. nan values, e.g. the time to fall of a bicycle which stays upright,
+    are only counted.
+    """
+    relative_accuracy = 0.01
+    # smaller magnitudes are counted as zero, larger ones in the last bucket
+    min_magnitude = 1e-9
+    max_magnitude = 1e9
+    _log_gamma = math.log((1 + relative_accuracy) / (1 - relative_accuracy))
+    _index_offset = math.ceil(math.log(min_magnitude) / _log_gamma)
+    bucket_cnt = math.ceil(math.log(max_magnitude) / _log_gamma) - _index_offset + 1
+
+    count: int
+    missing: int
+    mean: float
+    # sum of the squared differences from the mean
+    m2: float
+    minimum: float
+    maximum: float
+    # counts of the buckets of the positive and negative values by magnitude and of the values near zero
+    positive: np.ndarray
+    negative: np.ndarray
+    zero: int
+
+    def __init__(self):
+        self.count = 0
+        self.missing = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.positive = np.zeros(self.bucket_cnt, dtype=np.int64)
+        self.negative = np.zeros(self.bucket_cnt, dtype=np.int64)
+        self.zero = 0
+
+    def _buckets(self, magnitudes: np.ndarray) -> np.ndarray:
+        indices = np.ceil(np.log(magnitudes) / self._log_gamma) - self._index_offset
+        return np.bincount(np.clip(indices, 0, self.bucket_cnt - 1).astype(int), minlength=self.bucket_cnt)
+
+    def _bucket_values(self) -> np.ndarray:
+        # the value in the middle of each bucket in relative terms
+        gamma = math.exp(self._log_gamma)
+        return 2 * gamma ** (np.arange(self.bucket_cnt) + self._index_offset) / (gamma + 1)
+
+    def add(self, values: np.ndarray):
+        values = np.asarray(values, dtype=float)
+        finite = values[np.isfinite(values)]
+        self.missing += len(values) - len(finite)
+        if not len(finite):
+            return
+        other = MetricSketch()
+        other.count = len(finite)
+        other.mean = float(np.mean(finite))
+        other.m2 = float(np.sum((finite - other.mean) ** 2))
+        other.minimum = float(np.min(finite))
+        other.maximum = float(np.max(finite))
+        magnitudes = np.abs(finite)
+        near_zero = magnitudes < self.min_magnitude
+        other.zero = int(np.count_nonzero(near_zero))
+        other.positive = self._buckets(magnitudes[(finite > 0) & ~near_zero])
+        other.negative = self._buckets(magnitudes[(finite < 0) & ~near_zero])
+        self.merge(other)
+
+    def merge(self, other: "MetricSketch"):
+        count = self.count + other.count
+        if other.count:
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / count
+            self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        self.missing += other.missing
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self.positive += other.positive
+        self.negative += other.negative
+        self.zero += other.zero
+
+    def get_std(self) -> float:
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else math.nan
+
+    def _sorted_buckets(self) -> tuple[np.ndarray, np.ndarray]:
+        # values and counts of all buckets in increasing order of the values
+        bucket_values = self._bucket_values()
+        values = np.concatenate([-bucket_values[::-1], [0.0], bucket_values])
+        counts = np.concatenate([self.negative[::-1], [self.zero], self.positive])
+        return np.clip(values, self.minimum, self.maximum), counts
+
+    def quantile(self, q: float) -> float:
+        """
+        Get a quantile of the finite values within the relative accuracy
+        :param q: The quantile between 0 and 1
+        """
+        if not self.count:
+            return math.nan
+        values, counts = self._sorted_buckets()
+        rank = q * (self.count - 1)
+        return float(values[np.searchsorted(np.cumsum(counts), rank, side='right')])
+
+    def histogram(self, bin_cnt: int = 10) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Get a histogram of the finite values, which are located within the relative accuracy
+        :param bin_cnt: Number of bins of equal width between the minimum and the maximum
+        :return: The counts of shape (bin_cnt,) and the edges of the bins of shape (bin_cnt + 1,)
+        """
+        if not self.count:
+            return np.zeros(bin_cnt, dtype=np.int64), np.full(bin_cnt + 1, math.nan)
+        values, counts = self._sorted_buckets()
+        histogram, edges = np.histogram(values, bin_cnt, (self.minimum, self.maximum), weights=counts)
+        return histogram.astype(np.int64), edges
+
+    def get_state(self) -> dict[str, np.ndarray]:
+        return {'moments': np.array([self.count, self.missing, self.mean, self.m2, self.minimum, self.maximum,
+                                     self.zero]),
+                'positive': self.positive, 'negative': self.negative}
+
+    @staticmethod
+    def from_state(state: dict[str, np.ndarray]) -> "MetricSketch":
+        sketch = MetricSketch()
+        count, missing, sketch.mean, sketch.m2, sketch.minimum, sketch.maximum, zero = state['moments'].tolist()
+        sketch.count, sketch.missing, sketch.zero = int(count), int(missing), int(zero)
+        sketch.positive = np.array(state['positive'], dtype=np.int64)
+        sketch.negative = np.array(state['negative'], dtype=np.int64)
+        return sketch
+
+
+class MonteCarloStatistics:
+    """
+    Streaming statistics of a Monte Carlo study: the number of falls and a sketch of every summary metric
+    """
+    sample_count: int
+    fall_count: int
+    # samples without a valid bicycle model, which are not part of the statistics
+    error_count: int
+    metrics: dict[str, MetricSketch]
+
+    def __init__(self):
+        self.sample_count = 0
+        self.fall_count = 0
+        self.error_count = 0
+        self.metrics = {name: MetricSketch() for name in metric_names}
+
+    def add(self, metrics: dict[str, np.ndarray]):
+        """
+        Add the summary metrics of a batch of samples, see simulation_summary.summarize_trajectories
+        """
+        self.sample_count += len(metrics['time_to_fall'])
+        self.fall_count += int(np.count_nonzero(np.isfinite(metrics['time_to_fall'])))
+        for name, sketch in self.metrics.items():
+            sketch.add(metrics[name])
+
+    def merge(self, other: "MonteCarloStatistics"):
+        self.sample_count += other.sample_count
+        self.fall_count += other.fall_count
+        self.error_count += other.error_count
+        for name, sketch in self.metrics.items():
+            sketch.merge(other.metrics[name])
+
+    def get_fall_probability(self) -> float:
+        return self.fall_count / self.sample_count if self.sample_count else math.nan
+
+    def get_confidence_interval(self, confidence: float = 0.95) -> tuple[float, float]:
+        """
+        Wilson score interval of the fall probability, which stays within [0, 1] and is reliable for
+        probabilities close to 0 or 1, unlike the normal approximation
+        :param confidence: Confidence level of the interval
+        :return: Lower and upper bound
+        """
+        n = self.sample_count
+        if not n:
+            return 0.0, 1.0
+        z = NormalDist().inv_cdf((1 + confidence) / 2)
+        p = self.fall_count / n
+        center = (p + z ** 2 / (2 * n)) / (1 + z ** 2 / n)
+        half_width = z / (1 + z ** 2 / n) * math.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2))
+        return max(center - half_width, 0.0), min(center + half_width, 1.0)
+
+    def get_state(self) -> dict[str, np.ndarray]:
+        state = {'counts': np.array([self.sample_count, self.fall_count, self.error_count])}
+        for name, sketch in self.metrics.items():
+            state.update({f'{name}.{key}': value for key, value in sketch.get_state().items()})
+        return state
+
+    @staticmethod
+    def from_state(state) -> "MonteCarloStatistics":
+        statistics = MonteCarloStatistics()
+        statistics.sample_count, statistics.fall_count, statistics.error_count = map(int, state['counts'])
+        for name in metric_names:
+            statistics.metrics[name] = MetricSketch.from_state(
+                {key: state[f'{name}.{key}'] for key in ('moments', 'positive', 'negative')})
+        return statistics
+
+
+class MonteCarloStudy:
+    """
+    Estimates the probability of a fall, when the initial state, the velocity and model parameters are drawn
+    from distributions. The samples are drawn and simulated in batches, batch i from random streams seeded with
+    the seed and i, so the samples do not depend on the number of workers or on resuming. Only the streaming
+    statistics of the batches are kept, they are merged in the order of the batches.
+    The controller is designed for the base model and kept for all samples.
+    """
+    distributions: dict[str, Distribution]
+    controller: str
+    gains: dict[str, float]
+    base_model: BicycleModel
+    timestep: float
+    stepcount: int
+    batch_size: int
+    seed: int
+
+    def __init__(self, distributions: dict[str, Distribution], controller: str = 'none',
+                 gains: dict[str, float] | None = None, base_model: BicycleModel | None = None,
+                 timestep: float = 0.01, stepcount: int = 500, batch_size: int = 256, seed: int = 0):
+        """
+        :param distributions: Distribution of any variable of variable_names. The velocity, roll and steer
+                              default to 5 m/s, 5° and -2° like in the simulate command, the other variables
+                              to zero and to the values of the base model.
+        :param controller: Name of the controller, see controller_types
+        :param gains: Gains which replace the default gains of the controller
+        :param base_model: Model with the values of the parameters without a distribution
+        :param timestep: Timestep of the simulations in s
+        :param stepcount: Number of steps of every simulation
+        :param batch_size: Number of samples which are simulated together
+        :param seed: Seed of the samples
+        """
+        unknown_variables = set(distributions) - set(variable_names)
+        if unknown_variables:
+            raise ValueError(f'Unknown variables {", ".join(sorted(unknown_variables))}. '
+                             f'Use {", ".join(variable_names)}')
+        self.distributions = {'velocity': Constant(5.0), 'roll': Constant(5.0), 'steer': Constant(-2.0),
+                              **distributions}
+        self.controller = controller
+        self.gains = gains or {}
+        self.base_model = base_model if base_model is not None else BicycleModel.create()
+        self.timestep = timestep
+        self.stepcount = stepcount
+        self.batch_size = batch_size
+        self.seed = seed
+
+    def get_description(self) -> dict:
+        """
+        All inputs which determine the samples and their results, a checkpoint is only resumed by an equal study
+        """
+        return {'distributions': {name: distribution.get_spec()
+                                  for name, distribution in sorted(self.distributions.items())},
+                'controller': self.controller,
+                'gains': {name: float(value) for name, value in sorted(self.gains.items())},
+                'model': {name: float(value)
+                          for name, value in sorted(self.base_model.get_non_default_values().items())},
+                'timestep': float(self.timestep),
+                'stepcount': int(self.stepcount),
+                'batch_size': int(self.batch_size),
+                'seed': int(self.seed)}
+
+    def draw(self, batch: int) -> dict[str, np.ndarray]:
+        """
+        Draw the samples of a batch
+        :return: Values of shape (batch_size,) for every variable with a distribution
+        """
+        return {name: self.distributions[name].sample(np.random.default_rng((self.seed, batch, index)),
+                                                      self.batch_size)
+                for index, name in enumerate(variable_names) if name in self.distributions}
+
+    def run_batch(self, batch: int) -> MonteCarloStatistics:
+        """
+        Simulate the samples of a batch
+        :return: The statistics of the batch
+        """
+        samples = self.draw(batch)
+        statistics = MonteCarloStatistics()
+        model_names = [name for name in samples if name in BicycleModel.default_parameters]
+        valid = np.ones(self.batch_size, dtype=bool)
+        if model_names:
+            models = []
+            for i in range(self.batch_size):
+                try:
+                    # models of the samples are not kept by the cache of BicycleModel.create
+                    models.append(BicycleModel(**{**self.base_model.get_non_default_values(),
+                                                  **{name: float(samples[name][i]) for name in model_names}}))
+                except np.linalg.LinAlgError:
+                    valid[i] = False
+        else:
+            models = self.base_model
+        statistics.error_count = int(np.count_nonzero(~valid))
+        if not np.any(valid):
+            return statistics
+
+        initial_states = np.zeros((self.batch_size, 4))
+        for column, name in enumerate(('roll', 'steer', 'roll_rate', 'steer_rate')):
+            if name in samples:
+                initial_states[:, column] = np.radians(samples[name])
+        simulation = BatchSimulation(initial_states[valid], samples['velocity'][valid], models,
+                                     create_controller(self.controller, self.base_model, **self.gains),
+                                     self.timestep, self.stepcount)
+        simulation.run()
+        statistics.add(summarize_trajectories(simulation.get_data_array(), self.timestep))
+        return statistics
+
+    def load_checkpoint(self, checkpoint: Path) -> tuple[MonteCarloStatistics, int]:
+        """
+        Load the statistics of an earlier run of this study
+        :return: The statistics and the number of batches, which they contain
+        """
+        with np.load(checkpoint) as file_contents:
+            if json.loads(str(file_contents['description'])) != self.get_description():
+                raise ValueError(f'The checkpoint {checkpoint} belongs to a different study')
+            return MonteCarloStatistics.from_state(file_contents), int(file_contents['batch_cnt'])
+
+    def save_checkpoint(self, checkpoint: Path, statistics: MonteCarloStatistics, batch_cnt: int):
+        # write to a temporary file first, so an interrupted run never leaves a partial checkpoint
+        temporary_path = checkpoint.with_name(f'{checkpoint.stem}.{os.getpid()}.tmp.npz')
+        np.savez(temporary_path, description=json.dumps(self.get_description()), batch_cnt=batch_cnt,
+                 **statistics.get_state())
+        os.replace(temporary_path, checkpoint)
+
+    def run(self, workers: int | None = None, checkpoint: Path | None = None, ci_width: float = 0.01,
+            confidence: float = 0.95, min_samples: int = 1000, max_samples: int = 1_000_000,
+            verbose: bool = False) -> MonteCarloStatistics:
+        """
+        Simulate batches in parallel, until the confidence interval of the fall probability is tight enough
+        :param workers: Number of worker processes, defaults to the number of cores
+        :param checkpoint: File, which holds the statistics after every batch. If it exists, the study
+                           continues from it.
+        :param ci_width: The study stops, when the half width of the confidence interval is at most this value
+        :param confidence: Confidence level of the interval
+        :param min_samples: Minimum number of samples before the study may stop
+        :param max_samples: Maximum number of samples, rounded up to whole batches
+        :param verbose: Print the progress
+        :return: The statistics of all samples
+        """
+        statistics, batch_cnt = MonteCarloStatistics(), 0
+        if checkpoint is not None and checkpoint.exists():
+            statistics, batch_cnt = self.load_checkpoint(checkpoint)
+            if verbose:
+                print(f'Resuming from {statistics.sample_count} samples in {checkpoint}')
+        max_batches = -(-max_samples // self.batch_size)
+
+        def is_done() -> bool:
+            lower, upper = statistics.get_confidence_interval(confidence)
+            tight = statistics.sample_count >= min_samples and (upper - lower) / 2 <= ci_width
+            return tight or batch_cnt >= max_batches
+
+        if is_done():
+            return statistics
+        # a few batches per worker are queued, the results of batches which complete early wait for their turn
+        queue_size = 2 * (workers or os.cpu_count() or 1)
+        pending = {}
+        completed = {}
+        next_batch = batch_cnt
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while True:
+                while len(pending) < queue_size and next_batch < max_batches:
+                    pending[executor.submit(_run_batch, self, next_batch)] = next_batch
+                    next_batch += 1
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    completed[pending.pop(future)] = future.result()
+                while batch_cnt in completed and not is_done():
+                    statistics.merge(completed.pop(batch_cnt))
+                    batch_cnt += 1
+                if checkpoint is not None:
+                    self.save_checkpoint(checkpoint, statistics, batch_cnt)
+                if verbose:
+                    lower, upper = statistics.get_confidence_interval(confidence)
+                    print(f'{statistics.sample_count} samples, fall probability '
+                          f'{statistics.get_fall_probability():.4f} [{lower:.4f}, {upper:.4f}]')
+                if is_done():
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    break
+        return statistics
+
+
+def _run_batch(study: MonteCarloStudy, batch: int) -> MonteCarloStatistics:
+    # executed in the worker processes
+    return study.run_batch(batch)
@@ -0,0 +1,271 @@
+import math
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+
+from model.bicycle_model import BicycleModel
+from model.linear_system import expm, input_matrix, system_matrix
+from model.sensitivity import parameter_names as model_parameter_names, system_matrix_derivatives
+from model.simulation_summary import FALL_THRESHOLD
+
+
+@dataclass
+class FitResult:
+    parameter_names: tuple[str, ...]
+    values: np.ndarray
+    # standard errors from the covariance σ²(JᵀJ)⁻¹ of the linearized problem. the residuals of neighbouring
+    # states are correlated, so they are a lower bound of the actual uncertainties.
+    uncertainties: np.ndarray
+    initial_values: np.ndarray
+    # root mean square of the residuals of roll and steer in rad
+    rms: float
+    iterations: int
+    converged: bool
+    # no step decreased the cost any more before the tolerance was reached, e.g. at a minimum within rounding
+    stalled: bool = False
+
+    def get_values(self) -> dict[str, float]:
+        return {name: float(value) for name, value in zip(self.parameter_names, self.values)}
+
+
+class TrajectoryFit:
+    """
+    Least-squares fit of model parameters to a recorded trajectory in the layout of SimulationResult.
+    The model is driven by the recorded steer torque. An unstable bicycle diverges from the recording within
+    seconds, so the recording is split into short segments (multiple shooting), which start from the recorded
+    roll, steer and rates. All segments are simulated at once, each step is a single matrix product of the
+    exact transition of the linear model with a zero-order hold of the torque.
+    The Jacobian is integrated alongside the states from the analytic derivatives of the system matrix,
+    see sensitivity.simulate_sensitivities, so an iteration costs about one simulation of the recording.
+    """
+    names: tuple[str, ...]
+    base_model: BicycleModel
+    velocity: float
+    timestep: float
+    # indices of the fitted parameters in sensitivity.parameter_names
+    indices: np.ndarray
+    # initial states of the segments of shape (S, 4)
+    initial_states: np.ndarray
+    # steer torques of shape (L, S), recorded roll and steer of shape (L, S, 2) and their weights of shape (L, S).
+    # step k of all segments is stored together, the padding after the end of the recording has zero weight.
+    torques: np.ndarray
+    measured: np.ndarray
+    weights: np.ndarray
+    # number of steps, whose sensitivities are collected before they are added to JᵀJ
+    _block_steps = 64
+
+    def __init__(self, data: np.ndarray, timestep: float, velocity: float, names: list[str],
+                 base_model: BicycleModel | None = None, segment_duration: float = 1.0):
+        """
+        :param data: Recorded states of shape (T, 6) in the layout of SimulationResult. The states from the
+                     first one beyond the fall threshold on are not used.
+        :param timestep: Time between two recorded states in s
+        :param velocity: Velocity of the bicycle in m/s
+        :param names: Names of the fitted parameters, see BicycleModel.default_parameters
+        :param base_model: Model with the values of the other parameters and the initial guess, defaults to the
+                           default model
+        :param segment_duration: Length of the segments in s
+        """
+        unknown_parameters = set(names) - set(model_parameter_names)
+        if unknown_parameters:
+            raise ValueError(f'Unknown bicycle model parameters {", ".join(sorted(unknown_parameters))}')
+        if len(set(names)) != len(names) or not names:
+            raise ValueError('Give each fitted parameter once')
+        data = np.asarray(data, dtype=float)
+        if data.ndim == 2 and data.shape[1] == 6:
+            # the states after a fall are frozen like in Simulation.run and not described by the model
+            fallen = np.flatnonzero(np.any(np.abs(data[:, 0:2]) > FALL_THRESHOLD, axis=1))
+            if len(fallen):
+                data = data[:fallen[0]]
+        if data.ndim != 2 or data.shape[1] != 6 or len(data) < 2:
+            raise ValueError(f'The recording must be of shape (T, 6) with T > 1 states before a fall, got {data.shape}')
+        self.names = tuple(names)
+        self.base_model = base_model if base_model is not None else BicycleModel.create()
+        self.velocity = velocity
+        self.timestep = timestep
+        self.indices = np.array([model_parameter_names.index(name) for name in names])
+
+        length = max(1, min(round(segment_duration / timestep), len(data) - 1))
+        segment_cnt = -(-(len(data) - 1) // length)
+        # row j * length + k of the recording is step k of segment j, padded to complete segments
+        padded = np.zeros((segment_cnt * length + 1, 6))
+        padded[:len(data)] = data
+        valid = np.zeros(len(padded))
+        valid[1:len(data)] = 1.0
+        rows = np.arange(length)[:, None] + length * np.arange(segment_cnt)[None, :]
+        self.initial_states = padded[rows[0], 0:4]
+        self.torques = padded[rows, 4]
+        self.measured = padded[rows + 1, 0:2]
+        self.weights = valid[rows + 1]
+
+    def get_measurement_count(self) -> int:
+        return 2 * int(self.weights.sum())
+
+    def get_initial_values(self) -> np.ndarray:
+        return np.array([self.base_model.get_parameter(name) for name in self.names])
+
+    def create_model(self, values: np.ndarray) -> BicycleModel:
+        # models of the iterations are not kept by the cache of BicycleModel.create
+        return BicycleModel(**{**self.base_model.get_non_default_values(),
+                               **{name: float(value) for name, value in zip(self.names, values)}})
+
+    def _transitions(self, model: BicycleModel, jacobian: bool) -> tuple[np.ndarray, np.ndarray | None]:
+        # the torque is appended to the state as a constant, so the transition of [state, torque] holds the
+        # zero-order hold of the torque. its derivatives are the lower left block of the exponential of
+        # [[A, 0], [∂A/∂p, A]] (Van Loan, 1978).
+        A = np.zeros((5, 5))
+        A[0:4, 0:4] = system_matrix(model, self.velocity)
+        A[0:4, 4] = input_matrix()[:, 1]
+        if not jacobian:
+            return expm(A * self.timestep)[0:4], None
+        blocks = np.zeros((len(self.names), 10, 10))
+        blocks[:, 0:5, 0:5] = A
+        blocks[:, 5:9, 0:4] = system_matrix_derivatives(model, np.array([self.velocity]))[0, self.indices]
+        blocks[:, 5:10, 5:10] = A
+        transitions = expm(blocks * self.timestep)
+        return transitions[0, 0:4, 0:5], transitions[:, 5:9, 0:5]
+
+    def evaluate(self, values: np.ndarray,
+                 jacobian: bool = True) -> tuple[float, np.ndarray | None, np.ndarray | None]:
+        """
+        Simulate all segments with the given parameter values
+        :param values: Values of the fitted parameters
+        :param jacobian: Also compute JᵀJ and Jᵀr of the Jacobian J of the residuals
+        :return: Sum of the squared residuals, JᵀJ of shape (P, P) and Jᵀr of shape (P,).
+                 The sum is inf for parameters without a valid model.
+        """
+        try:
+            with np.errstate(over='raise', divide='raise', invalid='raise'):
+                transition, derivatives = self._transitions(self.create_model(values), jacobian)
+        except (np.linalg.LinAlgError, FloatingPointError):
+            return math.inf, None, None
+        # the last column of the extended states is the torque, which is held during the step
+        extended = np.empty((len(self.initial_states), 5))
+        extended[:, 0:4] = self.initial_states
+        step_matrix = transition.T
+        predicted = np.empty(self.measured.shape)
+        if jacobian:
+            phi = transition[:, 0:4].T
+            sensitivity_matrices = derivatives.transpose(0, 2, 1)
+            sensitivities = np.zeros((len(self.names),) + self.initial_states.shape)
+            # the sensitivities of roll and steer of a block of steps enter JᵀJ with a single matrix product
+            block = np.empty((self._block_steps, len(self.names), len(self.initial_states), 2))
+            jtj = np.zeros((len(self.names), len(self.names)))
+            jtr = np.zeros(len(self.names))
+
+        with np.errstate(all='ignore'):
+            for k in range(len(self.torques)):
+                extended[:, 4] = self.torques[k]
+                if jacobian:
+                    sensitivities = sensitivities @ phi + extended @ sensitivity_matrices
+                    block[k % self._block_steps] = sensitivities[:, :, 0:2]
+                extended[:, 0:4] = extended @ step_matrix
+                predicted[k] = extended[:, 0:2]
+                if jacobian and (k % self._block_steps == self._block_steps - 1 or k == len(self.torques) - 1):
+                    steps = slice(k - k % self._block_steps, k + 1)
+                    weights = self.weights[steps]
+                    residuals = (predicted[steps] - self.measured[steps]) * weights[:, :, None]
+                    jacobian_block = (block[:k % self._block_steps + 1] * weights[:, None, :, None])
+                    jacobian_block = jacobian_block.transpose(1, 0, 2, 3).reshape(len(self.names), -1)
+                    jtj += jacobian_block @ jacobian_block.T
+                    jtr += jacobian_block @ residuals.reshape(-1)
+            residuals = (predicted - self.measured) * self.weights[:, :, None]
+            cost = float(np.sum(residuals * residuals))
+        if not math.isfinite(cost):
+            return math.inf, None, None
+        return cost, (jtj if jacobian else None), (jtr if jacobian else None)
+
+    def fit(self, initial_values: np.ndarray | None = None, max_iterations: int = 100,
+            tolerance: float = 1e-10) -> FitResult:
+        """
+        Minimize the sum of the squared residuals of roll and steer with the Levenberg-Marquardt method.
+        The damping is scaled by the diagonal of JᵀJ, so the steps do not depend on the units of the parameters.
+        :param initial_values: Start of the iteration, defaults to the values of the base model
+        :param max_iterations: Maximum number of evaluations of the Jacobian
+        :param tolerance: The iteration stops, when the relative decrease of the cost or the relative step
+                          is smaller than the tolerance
+        :return: The fitted values
+        """
+        initial_values = self.get_initial_values() if initial_values is None else np.asarray(initial_values, float)
+        values = initial_values.copy()
+        cost, jtj, jtr = self.evaluate(values)
+        if not math.isfinite(cost):
+            raise ValueError(f'The initial values {self.names} = {values} do not describe a valid bicycle')
+        damping = 1e-3
+        converged = False
+        stalled = False
+        iteration = 0
+        while iteration < max_iterations and not converged:
+            iteration += 1
+            scale = np.maximum(np.diag(jtj), np.finfo(float).tiny)
+            while True:
+                try:
+                    step = np.linalg.solve(jtj + damping * np.diag(scale), -jtr)
+                except np.linalg.LinAlgError:
+                    step = None
+                new_cost = math.inf if step is None else self.evaluate(values + step, jacobian=False)[0]
+                if new_cost < cost:
+                    break
+                damping *= 4
+                if damping > 1e16:
+                    # no step along the gradient decreases the cost any more
+                    stalled = True
+                    break
+            if stalled:
+                break
+            converged = (cost - new_cost <= tolerance * cost
+                         or np.all(np.abs(step) <= tolerance * (np.abs(values) + tolerance)))
+            values = values + step
+            damping = max(damping / 3, 1e-12)
+            cost, jtj, jtr = self.evaluate(values)
+
+        return FitResult(self.names, values, self._uncertainties(cost, jtj), initial_values,
+                         math.sqrt(cost / self.get_measurement_count()), iteration, converged, stalled)
+
+    def _uncertainties(self, cost: float, jtj: np.ndarray) -> np.ndarray:
+        degrees_of_freedom = max(self.get_measurement_count() - len(self.names), 1)
+        try:
+            covariance = cost / degrees_of_freedom * np.linalg.inv(jtj)
+        except np.linalg.LinAlgError:
+            return np.full(len(self.names), math.inf)
+        return np.sqrt(np.maximum(np.diag(covariance), 0.0))
+
+
+def _fit_start(fit: TrajectoryFit, initial_values: np.ndarray, max_iterations: int, tolerance: float) -> FitResult:
+    try:
+        return fit.fit(initial_values, max_iterations, tolerance)
+    except ValueError:
+        # the start does not describe a valid bicycle
+        nan = np.full(len(initial_values), math.nan)
+        return FitResult(fit.names, nan, nan, initial_values, math.inf, 0, False)
+
+
+def fit_parameters(fit: TrajectoryFit, starts: int = 8, spread: float = 0.2, seed: int = 0,
+                   workers: int | None = None, max_iterations: int = 100,
+                   tolerance: float = 1e-10) -> list[FitResult]:
+    """
+    Fit the parameters from several starts in parallel worker processes, to avoid local minima.
+    The first start is the initial guess, the others are drawn uniformly within the relative spread around it.
+    :param fit: The fit problem
+    :param starts: Number of starts
+    :param spread: Relative distance of the random starts from the initial guess
+    :param seed: Seed of the random starts
+    :param workers: Number of worker processes, defaults to the number of cores
+    :param max_iterations: Maximum number of iterations per start
+    :param tolerance: Tolerance of the iteration, see TrajectoryFit.fit
+    :return: The results of all starts sorted by their residuals, the best one first
+    """
+    if starts < 1:
+        raise ValueError('At least one start is required')
+    initial_values = fit.get_initial_values()
+    rng = np.random.default_rng(seed)
+    start_values = [initial_values] + [initial_values * (1 + rng.uniform(-spread, spread, len(initial_values)))
+                                       for _ in range(starts - 1)]
+    if starts == 1 or workers == 1:
+        results = [_fit_start(fit, values, max_iterations, tolerance) for values in start_values]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_fit_start, [fit] * starts, start_values,
+                                        [max_iterations] * starts, [tolerance] * starts))
+    return sorted(results, key=lambda result: result.rms)
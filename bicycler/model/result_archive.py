@@ -0,0 +1,197 @@
+import json
+import math
+import zipfile
+from pathlib import Path
+
+import numpy as np
+
+from model.bicycle_model import BicycleModel
+from model.simulation_parameters import SimulationParameters
+from model.simulation_result import SimulationResult
+from model.simulation_summary import SimulationSummary, SummaryAccumulator
+
+
+# columns of the index which hold text instead of numbers
+text_columns = ('controller', 'metadata', 'error')
+
+
+class ArchiveWriter:
+    """
+    Writes many simulation results into a single archive file, see ResultArchive.
+    The trajectories are written as they are added, the index table is written when the archive is closed.
+    Failed runs are only added to the index together with their error, so the index describes every run.
+    """
+    path: Path
+    rows: list[dict]
+
+    def __init__(self, path: Path):
+        """
+        :param path: Path of the archive, usually with the suffix .npz
+        """
+        self.path = path
+        self.rows = []
+        # the members are stored uncompressed, so a single trajectory is read without decompressing others
+        self.file = zipfile.ZipFile(path, mode='w', compression=zipfile.ZIP_STORED, allowZip64=True)
+
+    def __enter__(self) -> "ArchiveWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write_array(self, name: str, array: np.ndarray):
+        with self.file.open(name + '.npy', mode='w', force_zip64=True) as member:
+            np.lib.format.write_array(member, np.asanyarray(array), allow_pickle=False)
+
+    def add(self, result: SimulationResult, parameters: SimulationParameters,
+            summary: SimulationSummary | None = None, **columns: float | str) -> int:
+        """
+        Add a simulation result and its parameters to the archive
+        :param result: The result of the simulation
+        :param parameters: The parameters which produced the result
+        :param summary: The summary of the result, computed from the trajectory if not given
+        :param columns: Additional index columns of the run, e.g. its index in a sweep
+        :return: The index of the run in the archive
+        """
+        index = len(self.rows)
+        data = result.get_data_array()
+        if summary is None:
+            accumulator = SummaryAccumulator(result.get_timestep())
+            accumulator.add(data)
+            summary = accumulator.get_summary()
+
+        self._write_array(ResultArchive.get_run_name(index), data)
+        row = {'velocity': float(parameters.bicycle_velocity),
+               'roll': math.degrees(parameters.initial_state.get_roll()),
+               'steer': math.degrees(parameters.initial_state.get_steering_angle()),
+               'controller': parameters.controller.get_name(),
+               'timestep': float(result.get_timestep()),
+               'sample_cnt': data.shape[0],
+               'metadata': json.dumps(result.get_metadata()),
+               'error': ''}
+        for name, value in parameters.controller.get_parameters().items():
+            try:
+                row['gain_' + name] = float(value)
+            except ValueError:
+                # e.g. the hash of the design model, which is described by the model columns
+                continue
+        for name, value in parameters.bicycle_model.get_non_default_values().items():
+            row['model_' + name] = float(value)
+        row.update(summary.as_dict())
+        row.update(columns)
+        self.rows.append(row)
+        return index
+
+    def add_failure(self, error: str, **columns: float | str) -> int:
+        """
+        Add a run, which failed, to the index of the archive without a trajectory
+        :param error: The error of the run
+        :param columns: The index columns of the run, which are known, e.g. its parameters
+        :return: The index of the run in the archive
+        """
+        index = len(self.rows)
+        self.rows.append({**columns, 'error': error})
+        return index
+
+    def close(self):
+        if self.file.fp is None:
+            return
+        names = list(dict.fromkeys(name for row in self.rows for name in row))
+        for name in names:
+            values = [row.get(name) for row in self.rows]
+            if name in text_columns:
+                column = np.array(['' if value is None else value for value in values], dtype=str)
+            elif name.startswith('model_'):
+                # runs without an override use the default parameter of the model
+                default = BicycleModel.default_parameters[name[len('model_'):]]
+                column = np.array([default if value is None else value for value in values], dtype=float)
+            else:
+                column = np.array([math.nan if value is None else value for value in values], dtype=float)
+            self._write_array('index/' + name, column)
+        self.file.close()
+
+
+class ResultArchive:
+    """
+    Single file holding the trajectories of many runs together with an index table of their
+    parameters and summary metrics. The archive is a zip file of uncompressed .npy members,
+    so it can be opened with np.load as well. Queries only read the index, trajectories are
+    loaded one at a time when they are requested.
+    """
+    path: Path
+    index: dict[str, np.ndarray]
+
+    def __init__(self, path: Path):
+        """
+        :param path: Path of an archive written by ArchiveWriter
+        """
+        self.path = path
+        self.file = np.load(path, allow_pickle=False)
+        self.index = {name[len('index/'):]: self.file[name] for name in self.file.files if name.startswith('index/')}
+
+    def __enter__(self) -> "ResultArchive":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.index['velocity']) if 'velocity' in self.index else 0
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def get_run_name(index: int) -> str:
+        return f'runs/{index:06d}'
+
+    def get_index(self) -> dict[str, np.ndarray]:
+        """
+        Get the index table as columns of equal length, one row per run
+        """
+        return self.index
+
+    def query(self, upright: bool | None = None, **conditions) -> np.ndarray:
+        """
+        Find runs by their parameters and metrics without loading any trajectory, e.g.
+        query(velocity=(4, 6), upright=True) or query(controller='RollPDController')
+        :param upright: Only select runs which did (True) or did not (False) stay upright
+        :param conditions: Column names of the index with either a value, which has to match exactly,
+                           or a tuple (min, max) of an inclusive range. None leaves a bound open.
+        :return: Indices of the matching runs
+        """
+        selected = np.ones(len(self), dtype=bool)
+        for name, condition in conditions.items():
+            if name not in self.index:
+                raise KeyError(f'Unknown column "{name}". Use one of {", ".join(self.index)}')
+            column = self.index[name]
+            if isinstance(condition, tuple):
+                lower, upper = condition
+                if lower is not None:
+                    selected &= column >= lower
+                if upper is not None:
+                    selected &= column <= upper
+            else:
+                selected &= column == condition
+        if upright is not None:
+            selected &= np.isnan(self.index['time_to_fall']) == upright
+            # failed runs have no time to fall either, but did not stay upright
+            if 'error' in self.index:
+                selected &= self.index['error'] == ''
+        return np.flatnonzero(selected)
+
+    def load(self, index: int) -> SimulationResult:
+        """
+        Load a single run of the archive
+        :param index: Index of the run, see query
+        :return: The result of the run
+        """
+        if not 0 <= index < len(self):
+            raise IndexError(f'Run {index} is not in the archive with {len(self)} runs')
+        if 'error' in self.index and self.index['error'][index]:
+            raise ValueError(f'Run {index} failed and has no trajectory: {self.index["error"][index]}')
+        data = self.file[self.get_run_name(index)]
+        result = SimulationResult(float(self.index['timestep'][index]), 0)
+        result.data = data
+        result.metadata = json.loads(str(self.index['metadata'][index]))
+        return result
@@ -0,0 +1,148 @@
+import copy
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from pathlib import Path
+
+from model.cache_directory import get_cache_directory
+from model.simulation import Simulation
+from model.simulation_parameters import SimulationParameters
+from model.simulation_result import SimulationResult
+
+# number of results which are kept in memory by run_cached
+memo_size = 32
+_memo: OrderedDict[str, SimulationResult] = OrderedDict()
+
+
+def get_cache_key(parameters: SimulationParameters) -> str:
+    """
+    Hash all inputs which determine the result of a simulation
+    :param parameters: The parameters of the simulation
+    :return: Hex digest which is equal for simulations with equal results
+    """
+    model = parameters.bicycle_model
+    state = parameters.initial_state
+    controller = parameters.controller
+    description = {
+        'engine_version': Simulation.engine_version,
+        'model': {name: float(model.get_parameter(name)) for name in sorted(model.default_parameters)},
+        'controller': f'{type(controller).__module__}.{type(controller).__qualname__}',
+        'controller_parameters': controller.get_parameters(),
+        'initial_state': [float(state.get_roll()), float(state.get_steering_angle()), float(state.get_roll_rate()),
+                          float(state.get_steering_rate()), float(state.get_steer_torque()),
+                          float(state.get_heading())],
+        'velocity': float(parameters.bicycle_velocity),
+        'timestep': float(parameters.timestep),
+        'stepcount': int(parameters.stepcount),
+        'output_stride': parameters.get_output_stride(),
+        'control_stride': parameters.get_control_stride(),
+        'delay_steps': parameters.get_delay_steps(),
+        'disturbances': [disturbance.get_spec() for disturbance in parameters.disturbances],
+        'disturbance_seed': parameters.disturbance_seed,
+        'engine': parameters.engine,
+        'integrator': parameters.integrator,
+    }
+    # floats are written with repr, which is exact, so different values never share a key
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    Directory of simulation results stored by the hash of their parameters.
+    When the directory grows beyond its size limit, the least recently used results are deleted.
+    """
+    directory: Path
+    max_bytes: int
+
+    def __init__(self, directory: Path | None = None, max_bytes: int = 1 << 30):
+        """
+        :param directory: Cache directory, defaults to $BICYCLER_CACHE_DIR or ~/.cache/bicycler
+        :param max_bytes: Maximum total size of the cached results
+        """
+        if directory is None:
+            directory = get_cache_directory()
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def get_path(self, key: str) -> Path:
+        return self.directory / f'{key}.npz'
+
+    def get(self, key: str) -> SimulationResult | None:
+        path = self.get_path(key)
+        try:
+            result = SimulationResult.load_from(path)
+        except (OSError, ValueError, KeyError):
+            # missing or damaged entry
+            return None
+        # the modification time marks the last use for the eviction
+        os.utime(path)
+        return result
+
+    def put(self, key: str, result: SimulationResult):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first, so concurrent readers never see a partial entry
+        temporary_path = self.directory / f'{key}.{os.getpid()}.tmp.npz'
+        result.save_to(temporary_path)
+        os.replace(temporary_path, self.get_path(key))
+        self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used results until the cache is smaller than its size limit
+        """
+        entries = []
+        for path in self.directory.glob('*.npz'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+
+def _without_timing(result: SimulationResult, names: tuple[str, ...]) -> SimulationResult:
+    # measured times only describe the run which measured them, so they are not passed on with a reused result
+    if not any(name in result.metadata for name in names):
+        return result
+    reused = copy.copy(result)
+    reused.metadata = {key: value for key, value in result.metadata.items() if key not in names}
+    return reused
+
+
+def run_cached(parameters: SimulationParameters, cache: ResultCache | None = None) -> SimulationResult:
+    """
+    Run a simulation or reuse the result of an earlier simulation with equal parameters.
+    Results are kept in memory for repeated calls in the same process and optionally in a cache directory.
+    The returned data is read-only, because the same result may be returned to several callers.
+    Reused results do not contain the timing statistics of the controller, which were measured by the original run.
+    :param parameters: The parameters of the simulation
+    :param cache: Optional cache directory, which is shared between processes
+    :return: The result of the simulation
+    """
+    key = get_cache_key(parameters)
+    if key in _memo:
+        _memo.move_to_end(key)
+        return _memo[key]
+
+    result = cache.get(key) if cache is not None else None
+    if result is None:
+        simulation = Simulation(parameters)
+        simulation.run()
+        result = simulation.get_result()
+        reused = _without_timing(result, parameters.controller.timing_statistics)
+        if cache is not None:
+            cache.put(key, reused)
+    else:
+        reused = result
+
+    result.data.flags.writeable = False
+    _memo[key] = reused
+    if len(_memo) > memo_size:
+        _memo.popitem(last=False)
+    return result
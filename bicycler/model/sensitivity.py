@@ -0,0 +1,240 @@
+import copy
+import math
+from dataclasses import dataclass
+
+import numpy as np
+
+from model.bicycle_model import BicycleModel
+from model.linear_system import augmented_closed_loop_matrix, expm, stacked_system_matrices
+from model.result_cache import run_cached
+from model.simulation_parameters import SimulationParameters
+from model.simulation_summary import FALL_THRESHOLD
+from model.stability import StabilityAnalysis
+
+# order of the parameters in all derivatives
+parameter_names = tuple(BicycleModel.default_parameters)
+# the complex step is not limited by cancellation, so it can be far below the precision of the parameters
+_COMPLEX_STEP = 1e-30
+
+
+@dataclass
+class MatrixDerivatives:
+    # derivatives of shape (P, 2, 2) with respect to the parameters in the order of parameter_names
+    M: np.ndarray
+    C1: np.ndarray
+    K0: np.ndarray
+    K2: np.ndarray
+
+
+def _perturbed_parameters(bicycle_model: BicycleModel) -> dict[str, np.ndarray]:
+    # copy i of the parameters has an imaginary step in parameter i, so the derivatives of any analytic function
+    # of the parameters are the imaginary parts of a single batched evaluation divided by the step
+    parameter_cnt = len(parameter_names)
+    params = {}
+    for index, name in enumerate(parameter_names):
+        values = np.full(parameter_cnt, bicycle_model.get_parameter(name), dtype=complex)
+        values[index] += 1j * _COMPLEX_STEP
+        params[name] = values
+    return params
+
+
+def matrix_derivatives(bicycle_model: BicycleModel) -> MatrixDerivatives:
+    """
+    Compute the derivatives of M, C1, K0 and K2 with respect to all parameters of the model.
+    The derivatives are exact up to rounding, because BicycleModel.compute_matrices is evaluated with
+    complex-step perturbations instead of finite differences.
+    :param bicycle_model: The bicycle model
+    :return: The derivatives of the four matrices
+    """
+    matrices = BicycleModel.compute_matrices(_perturbed_parameters(bicycle_model))
+    return MatrixDerivatives(*(matrix.imag / _COMPLEX_STEP for matrix in matrices))
+
+
+def system_matrix_derivatives(bicycle_model: BicycleModel, velocities: np.ndarray,
+                              augmented: bool = False) -> np.ndarray:
+    """
+    Compute the derivatives of the first-order system matrix with respect to all parameters of the model.
+    The gains of a linear controller are held fixed, so the derivatives of the closed-loop system matrix are equal.
+    For model-based controllers like LQR or MPC, this neglects the change of the gains with the design model.
+    :param bicycle_model: The bicycle model
+    :param velocities: Velocities of shape (N,)
+    :param augmented: Differentiate the 5x5 matrix of the state extended by the heading,
+                      see linear_system.augmented_closed_loop_matrix
+    :return: Derivatives of shape (N, P, 4, 4), or (N, P, 5, 5) if augmented
+    """
+    params = _perturbed_parameters(bicycle_model)
+    M, C1, K0, K2 = BicycleModel.compute_matrices(params)
+    M_inv = np.linalg.inv(M)
+    v = np.asarray(velocities, dtype=float)[:, None, None, None]
+    size = 5 if augmented else 4
+
+    # the same layout as linear_system.stacked_system_matrices, with one matrix per velocity and parameter
+    A = np.zeros((len(velocities), len(parameter_names), size, size), dtype=complex)
+    A[..., 0:2, 2:4] = np.eye(2)
+    A[..., 2:4, 0:2] = -M_inv @ (params['g'][:, None, None] * K0 + v ** 2 * K2)
+    A[..., 2:4, 2:4] = -M_inv @ (v * C1)
+    if augmented:
+        # heading rate coefficients of linear_system.heading_rate_coefficients
+        A[..., 4, 1] = v[..., 0, 0] * np.cos(params['lambda']) / params['w']
+        A[..., 4, 3] = params['c'] / params['w']
+    return A.imag / _COMPLEX_STEP
+
+
+def _velocity_derivative(bicycle_model: BicycleModel, velocity: float) -> np.ndarray:
+    # derivative of the system matrix with respect to the velocity
+    A_v = np.zeros((4, 4))
+    A_v[2:4, 0:2] = -bicycle_model.M_inv @ (2 * velocity * bicycle_model.K2)
+    A_v[2:4, 2:4] = -bicycle_model.M_inv @ bicycle_model.C1
+    return A_v
+
+
+def _eigenvalue_derivatives(A: np.ndarray, derivatives: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # first-order perturbation of simple eigenvalues: dλ = wᴴ dA v / wᴴ v with the left eigenvectors wᴴ,
+    # which are the rows of the inverse of the matrix of right eigenvectors, so wᴴ v = 1.
+    # A is of shape (N, n, n) and derivatives of shape (N, P, n, n).
+    values, vectors = np.linalg.eig(A)
+    order = np.argsort(-values.real, axis=-1, kind='stable')
+    values = np.take_along_axis(values, order, axis=-1)
+    vectors = np.take_along_axis(vectors, order[:, None, :], axis=-1)
+    left = np.linalg.inv(vectors)
+    value_derivatives = np.einsum('nij,npjk,nki->nip', left, derivatives, vectors)
+    return values, value_derivatives
+
+
+def eigenvalue_sensitivities(bicycle_model: BicycleModel,
+                             velocities: np.ndarray,
+                             gains: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the eigenvalues of the linearized system and their derivatives with respect to all parameters
+    of the model from a single eigendecomposition per velocity.
+    The derivatives are undefined at velocities, where two eigenvalues coincide.
+    :param bicycle_model: The bicycle model
+    :param velocities: Velocities of shape (N,)
+    :param gains: Optional linear state feedback of shape (2, 4), see BicycleController.get_linear_gains
+    :return: Eigenvalues of shape (N, 4) sorted like stability.eigenvalues and their derivatives of shape
+             (N, 4, P) in the order of parameter_names
+    """
+    velocities = np.asarray(velocities, dtype=float)
+    return _eigenvalue_derivatives(stacked_system_matrices(bicycle_model, velocities, gains),
+                                   system_matrix_derivatives(bicycle_model, velocities))
+
+
+def critical_speed_sensitivities(bicycle_model: BicycleModel,
+                                 analysis: StabilityAnalysis,
+                                 gains: np.ndarray | None = None) -> np.ndarray:
+    """
+    Compute the derivatives of the critical speeds with respect to all parameters of the model.
+    At a critical speed v* the real part of the leading eigenvalue is zero, so by the implicit function theorem
+    dv*/dp = -(∂Re λ/∂p) / (∂Re λ/∂v).
+    :param bicycle_model: The bicycle model of the analysis
+    :param analysis: The result of stability.analyze_stability
+    :param gains: The gains of the analysis
+    :return: Derivatives of shape (K, P) for the K critical speeds of the analysis
+    """
+    speeds = np.array([speed.velocity for speed in analysis.critical_speeds])
+    if not len(speeds):
+        return np.zeros((0, len(parameter_names)))
+    A = stacked_system_matrices(bicycle_model, speeds, gains)
+    # the velocity is appended as an additional parameter
+    derivatives = np.concatenate([system_matrix_derivatives(bicycle_model, speeds),
+                                  np.stack([_velocity_derivative(bicycle_model, v) for v in speeds])[:, None]],
+                                 axis=1)
+    _, value_derivatives = _eigenvalue_derivatives(A, derivatives)
+    leading = value_derivatives[:, 0].real
+    return -leading[:, :-1] / leading[:, -1:]
+
+
+@dataclass
+class SensitivityResult:
+    timestep: float
+    # states of shape (T, 6) in the layout of SimulationResult
+    data: np.ndarray
+    # derivatives of the states of shape (T, 6, P) in the order of parameter_names
+    sensitivities: np.ndarray
+    # time in s at which the bicycle falls over like in SimulationSummary, nan if it does not fall over
+    time_to_fall: float
+    # derivatives of the time to fall of shape (P,), nan if the bicycle does not fall over
+    time_to_fall_sensitivities: np.ndarray
+
+    def get_parameter_names(self) -> tuple[str, ...]:
+        return parameter_names
+
+
+def simulate_sensitivities(parameters: SimulationParameters) -> SensitivityResult:
+    """
+    Simulate the states together with their derivatives with respect to all parameters of the model.
+    The sensitivities S = d(state)/dp follow the linear equations dS/dt = A S + (∂A/∂p) state, which are
+    integrated alongside the state for all parameters at once. Both are advanced exactly from one stored
+    state to the next: the transition of the sensitivities is the lower left block of
+    expm([[A, 0], [∂A/∂p, A]]·dt) (Van Loan, 1978).
+    The states are those of the exact engine, which requires a linear controller evaluated in every step
+    and no disturbances. The gains of the controller are kept fixed, when the model parameters change.
+    :param parameters: Parameters of the simulation
+    :return: The states, their sensitivities and the sensitivities of the time to fall
+    """
+    gains = parameters.controller.get_linear_gains()
+    if gains is None:
+        raise ValueError(f'Sensitivities require a linear controller, '
+                         f'{parameters.controller.get_name()} is not linear')
+    if parameters.is_sampled_control() or parameters.disturbances:
+        raise ValueError('Sensitivities do not support sampled control, measurement delay or disturbances')
+    model = parameters.bicycle_model
+    timestep = parameters.get_output_timestep()
+
+    exact_parameters = copy.copy(parameters)
+    exact_parameters.engine = 'exact'
+    data = run_cached(exact_parameters).get_data_array()
+
+    A = augmented_closed_loop_matrix(model, parameters.bicycle_velocity, gains)
+    derivatives = system_matrix_derivatives(model, np.array([parameters.bicycle_velocity]), augmented=True)[0]
+    parameter_cnt = len(parameter_names)
+    blocks = np.zeros((parameter_cnt, 10, 10))
+    blocks[:, 0:5, 0:5] = A
+    blocks[:, 5:10, 0:5] = derivatives
+    blocks[:, 5:10, 5:10] = A
+    transitions = expm(blocks * timestep)
+    transition = transitions[0, 0:5, 0:5]
+    # (5, P, 5), so the product with a state gives the sensitivity increments of shape (5, P)
+    sensitivity_transition = transitions[:, 5:10, 0:5].transpose(1, 0, 2)
+
+    # the fall is detected like in Simulation.run, the states and sensitivities are frozen afterwards
+    row_cnt = len(data)
+    beyond = np.flatnonzero(np.any(np.abs(data[:, 0:2]) > np.pi / 2, axis=1))
+    last = beyond[0] if len(beyond) else row_cnt - 1
+    states = data[:, [0, 1, 2, 3, 5]]
+    sensitivities = np.zeros((row_cnt, 5, parameter_cnt))
+    for row in range(last):
+        sensitivities[row + 1] = transition @ sensitivities[row] + sensitivity_transition @ states[row]
+    sensitivities[last + 1:] = sensitivities[last]
+
+    result = np.empty((row_cnt, 6, parameter_cnt))
+    result[:, 0:4] = sensitivities[:, 0:4]
+    result[:, 4] = np.einsum('j,tjp->tp', gains[1], sensitivities[:, 0:4])
+    result[:, 5] = sensitivities[:, 4]
+
+    time_to_fall, fall_sensitivities = _time_to_fall(data, result, timestep)
+    return SensitivityResult(timestep, data, result, time_to_fall, fall_sensitivities)
+
+
+def _time_to_fall(data: np.ndarray, sensitivities: np.ndarray, timestep: float) -> tuple[float, np.ndarray]:
+    # the crossing of the fall threshold is interpolated between the last upright and the first fallen state
+    # like in SimulationSummary, t_f = (row - 1 + f) * timestep with the fraction f = (T - a) / (b - a) of the
+    # absolute angles a and b before and after the crossing. the derivative of the interpolated time follows from
+    # the derivatives of a and b, which are the sensitivities of both states times the signs of the angles.
+    parameter_cnt = sensitivities.shape[2]
+    beyond = np.flatnonzero(np.any(np.abs(data[:, 0:2]) > FALL_THRESHOLD, axis=1))
+    if not len(beyond) or beyond[0] == 0:
+        return math.nan, np.full(parameter_cnt, math.nan)
+    row = beyond[0]
+    previous = np.abs(data[row - 1, 0:2])
+    current = np.abs(data[row, 0:2])
+    # the first fallen state is beyond and the last upright state within the threshold, so current > previous
+    fractions = np.where(current > FALL_THRESHOLD, (FALL_THRESHOLD - previous) / (current - previous), np.inf)
+    angle = int(np.argmin(fractions))
+    fraction = fractions[angle]
+
+    previous_sensitivity = np.sign(data[row - 1, angle]) * sensitivities[row - 1, angle]
+    current_sensitivity = np.sign(data[row, angle]) * sensitivities[row, angle]
+    fraction_sensitivity = (-previous_sensitivity - fraction * (current_sensitivity - previous_sensitivity)) / (
+        current[angle] - previous[angle])
+    return float((row - 1 + fraction) * timestep), timestep * fraction_sensitivity
@@ -1,30 +1,134 @@
 import math
+from collections.abc import Sequence
 
 from model.bicycle_controller import BicycleController, NoControlController
 from model.bicycle_model import BicycleModel
 from model.bicycle_state import BicycleState
+from model.disturbances import Disturbance
+from model.integrators import integrators
+
+
+def _is_multiple(duration: float, timestep: float) -> bool:
+    steps = duration / timestep
+    return math.isclose(steps, round(steps), rel_tol=1e-9, abs_tol=1e-9)
 
 
 class SimulationParameters:
+    # available engines for advancing the simulation
+    # numeric: integrate the equations of motion step by step
+    # exact: step with the precomputed transition matrix of the linear closed-loop system
+    engines = ('numeric', 'exact')
+    # available integrators for the numeric engine
+    # euler is the explicit first-order method, the others are provided by model.integrators
+    integrators = ('euler',) + tuple(integrators)
+
     bicycle_model: BicycleModel
     initial_state: BicycleState
     controller: BicycleController
     timestep: float
     stepcount: int
+    engine: str
+    integrator: str
+    # time between two stored states in s, None stores every integration step
+    output_interval: float | None
+    # time between two evaluations of the controller in s, None evaluates it in every integration step
+    control_period: float | None
+    # age of the state in s, which the controller receives, e.g. the reaction time of a rider
+    measurement_delay: float
+    # external torques on the roll and steer axis, see model.disturbances
+    disturbances: list[Disturbance]
+    # seed of the random disturbances, equal seeds reproduce equal runs
+    disturbance_seed: int
 
     def __init__(self,
                  initial_state: BicycleState,
-                 bicycle_model: BicycleModel = BicycleModel(),
+                 bicycle_model: BicycleModel | None = None,
                  bicycle_velocity: float = 4.0,
                  controller: BicycleController = NoControlController(),
                  timestep: float = 0.01,
-                 stepcount: int = 500):
-        self.bicycle_model = bicycle_model
+                 stepcount: int = 500,
+                 engine: str = 'numeric',
+                 integrator: str = 'euler',
+                 output_interval: float | None = None,
+                 control_period: float | None = None,
+                 measurement_delay: float = 0.0,
+                 disturbances: Sequence[Disturbance] = (),
+                 disturbance_seed: int = 0):
+        if engine not in self.engines:
+            raise ValueError(f'Unknown engine "{engine}". Use one of {", ".join(self.engines)}')
+        if integrator not in self.integrators:
+            raise ValueError(f'Unknown integrator "{integrator}". Use one of {", ".join(self.integrators)}')
+        # the default model is created on first use instead of at import time
+        self.bicycle_model = bicycle_model if bicycle_model is not None else BicycleModel.create()
         self.initial_state = initial_state
         self.bicycle_velocity = bicycle_velocity
         self.controller = controller
         self.timestep = timestep
         self.stepcount = stepcount
+        self.engine = engine
+        self.integrator = integrator
+        # the states are stored, the controller is evaluated and the measurements are delayed by whole integration
+        # steps, so the intervals must be multiples of the timestep
+        if output_interval is not None and (output_interval <= 0 or not _is_multiple(output_interval, timestep)):
+            raise ValueError(f'The output interval {output_interval} must be a positive multiple of the '
+                             f'timestep {timestep}')
+        self.output_interval = output_interval
+        if control_period is not None and (control_period <= 0 or not _is_multiple(control_period, timestep)):
+            raise ValueError(f'The control period {control_period} must be a positive multiple of the '
+                             f'timestep {timestep}')
+        if measurement_delay < 0 or not _is_multiple(measurement_delay, timestep):
+            raise ValueError(f'The measurement delay {measurement_delay} must be a multiple of the timestep '
+                             f'{timestep} and must not be negative')
+        self.control_period = control_period
+        self.measurement_delay = measurement_delay
+        self.disturbances = list(disturbances)
+        self.disturbance_seed = disturbance_seed
+
+    def get_output_stride(self) -> int:
+        """
+        Get the number of integration steps between two stored states
+        """
+        if self.output_interval is None:
+            return 1
+        return round(self.output_interval / self.timestep)
+
+    def get_output_timestep(self) -> float:
+        """
+        Get the time between two stored states in s
+        """
+        return self.timestep * self.get_output_stride()
+
+    def get_output_count(self) -> int:
+        """
+        Get the number of stored states, which are the initial state and every output_stride-th step after it
+        """
+        return (self.stepcount - 1) // self.get_output_stride() + 1
+
+    def get_control_stride(self) -> int:
+        """
+        Get the number of integration steps between two evaluations of the controller
+        """
+        if self.control_period is None:
+            return 1
+        return round(self.control_period / self.timestep)
+
+    def get_control_period(self) -> float:
+        """
+        Get the time between two evaluations of the controller in s
+        """
+        return self.timestep * self.get_control_stride()
+
+    def get_delay_steps(self) -> int:
+        """
+        Get the measurement delay as a number of integration steps
+        """
+        return round(self.measurement_delay / self.timestep)
+
+    def is_sampled_control(self) -> bool:
+        """
+        Check, if the controller runs slower than the integration or on delayed states
+        """
+        return self.get_control_stride() > 1 or self.get_delay_steps() > 0
 
     def get_description(self) -> dict[str, str]:
         description = {'bicycle_model': "default" if self.bicycle_model.is_default() else "custom",
@@ -33,7 +137,19 @@ class SimulationParameters:
                        'bicycle_velocity': f"{self.bicycle_velocity} m/s",
                        'controller': self.controller.get_name(),
                        'timestep': f"{round(self.timestep * 1000, 3)}ms",
-                       'stepcount': str(self.stepcount)}
+                       'stepcount': str(self.stepcount),
+                       'engine': self.engine,
+                       'integrator': self.integrator}
+        if self.get_output_stride() > 1:
+            description['output_interval'] = f"{round(self.get_output_timestep() * 1000, 3)}ms"
+        if self.get_control_stride() > 1:
+            description['control_period'] = f"{round(self.get_control_stride() * self.timestep * 1000, 3)}ms"
+        if self.get_delay_steps() > 0:
+            description['measurement_delay'] = f"{round(self.get_delay_steps() * self.timestep * 1000, 3)}ms"
+        if self.disturbances:
+            description['disturbances'] = ' '.join(disturbance.get_spec() for disturbance in self.disturbances)
+            description['disturbance_seed'] = str(self.disturbance_seed)
+
 
         # add non-default parameters to description if they exist
         if not self.bicycle_model.is_default():
@@ -1,3 +1,4 @@
+import json
 from abc import abstractmethod, ABC
 from pathlib import Path
 
@@ -45,12 +46,21 @@ class SimulationResult(AbstractSimulationResult, BikeAnimation):
     # order: phi, delta, phi_dot, delta_dot, T_delta, psi
     # order: roll, steer, roll_rate, steer_rate, steer_torque, heading
     data: np.ndarray
-    metadata: dict[str, str] = {}
+    metadata: dict[str, str]
     timestep: float
 
-    def __init__(self, timestep: float, sample_cnt: int):
+    def __init__(self, timestep: float, sample_cnt: int, path: Path | None = None):
+        """
+        :param timestep: The timestep of the simulation in s
+        :param sample_cnt: The number of states
+        :param path: Optional .npy file which backs the data on disk instead of holding it in memory
+        """
         self.timestep = timestep
-        self.data = np.zeros((sample_cnt, 6))
+        self.metadata = {}
+        if path is None:
+            self.data = np.zeros((sample_cnt, 6))
+        else:
+            self.data = np.lib.format.open_memmap(path, mode='w+', shape=(sample_cnt, 6))
 
     def set_metadata_field(self, key: str, value: str):
         self.metadata[key] = value
@@ -67,6 +77,9 @@ class SimulationResult(AbstractSimulationResult, BikeAnimation):
     def get_frame_delay_ms(self) -> int:
         return round(self.get_timestep() * 1000)
 
+    def get_frame_time_ms(self) -> float:
+        return float(self.get_timestep()) * 1000
+
     def get_duration(self) -> int:
         return self.data.shape[0]
 
@@ -94,16 +107,86 @@ class SimulationResult(AbstractSimulationResult, BikeAnimation):
 
         np.savez(path, data=self.data, timestep=self.timestep, **metadata_fields)
 
+    def save_compact(self, path: Path, error_bound: float | None = None) -> np.ndarray:
+        """
+        Save the SimulationResult to a compressed file, which is usually several times smaller than save_to.
+        The states after a fall are all equal, so only the first of them is stored together with the
+        number of rows. Without an error bound the columns are stored as float32. With an error bound the
+        columns are quantized to integer multiples of twice the bound and the differences between
+        consecutive states are stored, which are small numbers for slowly varying columns like the heading.
+        :param path: Path to save the file to
+        :param error_bound: Maximum absolute error of every stored value, None to store float32 values
+        :return: Maximum absolute round-trip error per column, in the order of the columns of the data
+        """
+        data = np.asarray(self.data)
+        # drop the constant tail after a fall, except for its first row
+        changing = np.flatnonzero(np.any(data != data[-1], axis=1)) if len(data) else np.array([], dtype=int)
+        stored = data[:changing[-1] + 2] if len(changing) else data[:1]
+
+        metadata_fields = {}
+        for key, value in self.metadata.items():
+            metadata_fields["md_" + key] = value
+
+        if error_bound is None:
+            values = stored.astype(np.float32)
+            restored = values.astype(float)
+            encoded = {'format': 'compact-float32', 'data': values}
+        else:
+            if error_bound <= 0:
+                raise ValueError("The error bound must be positive")
+            scale = 2 * error_bound
+            if not np.all(np.isfinite(stored)) or np.max(np.abs(stored), initial=0) / scale >= 2 ** 62:
+                raise ValueError(f"The data can not be quantized with an error bound of {error_bound}")
+            quantized = np.rint(stored / scale).astype(np.int64)
+            deltas = np.diff(quantized, axis=0, prepend=np.zeros((1, 6), dtype=np.int64))
+            # use the smallest integer type which holds all differences
+            for dtype in (np.int8, np.int16, np.int32, np.int64):
+                if np.all(np.abs(deltas) <= np.iinfo(dtype).max):
+                    deltas = deltas.astype(dtype)
+                    break
+            restored = quantized * scale
+            encoded = {'format': 'compact-quantized', 'deltas': deltas, 'scale': scale}
+
+        error = np.max(np.abs(restored - stored), axis=0, initial=0.0)
+        np.savez_compressed(path, timestep=self.timestep, sample_cnt=data.shape[0], max_error=error,
+                            **encoded, **metadata_fields)
+        return error
+
     @staticmethod
-    def load_from(path: Path) -> "SimulationResult":
+    def get_sidecar_path(path: Path) -> Path:
+        """
+        Get the path of the file which stores timestep and metadata of a disk-backed result
+        """
+        return path.with_suffix('.json')
+
+    def save_sidecar(self, path: Path):
         """
-        Load a SimulationResult from a file
+        Write timestep and metadata of a disk-backed result next to its .npy file and flush the data
+        :param path: Path of the .npy file
+        """
+        if isinstance(self.data, np.memmap):
+            self.data.flush()
+        with open(self.get_sidecar_path(path), 'w') as sidecar:
+            json.dump({'timestep': float(self.timestep), 'metadata': self.metadata}, sidecar, indent=2)
+
+    @staticmethod
+    def load_from(path: Path | str) -> "SimulationResult":
+        """
+        Load a SimulationResult from a file.
+        Disk-backed results (.npy) are memory-mapped, so only the accessed frames are read.
         :param path: Path to the file to load
         :return: A SimulationResult object
         """
+        path = Path(path)
+        if path.suffix == '.npy':
+            return SimulationResult._load_memmap(path)
+
         file_contents = np.load(path)
         timestep = file_contents["timestep"]
-        data = file_contents["data"]
+        if "format" in file_contents.files:
+            data = SimulationResult._decode_compact(file_contents)
+        else:
+            data = file_contents["data"]
         metadata = {key[3:]: str(file_contents[key]) for key in file_contents.files if key.startswith("md_")}
 
         # check dimensions of the data
@@ -113,4 +196,35 @@ class SimulationResult(AbstractSimulationResult, BikeAnimation):
         result = SimulationResult(timestep, data.shape[0])
         result.data = data
         result.metadata = metadata
-        return result
\ No newline at end of file
+        return result
+
+    @staticmethod
+    def _decode_compact(file_contents) -> np.ndarray:
+        file_format = str(file_contents["format"])
+        if file_format == 'compact-float32':
+            stored = file_contents["data"].astype(float)
+        elif file_format == 'compact-quantized':
+            stored = np.cumsum(file_contents["deltas"], axis=0, dtype=np.int64) * float(file_contents["scale"])
+        else:
+            raise IOError(f"Unknown format {file_format}")
+
+        # repeat the last stored state for the constant tail after a fall
+        sample_cnt = int(file_contents["sample_cnt"])
+        if len(stored) < sample_cnt:
+            stored = np.concatenate((stored, np.repeat(stored[-1:], sample_cnt - len(stored), axis=0)))
+        return stored
+
+    @staticmethod
+    def _load_memmap(path: Path) -> "SimulationResult":
+        data = np.load(path, mmap_mode='r')
+        with open(SimulationResult.get_sidecar_path(path)) as sidecar:
+            sidecar_contents = json.load(sidecar)
+
+        # check dimensions of the data
+        if len(data.shape) != 2 or data.shape[1] != 6:
+            raise IOError(f"Data array in {path} is not of shape (n, 6)")
+
+        result = SimulationResult(sidecar_contents['timestep'], 0)
+        result.data = data
+        result.metadata = {key: str(value) for key, value in sidecar_contents['metadata'].items()}
+        return result
@@ -0,0 +1,162 @@
+import math
+from dataclasses import dataclass, asdict
+
+import numpy as np
+
+# the bicycle has fallen over, if the roll or the steering angle is larger than this threshold
+FALL_THRESHOLD = np.pi / 2
+# the bicycle is settled, while the roll and the steering angle stay below this threshold
+SETTLING_TOLERANCE = math.radians(1)
+
+
+@dataclass
+class SimulationSummary:
+    # time in s at which the roll or steering angle crosses 90 degrees, nan if the bicycle did not fall over
+    time_to_fall: float
+    # maximum absolute values in rad and Nm
+    peak_roll: float
+    peak_steer: float
+    peak_steer_torque: float
+    # time in s after which roll and steering angle stay within the settling tolerance, nan if they do not settle
+    settling_time: float
+    # heading at the end of the simulation or at the fall in rad
+    final_heading: float
+
+    def as_dict(self) -> dict[str, float]:
+        return asdict(self)
+
+
+class SummaryAccumulator:
+    """
+    Computes a SimulationSummary online from the blocks of states of a simulation,
+    so the trajectory never has to be held in memory at once.
+    """
+    timestep: float
+    settling_tolerance: float
+
+    def __init__(self, timestep: float, settling_tolerance: float = SETTLING_TOLERANCE):
+        """
+        :param timestep: Time between two consecutive states in s
+        :param settling_tolerance: Maximum absolute roll and steering angle of a settled bicycle in rad
+        """
+        self.timestep = timestep
+        self.settling_tolerance = settling_tolerance
+        self.row_cnt = 0
+        self.last_row: np.ndarray | None = None
+        self.time_to_fall = math.nan
+        self.peaks = np.zeros(3)
+        # index of the first state after which the bicycle stays within the tolerance
+        self.settled_from = 0
+
+    def add(self, chunk: np.ndarray):
+        """
+        Add the next block of states in the layout of SimulationResult.
+        States after the first one beyond the fall threshold are ignored.
+        """
+        if len(chunk) == 0 or not math.isnan(self.time_to_fall):
+            return
+        angles = np.abs(chunk[:, 0:2])
+        fallen = np.flatnonzero(np.any(angles > FALL_THRESHOLD, axis=1))
+        if len(fallen):
+            chunk = chunk[:fallen[0] + 1]
+            angles = angles[:fallen[0] + 1]
+            self.time_to_fall = self._interpolate_fall(fallen[0], chunk)
+
+        self.peaks = np.maximum(self.peaks, np.max(np.abs(chunk[:, [0, 1, 4]]), axis=0))
+        outside = np.flatnonzero(np.any(angles > self.settling_tolerance, axis=1))
+        if len(outside):
+            self.settled_from = self.row_cnt + outside[-1] + 1
+        self.row_cnt += len(chunk)
+        self.last_row = chunk[-1].copy()
+
+    def _interpolate_fall(self, index: int, chunk: np.ndarray) -> float:
+        # linear interpolation of the threshold crossing between the last upright and the first fallen state
+        previous = chunk[index - 1] if index > 0 else self.last_row
+        current = chunk[index]
+        if previous is None:
+            return 0.0
+        fractions = []
+        for column in (0, 1):
+            before, after = abs(previous[column]), abs(current[column])
+            if after > FALL_THRESHOLD:
+                fractions.append((FALL_THRESHOLD - before) / (after - before) if after != before else 1.0)
+        return float((self.row_cnt + index - 1 + min(fractions)) * self.timestep)
+
+    def get_summary(self) -> SimulationSummary:
+        if self.last_row is None:
+            raise ValueError("No states have been added")
+        fallen = not math.isnan(self.time_to_fall)
+        settled = not fallen and self.settled_from < self.row_cnt
+        return SimulationSummary(time_to_fall=self.time_to_fall,
+                                 peak_roll=float(self.peaks[0]),
+                                 peak_steer=float(self.peaks[1]),
+                                 peak_steer_torque=float(self.peaks[2]),
+                                 settling_time=float(self.settled_from * self.timestep) if settled else math.nan,
+                                 final_heading=float(self.last_row[5]))
+
+
+def summarize_trajectories(data: np.ndarray, timestep: float,
+                           settling_tolerance: float = SETTLING_TOLERANCE) -> dict[str, np.ndarray]:
+    """
+    Compute the summary metrics of many trajectories at once, like SummaryAccumulator does for a single one
+    :param data: Trajectories of shape (N, T, 6) in the layout of SimulationResult. States after the first one
+                 beyond the fall threshold are ignored, so they do not have to be frozen.
+    :param timestep: Time between two consecutive states in s
+    :param settling_tolerance: Maximum absolute roll and steering angle of a settled bicycle in rad
+    :return: One array of shape (N,) for every field of SimulationSummary
+    """
+    # the columns are copied, because they are overwritten
+    metrics, last = summarize_columns(data[:, :, 0].copy(), data[:, :, 1].copy(), data[:, :, 4].copy(), timestep,
+                                      settling_tolerance)
+    metrics['final_heading'] = data[np.arange(len(data)), last, 5]
+    return metrics
+
+
+def summarize_columns(roll: np.ndarray, steer: np.ndarray, steer_torque: np.ndarray, timestep: float,
+                      settling_tolerance: float = SETTLING_TOLERANCE) -> tuple[dict[str, np.ndarray], np.ndarray]:
+    """
+    Like summarize_trajectories for the columns of the trajectories, each of shape (N, T).
+    Contiguous columns are processed considerably faster than the interleaved layout of SimulationResult.
+    The columns are overwritten.
+    :return: All metrics except for the final heading and the index of the last state which is taken into
+             account, i.e. of the fall or of the end, of shape (N,)
+    """
+    member_cnt, row_cnt = roll.shape
+    members = np.arange(member_cnt)
+    abs_roll = np.abs(roll, out=roll)
+    abs_steer = np.abs(steer, out=steer)
+    angle = np.maximum(abs_roll, abs_steer)
+    beyond = angle > FALL_THRESHOLD
+    fallen = np.any(beyond, axis=1)
+    last = np.where(fallen, np.argmax(beyond, axis=1), row_cnt - 1)
+
+    # linear interpolation of the threshold crossing between the last upright and the first fallen state
+    time_to_fall = np.full(member_cnt, math.nan)
+    previous_row = np.maximum(last - 1, 0)
+    previous = np.stack([abs_roll[members, previous_row], abs_steer[members, previous_row]], axis=1)
+    current = np.stack([abs_roll[members, last], abs_steer[members, last]], axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fractions = np.where(current != previous, (FALL_THRESHOLD - previous) / (current - previous), 1.0)
+    fractions = np.min(np.where(current > FALL_THRESHOLD, fractions, np.inf), axis=1)
+    time_to_fall[fallen] = ((last - 1 + fractions) * timestep)[fallen]
+    time_to_fall[fallen & (last == 0)] = 0.0
+
+    abs_steer_torque = np.abs(steer_torque, out=steer_torque)
+    peaks = [np.max(column, axis=1) for column in (abs_roll, abs_steer, abs_steer_torque)]
+    if np.any(fallen):
+        # the peaks of fallen bicycles only include the states up to the fall
+        after_fall = np.arange(row_cnt) > last[fallen, np.newaxis]
+        for peak, column in zip(peaks, (abs_roll, abs_steer, abs_steer_torque)):
+            peak[fallen] = np.max(np.where(after_fall, 0.0, column[fallen]), axis=1)
+
+    # index of the first state after which the bicycle stays within the tolerance,
+    # only bicycles which did not fall over can settle
+    outside = angle > settling_tolerance
+    settled_from = np.where(np.any(outside, axis=1), row_cnt - np.argmax(outside[:, ::-1], axis=1), 0)
+    settled = ~fallen & (settled_from < row_cnt)
+
+    return {'time_to_fall': time_to_fall,
+            'peak_roll': peaks[0],
+            'peak_steer': peaks[1],
+            'peak_steer_torque': peaks[2],
+            'settling_time': np.where(settled, settled_from * timestep, math.nan)}, last
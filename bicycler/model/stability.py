@@ -0,0 +1,124 @@
+from dataclasses import dataclass
+from typing import Callable
+
+import numpy as np
+
+from model.bicycle_model import BicycleModel
+from model.linear_system import stacked_system_matrices
+
+# imaginary parts below this threshold are considered to belong to real eigenvalues
+IMAGINARY_TOLERANCE = 1e-9
+
+
+@dataclass
+class CriticalSpeed:
+    # velocity in m/s at which the real part of an eigenvalue crosses zero
+    velocity: float
+    # 'weave' for an oscillating mode, 'capsize' for a non-oscillating mode
+    mode: str
+    # True if the bicycle becomes stable when the velocity increases past this speed
+    stabilizing: bool
+
+
+@dataclass
+class StabilityAnalysis:
+    velocities: np.ndarray
+    # eigenvalues of shape (N, 4), sorted by their real part in descending order
+    eigenvalues: np.ndarray
+    critical_speeds: list[CriticalSpeed]
+    # velocity intervals (v_min, v_max) in which all eigenvalues have a negative real part
+    stable_intervals: list[tuple[float, float]]
+
+    def get_weave_speeds(self) -> list[float]:
+        return [speed.velocity for speed in self.critical_speeds if speed.mode == 'weave']
+
+    def get_capsize_speeds(self) -> list[float]:
+        return [speed.velocity for speed in self.critical_speeds if speed.mode == 'capsize']
+
+
+def eigenvalues(bicycle_model: BicycleModel,
+                velocities: np.ndarray,
+                gains: np.ndarray | None = None) -> np.ndarray:
+    """
+    Compute the eigenvalues of the linearized system for many velocities with a single call to np.linalg.eigvals
+    :return: Eigenvalues of shape (N, 4), sorted by their real part in descending order
+    """
+    values = np.linalg.eigvals(stacked_system_matrices(bicycle_model, velocities, gains))
+    order = np.argsort(-values.real, axis=1, kind='stable')
+    return np.take_along_axis(values, order, axis=1)
+
+
+def _find_root(function: Callable[[float], float], a: float, b: float, fa: float, fb: float,
+               xtol: float = 1e-12, max_iterations: int = 100) -> float:
+    """
+    Find the root of a function inside the bracket [a, b] with the Illinois variant of the regula falsi.
+    The bracket is kept during the iteration, so the method always converges.
+    """
+    side = 0
+    for _ in range(max_iterations):
+        c = (a * fb - b * fa) / (fb - fa)
+        fc = function(c)
+        if fc == 0.0 or abs(b - a) < xtol:
+            return c
+        if np.sign(fc) == np.sign(fb):
+            b, fb = c, fc
+            # halve the weight of a side which is retained twice in a row
+            if side == -1:
+                fa /= 2
+            side = -1
+        else:
+            a, fa = c, fc
+            if side == 1:
+                fb /= 2
+            side = 1
+        if abs(b - a) < xtol:
+            break
+    return (a + b) / 2
+
+
+def analyze_stability(bicycle_model: BicycleModel,
+                      velocities: np.ndarray,
+                      gains: np.ndarray | None = None) -> StabilityAnalysis:
+    """
+    Compute the eigenvalues over a velocity grid and locate the critical speeds.
+    Sign changes of the largest real part on the grid bracket the critical speeds,
+    which are then refined by root finding instead of refining the grid.
+    :param bicycle_model: The bicycle model
+    :param velocities: Increasing velocity grid of shape (N,)
+    :param gains: Optional linear state feedback of shape (2, 4), see BicycleController.get_linear_gains
+    :return: The eigenvalues, critical speeds and stable velocity intervals
+    """
+    velocities = np.asarray(velocities, dtype=float)
+    values = eigenvalues(bicycle_model, velocities, gains)
+    max_real = values[:, 0].real
+
+    def max_real_part(v: float) -> float:
+        return eigenvalues(bicycle_model, np.array([v]), gains)[0, 0].real
+
+    critical_speeds = []
+    crossings = np.flatnonzero(np.sign(max_real[:-1]) != np.sign(max_real[1:]))
+    for i in crossings:
+        if max_real[i] == 0.0:
+            continue
+        if max_real[i + 1] == 0.0:
+            speed = velocities[i + 1]
+        else:
+            speed = _find_root(max_real_part, velocities[i], velocities[i + 1], max_real[i], max_real[i + 1])
+        # the mode is oscillating, if the eigenvalue at the crossing has an imaginary part
+        critical_value = eigenvalues(bicycle_model, np.array([speed]), gains)[0, 0]
+        mode = 'weave' if abs(critical_value.imag) > IMAGINARY_TOLERANCE else 'capsize'
+        critical_speeds.append(CriticalSpeed(float(speed), mode, bool(max_real[i] > 0)))
+
+    # collect the intervals between the crossings in which the bicycle is stable
+    stable_intervals = []
+    lower = velocities[0] if max_real[0] < 0 else None
+    for speed in critical_speeds:
+        if speed.stabilizing:
+            lower = speed.velocity
+        elif lower is not None:
+            stable_intervals.append((float(lower), speed.velocity))
+            lower = None
+    if lower is not None:
+        stable_intervals.append((float(lower), float(velocities[-1])))
+
+    return StabilityAnalysis(velocities, values, critical_speeds, stable_intervals)
@@ -0,0 +1,298 @@
+import itertools
+import math
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field, fields
+from pathlib import Path
+
+import numpy as np
+
+from model.bicycle_controller import BicycleController, create_controller, controller_types
+from model.bicycle_model import BicycleModel
+from model.bicycle_state import BicycleState
+from model.linear_ensemble import LinearEnsemble
+from model.result_archive import ArchiveWriter
+from model.simulation import Simulation
+from model.simulation_parameters import SimulationParameters
+from model.simulation_result import SimulationResult
+from model.simulation_summary import SimulationSummary, SummaryAccumulator
+
+# summary metrics which are stored for every run of a sweep
+metric_names = tuple(field.name for field in fields(SimulationSummary))
+
+
+@dataclass
+class SweepRun:
+    velocity: float
+    # initial roll and steering angle in degree
+    roll: float
+    steer: float
+    controller: str = 'none'
+    gains: dict[str, float] = field(default_factory=dict)
+    model_parameters: dict[str, float] = field(default_factory=dict)
+
+    def get_simulation_parameters(self, timestep: float, stepcount: int,
+                                  engine: str = 'numeric', integrator: str = 'euler') -> SimulationParameters:
+        init_state = BicycleState(math.radians(self.roll), math.radians(self.steer), 0, 0, 0, 0)
+        model = BicycleModel.create(**self.model_parameters)
+        return SimulationParameters(init_state, model, self.velocity,
+                                    create_controller(self.controller, model, **self.gains), timestep, stepcount,
+                                    engine, integrator)
+
+
+def expand_grid(velocities: list[float],
+                rolls: list[float],
+                steers: list[float],
+                controllers: list[str],
+                gains: dict[str, list[float]] | None = None,
+                model_parameters: dict[str, list[float]] | None = None) -> list[SweepRun]:
+    """
+    Expand the cartesian product of all parameter values into a list of runs.
+    Gains are only varied for the controllers which use them, so no run is duplicated.
+    """
+    gains = gains or {}
+    model_parameters = model_parameters or {}
+    model_names = list(model_parameters)
+
+    runs = []
+    for controller in controllers:
+        gain_names = [name for name in gains if name in controller_types[controller][1]]
+        for velocity, roll, steer, gain_values, model_values in itertools.product(
+                velocities, rolls, steers,
+                itertools.product(*[gains[name] for name in gain_names]),
+                itertools.product(*[model_parameters[name] for name in model_names])):
+            runs.append(SweepRun(velocity, roll, steer, controller,
+                                 dict(zip(gain_names, gain_values)),
+                                 dict(zip(model_names, model_values))))
+    return runs
+
+
+def trajectory_metrics(data: np.ndarray, timestep: float) -> dict[str, float]:
+    """
+    Compute the summary metrics of one simulated trajectory in the layout of SimulationResult
+    """
+    summary = SummaryAccumulator(timestep)
+    summary.add(data)
+    return summary.get_summary().as_dict()
+
+
+def _summarize_group(indices: list[int], runs: list[SweepRun], timestep: float, stepcount: int, engine: str,
+                     integrator: str) -> dict[str, np.ndarray] | list[tuple[int, dict[str, float], None, str]]:
+    # executed in the worker processes, the runs only differ in their initial state
+    try:
+        parameters = runs[0].get_simulation_parameters(timestep, stepcount, engine, integrator)
+        if parameters.controller.get_linear_gains() is not None:
+            initial_states = np.zeros((len(runs), 4))
+            initial_states[:, 0] = np.radians([run.roll for run in runs])
+            initial_states[:, 1] = np.radians([run.steer for run in runs])
+            return LinearEnsemble(parameters).summarize(initial_states)
+    except Exception:
+        # the runs report the error, when they are simulated
+        pass
+    return _run_chunk(indices, runs, timestep, stepcount, engine, integrator, False)
+
+
+def _run_chunk(indices: list[int], runs: list[SweepRun], timestep: float, stepcount: int, engine: str,
+               integrator: str,
+               keep_trajectories: bool) -> list[tuple[int, dict[str, float], SimulationResult | None, str]]:
+    # executed in the worker processes, a failing run must not abort the rest of the chunk
+    results = []
+    for index, run in zip(indices, runs):
+        try:
+            simulation = Simulation(run.get_simulation_parameters(timestep, stepcount, engine, integrator))
+            if keep_trajectories:
+                simulation.run()
+                result = simulation.get_result()
+                results.append((index, trajectory_metrics(result.get_data_array(), timestep), result, ''))
+            else:
+                # only the metrics are needed, so the trajectory is never stored
+                results.append((index, simulation.summarize().as_dict(), None, ''))
+        except Exception as e:
+            results.append((index, {}, None, f'{type(e).__name__}: {e}'))
+    return results
+
+
+class Sweep:
+    """
+    Runs many simulations in a pool of worker processes and streams one record of parameters
+    and summary metrics per run into a single memory-mapped .npy file as the runs complete.
+    """
+    # maximum number of characters of the error of a failed run, which are stored in the output
+    error_length = 256
+
+    runs: list[SweepRun]
+    timestep: float
+    stepcount: int
+    engine: str
+    integrator: str
+
+    def __init__(self, runs: list[SweepRun], timestep: float = 0.01, stepcount: int = 500,
+                 engine: str = 'numeric', integrator: str = 'euler'):
+        self.runs = runs
+        self.timestep = timestep
+        self.stepcount = stepcount
+        self.engine = engine
+        self.integrator = integrator
+
+    def get_parameter_columns(self) -> dict[str, np.ndarray]:
+        gain_names = sorted({name for run in self.runs for name in run.gains})
+        model_names = sorted({name for run in self.runs for name in run.model_parameters})
+        columns = {'velocity': np.array([run.velocity for run in self.runs], dtype=float),
+                   'roll': np.array([run.roll for run in self.runs], dtype=float),
+                   'steer': np.array([run.steer for run in self.runs], dtype=float),
+                   'controller': np.array([run.controller for run in self.runs], dtype=str)}
+        for name in gain_names:
+            columns['gain_' + name] = np.array([run.gains.get(name, math.nan) for run in self.runs], dtype=float)
+        for name in model_names:
+            columns['model_' + name] = np.array(
+                [run.model_parameters.get(name, BicycleModel.default_parameters[name]) for run in self.runs],
+                dtype=float)
+        return columns
+
+    def _create_table(self, output: Path, keep_trajectories: bool) -> np.memmap:
+        """
+        Create the output file with one record per run of its parameters, its metrics, its error, whether it has
+        completed and optionally its trajectory. The records are written in place as the runs complete.
+        """
+        run_cnt = len(self.runs)
+        columns = self.get_parameter_columns()
+        columns['timestep'] = np.full(run_cnt, self.timestep)
+        columns['stepcount'] = np.full(run_cnt, self.stepcount)
+        columns['engine'] = np.full(run_cnt, self.engine)
+        columns['integrator'] = np.full(run_cnt, self.integrator)
+        dtype = [(name, column.dtype) for name, column in columns.items()]
+        dtype += [(name, float) for name in metric_names]
+        dtype += [('error', f'U{self.error_length}'), ('completed', bool)]
+        if keep_trajectories:
+            dtype.append(('trajectory', float, (self.stepcount, 6)))
+
+        table = np.lib.format.open_memmap(output, mode='w+', dtype=np.dtype(dtype), shape=(run_cnt,))
+        for name, column in columns.items():
+            table[name] = column
+        for name in metric_names:
+            table[name] = math.nan
+        return table
+
+    def _group_by_superposition(self) -> tuple[list[list[int]], list[int]]:
+        """
+        Find the groups of runs with a linear controller, which only differ in their initial state, so their
+        metrics can be computed by superposition instead of simulating every run, see LinearEnsemble
+        :return: The indices of the runs of every group and the indices of the runs, which have to be simulated
+        """
+        groups = {}
+        for index, run in enumerate(self.runs):
+            key = (run.velocity, run.controller, tuple(sorted(run.gains.items())),
+                   tuple(sorted(run.model_parameters.items())))
+            groups.setdefault(key, []).append(index)
+
+        linear_groups = []
+        remaining = []
+        for (_, controller, _, _), indices in groups.items():
+            # only controllers, which provide linear gains, are candidates, the gains are checked by the worker
+            controller_type = controller_types.get(controller, (BicycleController,))[0]
+            linear = controller_type.get_linear_gains is not BicycleController.get_linear_gains
+            # the basis of the superposition costs four simulations
+            if linear and len(indices) > 4:
+                linear_groups.append(indices)
+            else:
+                remaining.extend(indices)
+        return linear_groups, sorted(remaining)
+
+    def run(self, output: Path, workers: int | None = None, chunk_size: int = 64,
+            keep_trajectories: bool = False, verbose: bool = False,
+            archive: Path | None = None, superposition: bool = True) -> dict[str, np.ndarray]:
+        """
+        Run all simulations of the sweep and write the results
+        :param output: Output .npy file of a structured array with one record per run. It holds the parameters,
+                       the metrics, the error of a failed run and whether the run has completed, and is written
+                       as the chunks complete, so an interrupted sweep keeps all completed runs.
+                       Read it with np.load(output, mmap_mode='r') and select the columns by name.
+        :param workers: Number of worker processes, defaults to the number of cores
+        :param chunk_size: Number of runs which are sent to a worker at once
+        :param keep_trajectories: Also store the trajectory of shape (stepcount, 6) of every run in the field
+                                  trajectory of its record
+        :param verbose: Print the progress
+        :param archive: Optional archive file, to store the trajectories of all runs together with an index of
+                        their parameters and metrics, see ResultArchive
+        :param superposition: Compute the metrics of runs with a linear controller by superposition, if only
+                              the metrics are stored
+        :return: The columns written to the output file without the trajectories
+        """
+        run_cnt = len(self.runs)
+        table = self._create_table(output, keep_trajectories)
+        # the index of the archive is written on exit, also when the sweep is interrupted
+        with ArchiveWriter(archive) if archive is not None else nullcontext() as writer:
+            self._run_chunks(table, writer, workers, chunk_size, keep_trajectories, verbose, superposition)
+        columns = {name: np.array(table[name]) for name in table.dtype.names if name != 'trajectory'}
+        table.flush()
+        del table
+        return columns
+
+    def _run_chunks(self, table: np.ndarray, writer: ArchiveWriter | None, workers: int | None, chunk_size: int,
+                    keep_trajectories: bool, verbose: bool, superposition: bool):
+        """
+        Compute all runs in the worker pool or by superposition and write them to the table and the archive
+        """
+        run_cnt = len(self.runs)
+        linear_groups, remaining = [], list(range(run_cnt))
+        if superposition and not keep_trajectories and writer is None:
+            linear_groups, remaining = self._group_by_superposition()
+        completed = 0
+
+        chunks = [remaining[start:start + chunk_size] for start in range(0, len(remaining), chunk_size)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_summarize_group, indices, [self.runs[index] for index in indices],
+                                       self.timestep, self.stepcount, self.engine, self.integrator): indices
+                       for indices in linear_groups}
+            futures.update({executor.submit(_run_chunk, indices, [self.runs[index] for index in indices],
+                                            self.timestep, self.stepcount, self.engine, self.integrator,
+                                            keep_trajectories or writer is not None): indices
+                            for indices in chunks})
+            for future in as_completed(futures):
+                indices = futures[future]
+                count = len(indices)
+                try:
+                    results = future.result()
+                except Exception as e:
+                    # the worker itself failed, e.g. because it was killed
+                    results = [(index, {}, None, repr(e)) for index in indices]
+                if isinstance(results, dict):
+                    # the columns of the metrics of a group, which was computed by superposition
+                    for name, values in results.items():
+                        table[name][indices] = values
+                    table['completed'][indices] = True
+                    results = []
+                for index, metrics, result, error in results:
+                    for name, value in metrics.items():
+                        table[name][index] = value
+                    table['error'][index] = error
+                    table['completed'][index] = True
+                    if result is not None and keep_trajectories:
+                        table['trajectory'][index] = result.get_data_array()
+                    if writer is not None:
+                        self._add_to_archive(writer, index, metrics, result, error)
+                # write the completed records to disk
+                table.flush()
+                completed += count
+                if verbose:
+                    print(f'Completed {completed}/{run_cnt} runs')
+
+    def _add_to_archive(self, writer: ArchiveWriter, index: int, metrics: dict[str, float],
+                        result: SimulationResult | None, error: str):
+        """
+        Add a run to the archive, with the column run holding its index in the sweep,
+        because the runs are added in the order in which they complete
+        """
+        run = self.runs[index]
+        if result is not None:
+            parameters = run.get_simulation_parameters(self.timestep, self.stepcount, self.engine, self.integrator)
+            writer.add(result, parameters, SimulationSummary(**metrics), run=index)
+            return
+        # the parameters of a failed run may be invalid, so they are described without creating the simulation
+        controller_type, default_gains = controller_types.get(run.controller, (None, {}))
+        columns = {'run': index, 'velocity': run.velocity, 'roll': run.roll, 'steer': run.steer,
+                   'controller': controller_type.__name__ if controller_type is not None else run.controller,
+                   'timestep': self.timestep}
+        columns.update({'gain_' + name: value for name, value in {**default_gains, **run.gains}.items()})
+        columns.update({'model_' + name: value for name, value in run.model_parameters.items()})
+        writer.add_failure(error, **columns)
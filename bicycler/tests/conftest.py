@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the modules are imported relative to the bicycler directory, like when running python bicycler
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
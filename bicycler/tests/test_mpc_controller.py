@@ -0,0 +1,18 @@
+import numpy as np
+
+from model import linear_system
+from model.bicycle_controller import MPCController
+
+
+def test_unconstrained_mpc_stabilizes_all_velocities():
+    controller = MPCController()
+    for velocity in np.linspace(0.5, 10, 20):
+        H, F, _ = controller.get_qp_matrices(velocity)
+        # the first torque of the unconstrained solution U = -H⁻¹Fx₀ is the linear control law u = -Kx₀
+        K = np.linalg.solve(H, F)[0]
+        augmented = np.zeros((5, 5))
+        augmented[:4, :4] = linear_system.system_matrix(controller.bicycle_model, velocity)
+        augmented[:4, 4] = linear_system.input_matrix()[:, 1]
+        discrete = linear_system.expm(augmented * controller.prediction_timestep)
+        closed_loop = discrete[:4, :4] - np.outer(discrete[:4, 4], K)
+        assert np.max(np.abs(np.linalg.eigvals(closed_loop))) < 1, f'unstable at {velocity} m/s'
@@ -13,6 +13,13 @@ class BikeAnimation(ABC):
     def get_frame_delay_ms(self) -> int:
         pass
 
+    def get_frame_time_ms(self) -> float:
+        """
+        Get the exact time between two frames, which may be less than a millisecond
+        :return: The time between two frames in ms
+        """
+        return self.get_frame_delay_ms()
+
     @abstractmethod
     def get_duration(self) -> int:
         """
@@ -23,4 +30,12 @@ class BikeAnimation(ABC):
 
     @abstractmethod
     def get_metadata(self) -> dict[str, str]:
-        pass
\ No newline at end of file
+        pass
+
+    def get_available_frames(self) -> range:
+        """
+        Get the frames which can currently be shown.
+        Animations which are still being computed only provide a part of their frames.
+        :return: The range of available frames
+        """
+        return range(self.get_duration())
\ No newline at end of file
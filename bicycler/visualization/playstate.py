@@ -21,5 +21,9 @@ class PlayState:
     def next_frame(self):
         self.frame = (self.frame + self.steps_per_frame) % self.duration
 
+    def clamp(self, available_frames: range):
+        # stay within the frames which are available, e.g. wait for the newest frame of a running simulation
+        self.frame = min(max(self.frame, available_frames.start), available_frames.stop - 1)
+
     def get_animation_delay_ms(self):
         return round(self.timestep * self.steps_per_frame)
\ No newline at end of file
@@ -0,0 +1,111 @@
+import threading
+
+import numpy as np
+
+from model.bicycle_state import BicycleState
+from model.simulation import Simulation
+from visualization.animation import BikeAnimation
+
+
+class StreamingAnimation(BikeAnimation):
+    """
+    Animation which is played while the simulation is still running.
+    A background thread runs the simulation and pushes the states into a ring buffer.
+    The producer waits when the buffer is full, so memory is bounded by the buffer size,
+    and the player waits at the newest state when it catches up with the producer.
+    """
+    # number of frames behind the last requested frame which are kept for stepping back
+    history_fraction = 0.25
+
+    simulation: Simulation
+    buffer: np.ndarray
+    # number of frames written by the producer so far
+    produced: int = 0
+    # last frame requested by the player
+    read_frame: int = 0
+    finished: bool = False
+    error: BaseException | None = None
+
+    def __init__(self, simulation: Simulation, buffer_size: int = 100_000, chunk_size: int = 1024):
+        """
+        :param simulation: The simulation to run, it must not have been run yet
+        :param buffer_size: Maximum number of frames held in memory
+        :param chunk_size: Number of steps the simulation computes at once
+        """
+        self.simulation = simulation
+        self.chunk_size = min(chunk_size, buffer_size)
+        self.buffer = np.zeros((buffer_size, 6))
+        self.history = int(buffer_size * self.history_fraction)
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+
+    def start(self) -> "StreamingAnimation":
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def _produce(self):
+        capacity = len(self.buffer)
+        try:
+            # the frames after a fall are all equal, so the player simply holds the last one
+            for chunk in self.simulation.iter_chunks(self.chunk_size, stop_at_fall=True):
+                written = 0
+                while written < len(chunk):
+                    with self.condition:
+                        # backpressure: do not overwrite frames which the player may still show
+                        keep_from = max(0, self.read_frame - self.history)
+                        while not self.stopped and self.produced >= keep_from + capacity:
+                            self.condition.wait()
+                            keep_from = max(0, self.read_frame - self.history)
+                        if self.stopped:
+                            return
+                        # write as much as fits without wrapping around or overwriting kept frames
+                        position = self.produced % capacity
+                        count = min(len(chunk) - written, capacity - position, keep_from + capacity - self.produced)
+                        self.buffer[position:position + count] = chunk[written:written + count]
+                        self.produced += count
+                        written += count
+                        self.condition.notify_all()
+        except BaseException as e:
+            self.error = e
+        finally:
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+
+    def get_available_frames(self) -> range:
+        with self.condition:
+            return range(max(0, self.produced - len(self.buffer)), self.produced)
+
+    def get_state_at_frame(self, frame) -> BicycleState:
+        with self.condition:
+            # wait for the first frames of the simulation
+            while self.produced == 0 and not self.finished:
+                self.condition.wait()
+            if self.produced == 0:
+                raise RuntimeError("The simulation did not produce any states") from self.error
+            # frames which are not available anymore or not yet are replaced by the closest available frame
+            frame = min(max(frame, self.produced - len(self.buffer)), self.produced - 1)
+            self.read_frame = frame
+            self.condition.notify_all()
+            dataframe = self.buffer[frame % len(self.buffer)].copy()
+        return BicycleState(dataframe[0], dataframe[1], dataframe[2], dataframe[3], dataframe[4], dataframe[5])
+
+    def get_frame_delay_ms(self) -> int:
+        return round(self.get_frame_time_ms())
+
+    def get_frame_time_ms(self) -> float:
+        return self.simulation.parameters.get_output_timestep() * 1000
+
+    def get_duration(self) -> int:
+        return self.simulation.parameters.get_output_count()
+
+    def get_metadata(self) -> dict[str, str]:
+        metadata = self.simulation.parameters.get_description()
+        metadata['engine'] = self.simulation.get_engine()
+        return metadata
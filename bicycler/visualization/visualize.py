@@ -20,12 +20,12 @@ class BikeAnimationWindow(QMainWindow):
     bird_eye_scene: BirdEyeBikeScene
     back_view: RearViewBikeScene
 
-    def __init__(self, animation: BikeAnimation):
+    def __init__(self, animation: BikeAnimation, autoplay: bool = False):
         super().__init__()
 
         # init state
         self.animation = animation
-        self.play_state = PlayState(animation.get_duration(), animation.get_frame_delay_ms())
+        self.play_state = PlayState(animation.get_duration(), animation.get_frame_time_ms())
         self.animation_delay_ms = self.animation.get_frame_delay_ms()
 
         # Scenes
@@ -43,6 +43,9 @@ class BikeAnimationWindow(QMainWindow):
         self.update_canvas()
         self.update_frame_count(self.play_state.frame)
 
+        if autoplay:
+            self.play_pause()
+
     def __setup_window(self, title: str, metadata: dict[str, str] = None):
         self.setWindowTitle(title)
         self.setGeometry(100, 100, 1000, 600)
@@ -129,28 +132,33 @@ class BikeAnimationWindow(QMainWindow):
             self.play_pause_button.setText('Pause')
             self.animation_timer.start(self.play_state.get_animation_delay_ms())
 
-    def next_frame(self):
-        self.play_state.next_frame()
+    def show_available_frame(self):
+        available_frames = self.animation.get_available_frames()
+        if len(available_frames) == 0:
+            return
+        self.play_state.clamp(available_frames)
         self.update_frame_count(self.play_state.frame)
         self.update_canvas()
 
+    def next_frame(self):
+        self.play_state.next_frame()
+        self.show_available_frame()
+
     def step_forward(self):
         self.play_state.step_forward()
-        self.update_frame_count(self.play_state.frame)
-        self.update_canvas()
+        self.show_available_frame()
 
     def step_back(self):
         self.play_state.step_back()
-        self.update_frame_count(self.play_state.frame)
-        self.update_canvas()
+        self.show_available_frame()
 
     def get_play_state(self):
         return self.play_state
 
 
-def visualize_animation(animation: BikeAnimation):
+def visualize_animation(animation: BikeAnimation, autoplay: bool = False):
     app = QApplication(sys.argv)
-    window = BikeAnimationWindow(animation)
+    window = BikeAnimationWindow(animation, autoplay)
     window.show()
     sys.exit(app.exec_())
 